@@ -0,0 +1,132 @@
+from fhir_parser.parser import str_to_patient, str_to_patients, str_to_observations, str_to_error
+import urllib.parse
+import threading
+import asyncio
+import aiohttp
+import json
+
+
+class AsyncFHIR():
+    """
+    FHIR client that makes its requests with asyncio over a pooled aiohttp session. The event loop runs on its own
+    thread, so the blocking methods below can be called from any Flask request thread while the requests of every
+    thread share the same connections. It returns the same fhir_parser Patient and Observation objects as the
+    blocking FHIR client, and raises ConnectionError in the same cases, so the two can be swapped.
+    """
+
+    def __init__(self, endpoint='https://localhost:5001/api/', verify_ssl=False, max_connections=32,
+                 max_concurrent_requests=8, ignore_errors=True):
+        """
+        :param max_connections: maximum number of connections kept open to the FHIR server
+        :param max_concurrent_requests: maximum number of requests, including pages of observations, in flight at
+        once across every caller
+        """
+        self.endpoint = endpoint
+        self.verify_ssl = verify_ssl
+        self.max_connections = max_connections
+        self.max_concurrent_requests = max_concurrent_requests
+        self.ignore_errors = ignore_errors
+        self.session = None
+        self.request_limit = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='AsyncFHIR', daemon=True)
+        self.thread.start()
+
+    def run(self, coroutine):
+        """
+        Runs a coroutine on the client's event loop and waits for its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def fetch_text(self, path):
+        """
+        Fetches a path relative to the FHIR endpoint, or an absolute URL, and returns the body of the response.
+        """
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, ssl=None if self.verify_ssl else False)
+            self.session = aiohttp.ClientSession(connector=connector)
+            self.request_limit = asyncio.Semaphore(self.max_concurrent_requests)
+
+        async with self.request_limit:
+            try:
+                async with self.session.get(urllib.parse.urljoin(self.endpoint, path)) as response:
+                    text = await response.text()
+                    status = response.status
+            except aiohttp.ClientError as error:
+                raise ConnectionError(str(error))
+
+        if text == '' or status != 200:
+            raise ConnectionError('Status code: {}'.format(status))
+        if str_to_error(text) is not None:
+            raise ConnectionError(str_to_error(text))
+        return text
+
+    async def fetch_patient(self, patient_id):
+        """
+        Returns a single patient.
+        """
+        text = await self.fetch_text('Patient/' + str(patient_id))
+        try:
+            return str_to_patient(text)
+        except KeyError:
+            raise AttributeError('Patient data is corrupt')
+
+    async def fetch_all_patients(self):
+        """
+        Returns every patient.
+        """
+        text = await self.fetch_text('Patient/')
+        try:
+            return str_to_patients(text, ignore_errors=self.ignore_errors)
+        except KeyError:
+            raise AttributeError('Patient data is corrupt')
+
+    async def fetch_observations(self, patient_id):
+        """
+        Returns every observation made on a patient. The server may answer with a list of bundles or with a single
+        bundle; either way the next link of the last bundle is followed until there are no more pages.
+        """
+        data = json.loads(await self.fetch_text('Observation/' + str(patient_id)))
+        bundles = data if isinstance(data, list) else [data]
+        visited = set()
+        while True:
+            next_links = [link['url'] for link in bundles[-1].get('link', []) if link.get('relation') == 'next']
+            if not next_links or next_links[0] in visited:
+                break
+            visited.add(next_links[0])
+            page = json.loads(await self.fetch_text(next_links[0]))
+            bundles.extend(page if isinstance(page, list) else [page])
+
+        try:
+            return str_to_observations(json.dumps(bundles), ignore_errors=self.ignore_errors)
+        except KeyError:
+            raise AttributeError('Observation data from patient is corrupt')
+
+    async def fetch_patient_with_observations(self, patient_id):
+        """
+        Fetches a patient and their observations at the same time.
+        """
+        return tuple(await asyncio.gather(self.fetch_patient(patient_id), self.fetch_observations(patient_id)))
+
+    def get_patient(self, patient_id):
+        return self.run(self.fetch_patient(patient_id))
+
+    def get_all_patients(self):
+        return self.run(self.fetch_all_patients())
+
+    def get_patient_observations(self, patient_id):
+        return self.run(self.fetch_observations(patient_id))
+
+    def get_patient_with_observations(self, patient_id):
+        """
+        Returns a patient and their observations, fetched concurrently.
+        """
+        return self.run(self.fetch_patient_with_observations(patient_id))
+
+    def close(self):
+        """
+        Closes the pooled connections and stops the event loop.
+        """
+        if self.session is not None:
+            self.run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
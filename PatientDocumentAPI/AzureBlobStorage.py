@@ -1,15 +1,21 @@
-from azure.storage.blob import BlockBlobService
+from BlobStore import create_blob_store
+
+
+def get_blob_store(storage_account_name, storage_account_key):
+    """
+    Returns the blob store shared by every call made with the same storage account, so a new client and connection
+    is not created for each document.
+    """
+    return create_blob_store({"account_name": storage_account_name, "account_key": storage_account_key})
 
 
 def get_data_from_azure(file_name, storage_account_name, storage_account_key, container_name):
-    blob_service = BlockBlobService(account_name=storage_account_name, account_key=storage_account_key)
-    blob_service.get_blob_to_path(container_name,
-                                  file_name,
-                                  file_name)
+    with open(file_name, 'wb') as blob_file:
+        get_blob_store(storage_account_name, storage_account_key).download_to_stream(container_name, file_name,
+                                                                                     blob_file)
 
 
 def write_data_to_azure(file_name, storage_account_name, storage_account_key,  container_name):
-    blob_service = BlockBlobService(account_name=storage_account_name, account_key=storage_account_key)
-    blob_service.create_blob_from_path(container_name,
-                                       file_name,
-                                       file_name)
+    with open(file_name, 'rb') as blob_file:
+        get_blob_store(storage_account_name, storage_account_key).upload_stream(container_name, file_name, blob_file)
+
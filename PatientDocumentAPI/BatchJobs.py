@@ -0,0 +1,203 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import threading
+import uuid
+import time
+
+
+def render_health_report(use_templates, patient_id, name, patient_data):
+    """
+    Creates the health data word document for a single patient. This runs inside a worker process so that the
+    rendering of charts for different patients is spread across every core rather than one.
+    :param use_templates: whether to fill in the health data template rather than build the document from scratch
+    :param patient_id: ID of the patient the document is for
+    :param name: Full name of the patient
+    :param patient_data: dictionary mapping each vital sign to its VitalSignSeries
+    :return: bytes of the finished .docx file
+    """
+    if use_templates:
+        from DocumentTemplates import TemplatePatientHealthForm as health_form_type
+    else:
+        from GenerateDocuments import PatientHealthForm as health_form_type
+    return health_form_type(patient_id, name, patient_data).generate_patient_data_form().getvalue()
+
+
+class BatchJob():
+    """
+    Keeps track of the progress of every patient in a batch of health reports.
+    """
+
+    def __init__(self, patient_ids):
+        self.job_id = str(uuid.uuid4())
+        self.created = time.time()
+        self.finished = None
+        self.lock = threading.Lock()
+        self.statuses = OrderedDict((patient_id, {"status": "queued"}) for patient_id in patient_ids)
+
+    def set_status(self, patient_id, status, error=None):
+        """
+        Records the stage a patient has reached, and the error message if generating their document failed.
+        """
+        with self.lock:
+            self.statuses[patient_id] = {"status": status} if error is None else {"status": status, "error": error}
+            if self.finished is None and all(entry["status"] in ("done", "unchanged", "failed")
+                                             for entry in self.statuses.values()):
+                self.finished = time.time()
+
+    def summary(self, status_filter=None):
+        """
+        Creates a dictionary describing the overall progress of the job along with the status of each patient.
+        :param status_filter: if given only patients currently at this status are listed
+        """
+        with self.lock:
+            counts = {}
+            for entry in self.statuses.values():
+                counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+            patients = {patient_id: dict(entry) for patient_id, entry in self.statuses.items()
+                        if status_filter is None or entry["status"] == status_filter}
+            completed = counts.get("done", 0) + counts.get("unchanged", 0) + counts.get("failed", 0)
+            return {"job_id": self.job_id,
+                    "state": "finished" if self.finished is not None else "running",
+                    "total": len(self.statuses),
+                    "completed": completed,
+                    "progress": completed / len(self.statuses) if self.statuses else 1.0,
+                    "counts": counts,
+                    "elapsed": (self.finished or time.time()) - self.created,
+                    "patients": patients}
+
+
+class BatchJobManager():
+    """
+    Runs batches of health reports as a pipeline of three stages, each with its own pool of workers. Patient data is
+    fetched from FHIR on a pool of threads, documents are rendered on a pool of processes and finished documents are
+    uploaded to Azure on a second pool of threads, so every stage works on a different patient at the same time.
+    """
+
+    def __init__(self, fetch_stage, upload_stage, render_pool, fetch_workers=8, upload_workers=8, max_in_flight=64,
+                 use_templates=False, cache_stage=None, retention=86400):
+        """
+        :param fetch_stage: function taking a patient ID and returning the patient's name and health data
+        :param upload_stage: function taking the blob name, bytes and metadata of a finished document and storing it
+        on Azure
+        :param render_pool: ChartRenderPool whose worker processes render the documents
+        :param max_in_flight: maximum number of patients that have been fetched but not yet uploaded, which stops
+        fetched data from piling up in memory when rendering falls behind
+        :param use_templates: whether health data documents are filled in from a template
+        :param cache_stage: optional function taking a patient ID, name and health data and returning the metadata to
+        store with the document, or None if the stored document was made from the same data, in which case the patient
+        is marked unchanged without rendering or uploading anything
+        :param retention: seconds finished jobs are kept for before they are removed
+        """
+        self.fetch_stage = fetch_stage
+        self.cache_stage = cache_stage
+        self.upload_stage = upload_stage
+        self.fetch_pool = ThreadPoolExecutor(fetch_workers)
+        self.render_pool = render_pool
+        self.upload_pool = ThreadPoolExecutor(upload_workers)
+        self.max_in_flight = max_in_flight
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.in_flight_count = 0
+        self.in_flight_lock = threading.Lock()
+        self.use_templates = use_templates
+        self.retention = retention
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+
+    def submit(self, patient_ids):
+        """
+        Starts generating health reports for every patient in the list and returns the job tracking them.
+        """
+        job = BatchJob(list(OrderedDict.fromkeys(patient_ids)))
+        with self.jobs_lock:
+            self._expire()
+            self.jobs[job.job_id] = job
+        for patient_id in job.statuses.keys():
+            self.fetch_pool.submit(self._fetch, job, patient_id)
+        return job
+
+    def get(self, job_id):
+        """
+        Returns the job with the given ID or None if no such job exists.
+        """
+        with self.jobs_lock:
+            self._expire()
+            return self.jobs.get(job_id)
+
+    def stats(self):
+        """
+        Returns the number of jobs kept and the number of patients fetched but not yet uploaded.
+        """
+        with self.jobs_lock:
+            self._expire()
+            jobs = len(self.jobs)
+        with self.in_flight_lock:
+            in_flight = self.in_flight_count
+        return {"jobs": jobs, "in_flight": in_flight}
+
+    def _expire(self):
+        """
+        Removes jobs that finished more than retention seconds ago. Must be called holding jobs_lock.
+        """
+        cutoff = time.time() - self.retention
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job.finished is not None and job.finished < cutoff]:
+            del self.jobs[job_id]
+
+    def _acquire(self):
+        """
+        Waits for room for another patient in the pipeline and counts them as in flight.
+        """
+        self.in_flight.acquire()
+        with self.in_flight_lock:
+            self.in_flight_count += 1
+
+    def _release(self):
+        """
+        Counts a patient as having left the pipeline and makes room for the next one.
+        """
+        with self.in_flight_lock:
+            self.in_flight_count -= 1
+        self.in_flight.release()
+
+    def _fetch(self, job, patient_id):
+        self._acquire()
+        job.set_status(patient_id, "fetching")
+        try:
+            name, patient_data = self.fetch_stage(patient_id)
+            metadata = self.cache_stage(patient_id, name, patient_data) if self.cache_stage is not None else None
+        except Exception as error:
+            self._fail(job, patient_id, error)
+            return
+        if self.cache_stage is not None and metadata is None:
+            job.set_status(patient_id, "unchanged")
+            self._release()
+            return
+
+        job.set_status(patient_id, "rendering")
+        try:
+            future = self.render_pool.submit(render_health_report, self.use_templates, patient_id, name,
+                                             patient_data)
+        except Exception as error:
+            self._fail(job, patient_id, error)
+            return
+        future.add_done_callback(lambda rendered: self._rendered(job, patient_id, rendered, metadata))
+
+    def _rendered(self, job, patient_id, future, metadata):
+        if future.exception() is not None:
+            self._fail(job, patient_id, future.exception())
+            return
+        job.set_status(patient_id, "uploading")
+        self.upload_pool.submit(self._upload, job, patient_id, future.result(), metadata)
+
+    def _upload(self, job, patient_id, document, metadata):
+        try:
+            self.upload_stage(patient_id + " health data.docx", document, metadata)
+        except Exception as error:
+            self._fail(job, patient_id, error)
+            return
+        job.set_status(patient_id, "done")
+        self._release()
+
+    def _fail(self, job, patient_id, error):
+        job.set_status(patient_id, "failed", str(error) or type(error).__name__)
+        self._release()
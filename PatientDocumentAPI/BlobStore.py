@@ -0,0 +1,332 @@
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
+from requests.adapters import HTTPAdapter
+import requests
+from contextlib import contextmanager
+import threading
+import tempfile
+import shutil
+import json
+import os
+
+# shared blob stores, one per set of settings, kept for the life of the process
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class BlobConditionFailed(Exception):
+    """
+    Raised when a conditional upload is refused because the blob is no longer the version the upload was made
+    against, such as when another node stored it first.
+    """
+
+
+class BlobStore():
+    """
+    Interface for somewhere documents are stored. The API only talks to a store through these methods, so Azure can be
+    swapped for a local stand-in when benchmarking or testing the upload path. Every upload can be made conditional:
+    if_match only replaces the blob if its ETag is still the one given, and if_none_match='*' only creates a blob that
+    does not exist yet. An upload whose condition fails raises BlobConditionFailed and leaves the blob untouched.
+    """
+
+    def upload_bytes(self, container_name, blob_name, data, metadata=None, if_match=None, if_none_match=None):
+        """
+        Stores bytes as a blob, replacing it if it already exists.
+        :param metadata: dictionary of strings stored alongside the blob, replacing any it had before
+        """
+        raise NotImplementedError
+
+    def upload_stream(self, container_name, blob_name, stream, metadata=None, if_match=None, if_none_match=None):
+        """
+        Stores the remaining contents of a readable stream as a blob, replacing it if it already exists.
+        :param metadata: dictionary of strings stored alongside the blob, replacing any it had before
+        """
+        raise NotImplementedError
+
+    def upload_file(self, container_name, blob_name, path, metadata=None, if_match=None, if_none_match=None):
+        """
+        Stores the contents of a file on disk as a blob, replacing it if it already exists. Large files are uploaded
+        in blocks without reading the whole file into memory.
+        """
+        raise NotImplementedError
+
+    def download_bytes(self, container_name, blob_name):
+        """
+        Returns the contents of a blob, raising AzureMissingResourceHttpError if it does not exist.
+        """
+        raise NotImplementedError
+
+    def download_to_stream(self, container_name, blob_name, stream):
+        """
+        Writes the contents of a blob to a writable stream, raising AzureMissingResourceHttpError if it does not exist.
+        """
+        raise NotImplementedError
+
+    def exists(self, container_name, blob_name):
+        """
+        Returns whether a blob exists.
+        """
+        raise NotImplementedError
+
+    def get_metadata(self, container_name, blob_name):
+        """
+        Returns the metadata dictionary of a blob without downloading it, or None if the blob does not exist.
+        """
+        raise NotImplementedError
+
+    def get_properties(self, container_name, blob_name):
+        """
+        Returns the ETag and metadata dictionary of a blob without downloading it, or None and None if the blob does
+        not exist.
+        """
+        raise NotImplementedError
+
+
+class AzureBlobStore(BlobStore):
+    """
+    Blob store backed by an Azure storage account. One BlockBlobService is created and shared by every thread, so
+    each upload reuses a pooled connection instead of paying for a new client and TLS handshake. Large documents are
+    uploaded as blocks in parallel and failed requests are retried with exponential backoff.
+    """
+
+    def __init__(self, account_name=None, account_key=None, connection_string=None, pool_size=32,
+                 upload_connections=4, single_put_size=None, block_size=None, retry_attempts=3, retry_backoff=1):
+        """
+        :param connection_string: used instead of the account name and key when given, for example to point at a
+        local Azurite storage emulator
+        :param pool_size: number of connections kept open to the storage account
+        :param upload_connections: number of blocks of a single blob uploaded in parallel
+        :param single_put_size: blobs bigger than this many bytes are uploaded in blocks rather than a single request
+        :param block_size: size in bytes of each block of a block upload
+        :param retry_attempts: number of times a failed request is retried
+        :param retry_backoff: seconds waited before the first retry, growing exponentially for each retry after
+        """
+        self.account_name = account_name
+        self.account_key = account_key
+        self.connection_string = connection_string
+        self.pool_size = pool_size
+        self.upload_connections = upload_connections
+        self.single_put_size = single_put_size
+        self.block_size = block_size
+        self.retry_attempts = retry_attempts
+        self.retry_backoff = retry_backoff
+        self._service = None
+        self._service_lock = threading.Lock()
+
+    @property
+    def service(self):
+        """
+        The shared BlockBlobService, created on first use so the API can start before storage details are filled in.
+        """
+        with self._service_lock:
+            if self._service is None:
+                self._service = self.create_service()
+            return self._service
+
+    def create_service(self):
+        """
+        Creates a BlockBlobService using a pooled HTTP session and exponential backoff between retries. The Azure SDK
+        is imported here so processes using the local store, or not yet storing anything, never load it.
+        """
+        from azure.storage.blob import BlockBlobService
+        from azure.storage.common.retry import ExponentialRetry
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        if self.connection_string:
+            service = BlockBlobService(connection_string=self.connection_string, request_session=session)
+        else:
+            service = BlockBlobService(account_name=self.account_name, account_key=self.account_key,
+                                       request_session=session)
+        service.retry = ExponentialRetry(initial_backoff=self.retry_backoff, increment_base=self.retry_backoff + 2,
+                                         max_attempts=self.retry_attempts).retry
+        if self.single_put_size:
+            service.MAX_SINGLE_PUT_SIZE = self.single_put_size
+        if self.block_size:
+            service.MAX_BLOCK_SIZE = self.block_size
+        return service
+
+    def upload_bytes(self, container_name, blob_name, data, metadata=None, if_match=None, if_none_match=None):
+        with conditional_upload():
+            self.service.create_blob_from_bytes(container_name, blob_name, data, metadata=metadata,
+                                                max_connections=self.upload_connections, if_match=if_match,
+                                                if_none_match=if_none_match)
+
+    def upload_stream(self, container_name, blob_name, stream, metadata=None, if_match=None, if_none_match=None):
+        with conditional_upload():
+            self.service.create_blob_from_stream(container_name, blob_name, stream, metadata=metadata,
+                                                 max_connections=self.upload_connections, if_match=if_match,
+                                                 if_none_match=if_none_match)
+
+    def upload_file(self, container_name, blob_name, path, metadata=None, if_match=None, if_none_match=None):
+        with conditional_upload():
+            self.service.create_blob_from_path(container_name, blob_name, path, metadata=metadata,
+                                               max_connections=self.upload_connections, if_match=if_match,
+                                               if_none_match=if_none_match)
+
+    def download_bytes(self, container_name, blob_name):
+        return self.service.get_blob_to_bytes(container_name, blob_name,
+                                              max_connections=self.upload_connections).content
+
+    def download_to_stream(self, container_name, blob_name, stream):
+        self.service.get_blob_to_stream(container_name, blob_name, stream, max_connections=self.upload_connections)
+
+    def exists(self, container_name, blob_name):
+        return self.service.exists(container_name, blob_name)
+
+    def get_metadata(self, container_name, blob_name):
+        try:
+            return self.service.get_blob_metadata(container_name, blob_name)
+        except AzureMissingResourceHttpError:
+            return None
+
+    def get_properties(self, container_name, blob_name):
+        try:
+            blob = self.service.get_blob_properties(container_name, blob_name)
+        except AzureMissingResourceHttpError:
+            return None, None
+        return blob.properties.etag, blob.metadata
+
+
+class LocalBlobStore(BlobStore):
+    """
+    Blob store keeping each container as a folder on the local file system. Used in place of Azure for benchmarks and
+    local development. Metadata is kept as a JSON file per blob in a .metadata folder inside the container. The ETag
+    of a blob is made from its file's inode, modification time and size, and conditional uploads are only atomic
+    between the threads of one process.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+
+    def path(self, container_name, blob_name):
+        """
+        Returns the path of the file holding a blob.
+        """
+        return os.path.join(self.root, container_name, blob_name)
+
+    def metadata_path(self, container_name, blob_name):
+        """
+        Returns the path of the file holding the metadata of a blob.
+        """
+        return os.path.join(self.root, container_name, '.metadata', blob_name + '.json')
+
+    def etag(self, container_name, blob_name):
+        """
+        Returns the ETag of a blob, or None if it does not exist.
+        """
+        try:
+            stat = os.stat(self.path(container_name, blob_name))
+        except FileNotFoundError:
+            return None
+        return '"%x-%x-%x"' % (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def upload_bytes(self, container_name, blob_name, data, metadata=None, if_match=None, if_none_match=None):
+        self.write(container_name, blob_name, lambda blob_file: blob_file.write(data), metadata, if_match,
+                   if_none_match)
+
+    def upload_file(self, container_name, blob_name, path, metadata=None, if_match=None, if_none_match=None):
+        def copy(blob_file):
+            with open(path, 'rb') as source:
+                shutil.copyfileobj(source, blob_file)
+        self.write(container_name, blob_name, copy, metadata, if_match, if_none_match)
+
+    def write(self, container_name, blob_name, write_data, metadata=None, if_match=None, if_none_match=None):
+        """
+        Stores a blob and its metadata, if the blob still meets the conditions given.
+        :param write_data: function writing the contents of the blob to the file object it is given
+        """
+        folder = os.path.join(self.root, container_name)
+        metadata_folder = os.path.join(folder, '.metadata')
+        os.makedirs(metadata_folder, exist_ok=True)
+        # written to temporary files first so readers never see a partly written blob
+        with tempfile.NamedTemporaryFile(dir=folder, delete=False) as blob_file:
+            write_data(blob_file)
+        with tempfile.NamedTemporaryFile('w', dir=metadata_folder, delete=False) as metadata_file:
+            json.dump(metadata or {}, metadata_file)
+
+        with self.lock:
+            etag = self.etag(container_name, blob_name)
+            if (if_match is not None and if_match != etag) or (if_none_match == '*' and etag is not None):
+                os.remove(blob_file.name)
+                os.remove(metadata_file.name)
+                raise BlobConditionFailed('The condition specified using HTTP conditional header(s) is not met.')
+            os.replace(blob_file.name, self.path(container_name, blob_name))
+            # the metadata is replaced after the blob, so a crash in between leaves stale metadata rather than
+            # metadata describing a blob that was never written
+            os.replace(metadata_file.name, self.metadata_path(container_name, blob_name))
+
+    def upload_stream(self, container_name, blob_name, stream, metadata=None, if_match=None, if_none_match=None):
+        self.upload_bytes(container_name, blob_name, stream.read(), metadata, if_match, if_none_match)
+
+    def download_bytes(self, container_name, blob_name):
+        try:
+            with open(self.path(container_name, blob_name), 'rb') as blob_file:
+                return blob_file.read()
+        except FileNotFoundError:
+            raise AzureMissingResourceHttpError('The specified blob does not exist.', 404)
+
+    def download_to_stream(self, container_name, blob_name, stream):
+        try:
+            with open(self.path(container_name, blob_name), 'rb') as blob_file:
+                shutil.copyfileobj(blob_file, stream)
+        except FileNotFoundError:
+            raise AzureMissingResourceHttpError('The specified blob does not exist.', 404)
+
+    def exists(self, container_name, blob_name):
+        return os.path.isfile(self.path(container_name, blob_name))
+
+    def get_metadata(self, container_name, blob_name):
+        if not self.exists(container_name, blob_name):
+            return None
+        try:
+            with open(self.metadata_path(container_name, blob_name)) as metadata_file:
+                return json.load(metadata_file)
+        except FileNotFoundError:
+            return {}
+
+    def get_properties(self, container_name, blob_name):
+        # read together so the ETag always belongs to the blob the metadata describes
+        with self.lock:
+            return self.etag(container_name, blob_name), self.get_metadata(container_name, blob_name)
+
+
+@contextmanager
+def conditional_upload():
+    """
+    Turns the errors Azure answers a failed upload condition with, 412 for If-Match and 409 for If-None-Match, into
+    BlobConditionFailed.
+    """
+    try:
+        yield
+    except AzureHttpError as error:
+        if error.status_code in (409, 412):
+            raise BlobConditionFailed(str(error))
+        raise
+
+
+def create_blob_store(config):
+    """
+    Returns the shared blob store described by a config dictionary, creating it the first time it is asked for.
+    The blob_backend entry chooses between "azure", the default, and "local".
+    """
+    if config.get('blob_backend', 'azure') == 'local':
+        key = ('local', config.get('blob_local_root', 'blob_storage'))
+        build = lambda: LocalBlobStore(key[1])
+    else:
+        key = ('azure', config.get('account_name'), config.get('account_key'), config.get('connection_string'))
+        build = lambda: AzureBlobStore(config.get('account_name'), config.get('account_key'),
+                                       config.get('connection_string'),
+                                       pool_size=config.get('blob_pool_size', 32),
+                                       upload_connections=config.get('blob_upload_connections', 4),
+                                       single_put_size=config.get('blob_single_put_size'),
+                                       block_size=config.get('blob_block_size'),
+                                       retry_attempts=config.get('blob_retry_attempts', 3),
+                                       retry_backoff=config.get('blob_retry_backoff', 1))
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = build()
+        return _stores[key]
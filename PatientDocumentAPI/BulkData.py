@@ -0,0 +1,287 @@
+from fhir_parser.parser import str_to_patient, str_to_observation
+import urllib.parse
+import threading
+import sqlite3
+import gzip
+import json
+import time
+import uuid
+import os
+
+# resource types read from a bulk export, every other type in an export is skipped
+BULK_RESOURCE_TYPES = ('Patient', 'Observation')
+
+# tables the store is read from, as opposed to the staging tables a replacement export is read into
+LIVE_TABLES = ('patients', 'observations')
+
+
+def open_ndjson(path):
+    """
+    Opens an NDJSON file, or a gzipped one ending in .gz, for reading a line at a time.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def ndjson_files(folder):
+    """
+    Returns the paths of the NDJSON files in a folder, such as Patient.ndjson or Observation.000.ndjson.gz, in name
+    order.
+    """
+    return [os.path.join(folder, name) for name in sorted(os.listdir(folder))
+            if name.endswith('.ndjson') or name.endswith('.ndjson.gz')]
+
+
+class BulkDataStore():
+    """
+    Local SQLite store of the Patient and Observation resources of a FHIR Bulk Data export, with observations indexed
+    by patient. NDJSON is read a line at a time and written in batches, so exports of any size are ingested without
+    being held in memory. The store answers get_patient, get_patient_observations, get_patient_with_observations and
+    get_all_patients with the same fhir_parser objects, and the same ConnectionError for missing patients, as the FHIR
+    client, so it can be used in place of it and whole cohorts are reported on without a request to the FHIR server.
+    Each resource is kept as its line of JSON and only parsed when it is asked for. An import replacing the whole
+    store is read into staging tables and swapped in with one transaction once it has been read completely, so the
+    store keeps answering from its old contents meanwhile and is left untouched if the import fails.
+    """
+
+    def __init__(self, path='bulk_data.sqlite3', batch_size=1000, ignore_errors=True):
+        """
+        :param path: path of the SQLite file holding the store, which several API worker processes can share
+        :param batch_size: number of resources written in each transaction while ingesting
+        :param ignore_errors: whether observations that cannot be parsed are left out rather than failing the request
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.ignore_errors = ignore_errors
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.create_tables(LIVE_TABLES)
+            self.connection.execute('CREATE INDEX IF NOT EXISTS observations_by_patient ON observations (patient_id)')
+
+    def create_tables(self, tables):
+        """
+        Creates a pair of patient and observation tables if they do not exist.
+        """
+        self.connection.execute('CREATE TABLE IF NOT EXISTS {} (patient_id TEXT PRIMARY KEY, '
+                                'resource TEXT NOT NULL)'.format(tables[0]))
+        self.connection.execute('CREATE TABLE IF NOT EXISTS {} (observation_id TEXT PRIMARY KEY, '
+                                'patient_id TEXT NOT NULL, resource TEXT NOT NULL)'.format(tables[1]))
+
+    def staged(self, replace, ingest):
+        """
+        Runs a function ingesting resources into the tables it is given. When replace is set it is given a new pair of
+        staging tables, whose contents replace everything in the store in one transaction once it returns, and which
+        are dropped whether it succeeds or not.
+        :return: what the function returns
+        """
+        if not replace:
+            return ingest(LIVE_TABLES)
+        suffix = uuid.uuid4().hex
+        tables = ('patients_' + suffix, 'observations_' + suffix)
+        with self.lock, self.connection:
+            self.create_tables(tables)
+        try:
+            totals = ingest(tables)
+            with self.lock, self.connection:
+                self.connection.execute('DELETE FROM observations')
+                self.connection.execute('DELETE FROM patients')
+                self.connection.execute('INSERT INTO patients SELECT patient_id, resource FROM {}'.format(tables[0]))
+                self.connection.execute('INSERT INTO observations SELECT observation_id, patient_id, resource '
+                                        'FROM {}'.format(tables[1]))
+            return totals
+        finally:
+            with self.lock, self.connection:
+                for table in tables:
+                    self.connection.execute('DROP TABLE IF EXISTS {}'.format(table))
+
+    def ingest_lines(self, lines, tables=LIVE_TABLES):
+        """
+        Stores the resources in an iterable of NDJSON lines, replacing any stored resource with the same ID. Lines
+        that are blank, are not JSON or are of a type other than Patient and Observation are skipped.
+        :param tables: names of the patient and observation tables to write to
+        :return: dictionary of the number of patients, observations and skipped lines read
+        """
+        counts = {"patients": 0, "observations": 0, "skipped": 0}
+        patients = []
+        observations = []
+        for line in lines:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                resource = json.loads(line)
+                resource_type = resource.get('resourceType')
+                if resource_type == 'Patient':
+                    patients.append((resource['id'], line))
+                elif resource_type == 'Observation':
+                    observations.append((resource['id'], resource['subject']['reference'].split('/')[-1], line))
+                else:
+                    counts["skipped"] += 1
+            except (ValueError, KeyError, TypeError, AttributeError):
+                counts["skipped"] += 1
+            if len(patients) + len(observations) >= self.batch_size:
+                self._write(tables, patients, observations, counts)
+        self._write(tables, patients, observations, counts)
+        return counts
+
+    def _write(self, tables, patients, observations, counts):
+        """
+        Writes a batch of resources in one transaction and empties the lists holding them.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO {} VALUES (?, ?)'.format(tables[0]), patients)
+            self.connection.executemany('INSERT OR REPLACE INTO {} VALUES (?, ?, ?)'.format(tables[1]), observations)
+        counts["patients"] += len(patients)
+        counts["observations"] += len(observations)
+        del patients[:]
+        del observations[:]
+
+    def ingest_file(self, path, tables=LIVE_TABLES):
+        """
+        Stores the resources of one NDJSON file, which may be gzipped.
+        """
+        with open_ndjson(path) as ndjson_file:
+            return self.ingest_lines(ndjson_file, tables)
+
+    def ingest_folder(self, folder, replace=False):
+        """
+        Stores the resources of every NDJSON file in a folder, for example the output of a bulk export saved to disk.
+        :param replace: whether the files replace everything in the store rather than being added to it
+        :return: dictionary of the number of files, patients, observations and skipped lines read
+        """
+        def ingest(tables):
+            totals = {"files": 0, "patients": 0, "observations": 0, "skipped": 0}
+            for path in ndjson_files(folder):
+                for key, count in self.ingest_file(path, tables).items():
+                    totals[key] += count
+                totals["files"] += 1
+            return totals
+        return self.staged(replace, ingest)
+
+    def ingest_export(self, endpoint, verify_ssl=False, poll_interval=5, timeout=3600, session=None, replace=False):
+        """
+        Runs a FHIR Bulk Data export of patients and observations on a server and stores its output. The export is
+        started with a kick-off request to endpoint/$export, its status URL is polled until the export is complete,
+        honouring Retry-After, and each NDJSON file of the manifest is streamed into the store a line at a time.
+        Raises ConnectionError if the server refuses the export, it fails or it takes longer than timeout seconds.
+        :param replace: whether the export replaces everything in the store rather than being added to it
+        :return: dictionary of the number of files, patients, observations and skipped lines read
+        """
+        import requests
+        session = session or requests.Session()
+        kick_off = urllib.parse.urljoin(endpoint if endpoint.endswith('/') else endpoint + '/', '$export')
+        response = session.get(kick_off, params={'_type': ','.join(BULK_RESOURCE_TYPES)}, verify=verify_ssl,
+                               headers={'Accept': 'application/fhir+json', 'Prefer': 'respond-async'})
+        if response.status_code != 202 or 'Content-Location' not in response.headers:
+            raise ConnectionError('Bulk export was not started, status code: {}'.format(response.status_code))
+        status_url = response.headers['Content-Location']
+
+        deadline = time.monotonic() + timeout
+        while True:
+            response = session.get(status_url, verify=verify_ssl, headers={'Accept': 'application/json'})
+            if response.status_code == 200:
+                break
+            if response.status_code != 202:
+                raise ConnectionError('Bulk export failed, status code: {}'.format(response.status_code))
+            if time.monotonic() > deadline:
+                raise ConnectionError('Bulk export did not finish within {} seconds'.format(timeout))
+            retry_after = response.headers.get('Retry-After', '')
+            time.sleep(int(retry_after) if retry_after.isdigit() else poll_interval)
+
+        outputs = [output for output in response.json().get('output', []) if output.get('type') in BULK_RESOURCE_TYPES]
+
+        def ingest(tables):
+            totals = {"files": 0, "patients": 0, "observations": 0, "skipped": 0}
+            for output in outputs:
+                with session.get(output['url'], verify=verify_ssl, stream=True,
+                                 headers={'Accept': 'application/fhir+ndjson'}) as ndjson_response:
+                    if ndjson_response.status_code != 200:
+                        raise ConnectionError('Bulk export file could not be downloaded, status code: {}'
+                                              .format(ndjson_response.status_code))
+                    for key, count in self.ingest_lines(ndjson_response.iter_lines(), tables).items():
+                        totals[key] += count
+                totals["files"] += 1
+            return totals
+        return self.staged(replace, ingest)
+
+    def get_patient(self, patient_id):
+        """
+        Returns a single patient, raising ConnectionError if they are not in the store.
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT resource FROM patients WHERE patient_id = ?',
+                                          (str(patient_id),)).fetchone()
+        if row is None:
+            raise ConnectionError('Patient {} is not in the bulk data store'.format(patient_id))
+        try:
+            return str_to_patient(row[0])
+        except KeyError:
+            raise AttributeError('Patient data is corrupt')
+
+    def get_all_patients(self):
+        """
+        Returns every patient in the store.
+        """
+        with self.lock:
+            rows = self.connection.execute('SELECT resource FROM patients ORDER BY rowid').fetchall()
+        patients = []
+        for (resource,) in rows:
+            try:
+                patients.append(str_to_patient(resource))
+            except Exception:
+                if not self.ignore_errors:
+                    raise
+        return patients
+
+    def get_patient_observations(self, patient_id):
+        """
+        Returns every observation made on a patient in the order they were exported, raising ConnectionError if the
+        patient is not in the store.
+        """
+        with self.lock:
+            known = self.connection.execute('SELECT 1 FROM patients WHERE patient_id = ?',
+                                            (str(patient_id),)).fetchone()
+            rows = self.connection.execute('SELECT resource FROM observations WHERE patient_id = ? ORDER BY rowid',
+                                           (str(patient_id),)).fetchall()
+        if known is None:
+            raise ConnectionError('Patient {} is not in the bulk data store'.format(patient_id))
+        observations = []
+        for (resource,) in rows:
+            try:
+                observations.append(str_to_observation(resource))
+            except Exception:
+                if not self.ignore_errors:
+                    raise
+        return observations
+
+    def get_patient_with_observations(self, patient_id):
+        """
+        Returns a patient and their observations.
+        """
+        return self.get_patient(patient_id), self.get_patient_observations(patient_id)
+
+    def stats(self):
+        """
+        Returns the number of patients and observations in the store.
+        """
+        with self.lock:
+            patients = self.connection.execute('SELECT COUNT(*) FROM patients').fetchone()[0]
+            observations = self.connection.execute('SELECT COUNT(*) FROM observations').fetchone()[0]
+        return {"patients": patients, "observations": observations}
+
+    def clear(self):
+        """
+        Removes every resource from the store, before ingesting a complete new export.
+        """
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM observations')
+            self.connection.execute('DELETE FROM patients')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,248 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+from VitalSeries import as_series
+from io import BytesIO
+import importlib
+import threading
+import os
+
+# charts are only ever drawn to images, so matplotlib never needs to look for an interactive backend. matplotlib
+# itself is imported the first time a renderer is created, not when this module is.
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+# image formats charts can be saved in, both of which can be placed in a word document
+IMAGE_FORMATS = ('png', 'jpeg')
+
+# lowest resolution a chart is saved at to bring it under max_bytes
+MIN_DPI = 50
+
+# modules a chart worker draws with, imported before the workers are forked
+CHART_MODULES = ('matplotlib.figure', 'matplotlib.backends.backend_agg')
+
+# one renderer per process, created the first time a chart is drawn in that process
+_renderer = None
+
+# settings the renderer of this process is created with, set by configure_charts
+_settings = {}
+
+
+class ChartRenderer():
+    """
+    Draws the vital sign charts used in patient health reports. A single figure and canvas are created up front and
+    cleared between charts, so no pyplot global state is touched and memory use stays the same no matter how many
+    charts are drawn. Series longer than max_points are downsampled before they are drawn and images larger than
+    max_bytes are saved again at a lower resolution, so the time and space taken by one chart is bounded however
+    much data a patient has.
+    """
+
+    def __init__(self, width=6.4, height=4.8, dpi=100, image_format='png', max_points=2000, downsample='minmax',
+                 max_bytes=0):
+        """
+        :param width: width of each chart in inches
+        :param height: height of each chart in inches
+        :param dpi: resolution the charts are saved at
+        :param image_format: png, or jpeg for smaller files from charts with many points
+        :param max_points: most points drawn for one vital sign, 0 to draw every reading
+        :param downsample: minmax to keep the lowest and highest reading of each stretch of time, or lttb
+        :param max_bytes: largest size in bytes of one chart image, 0 for no limit
+        """
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError('Unknown chart image format ' + image_format)
+        if downsample not in ('minmax', 'lttb'):
+            raise ValueError('Unknown downsampling method ' + downsample)
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        self.figure = Figure(figsize=(width, height), dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_subplot(1, 1, 1)
+        self.dpi = dpi
+        self.image_format = image_format
+        self.max_points = max_points
+        self.downsample = downsample
+        self.max_bytes = max_bytes
+
+    def render(self, title, dates, values, unit):
+        """
+        Draws a single chart of values against dates and returns it as image bytes.
+        :param title: title shown above the chart
+        :param dates: datetimes for the x axis
+        :param values: readings for the y axis
+        :param unit: unit of the readings, used to label the y axis
+        """
+        self.axes.clear()
+        self.axes.plot(dates, values, 'o', color='orange')
+        self.axes.set_xlabel('Date')
+        self.axes.set_ylabel(unit)
+        self.axes.set_title(title)
+        dpi = self.dpi
+        image = self.save(dpi)
+        while self.max_bytes and len(image) > self.max_bytes and dpi > MIN_DPI:
+            dpi = max(MIN_DPI, int(dpi * 0.7))
+            image = self.save(dpi)
+        return image
+
+    def render_series(self, title, series):
+        """
+        Draws a chart of a VitalSignSeries, downsampled to at most max_points readings.
+        """
+        if self.max_points and len(series) > self.max_points:
+            if self.downsample == 'lttb':
+                series = series.lttb(self.max_points)
+            else:
+                series = series.envelope(self.max_points)
+        return self.render(title, series.dates, series.values, series.unit)
+
+    def save(self, dpi):
+        memfile = BytesIO()
+        self.canvas.print_figure(memfile, format=self.image_format, dpi=dpi)
+        return memfile.getvalue()
+
+
+def configure_charts(settings):
+    """
+    Sets how charts are drawn in the current process, replacing its renderer if one has already been created.
+    :param settings: dictionary of ChartRenderer keyword arguments
+    """
+    global _renderer, _settings
+    _settings = dict(settings)
+    _renderer = None
+
+
+def chart_settings():
+    """
+    Returns the settings charts are drawn with in the current process.
+    """
+    return dict(_settings)
+
+
+def get_renderer():
+    """
+    Returns the chart renderer belonging to the current process, creating it if needed.
+    """
+    global _renderer
+    if _renderer is None:
+        _renderer = ChartRenderer(**_settings)
+    return _renderer
+
+
+def warm_up_renderer(_=None):
+    """
+    Creates the renderer of the current process and draws an empty chart with it, so matplotlib and its fonts are
+    loaded before the first real chart is needed.
+    :return: ID of the process that was warmed up
+    """
+    get_renderer().render('', [], [], '')
+    return os.getpid()
+
+
+def render_patient_charts(patient_data):
+    """
+    Draws a chart for every vital sign in a patient's health data.
+    :param patient_data: dictionary mapping each vital sign to its VitalSignSeries
+    :return: ordered dictionary mapping each vital sign to its chart as image bytes
+    """
+    renderer = get_renderer()
+    charts = OrderedDict()
+    for data_type in patient_data.keys():
+        charts[data_type] = renderer.render_series(data_type, as_series(patient_data[data_type]))
+    return charts
+
+
+class ChartRenderPool():
+    """
+    Pool of worker processes used to draw charts and documents for many patients at once. The workers are forked the
+    first time the pool is used, all at once, after the modules they need have been imported in this process. A
+    worker forked while another thread was part way through importing one of those modules would inherit the held
+    import lock and wait on it forever. If a worker dies, for example killed for using too much memory, the pool is
+    replaced by a new one so later charts can still be drawn.
+    """
+
+    def __init__(self, workers=None, settings=None, preload=()):
+        """
+        :param settings: dictionary of ChartRenderer keyword arguments the charts are drawn with in every worker
+        :param preload: names of any other modules the functions submitted to the workers import
+        """
+        self.workers = workers or os.cpu_count()
+        self.settings = settings or {}
+        self.preload = CHART_MODULES + tuple(preload)
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def get_executor(self):
+        """
+        Returns the executor running the workers, importing the modules they need and forking every worker the first
+        time it is asked for.
+        """
+        with self.lock:
+            if self.executor is None:
+                for module in self.preload:
+                    importlib.import_module(module)
+                executor = ProcessPoolExecutor(self.workers, initializer=configure_charts, initargs=(self.settings,))
+                # the first task forks every worker, so none is forked later from a thread that is not holding this lock
+                executor.submit(os.getpid).result()
+                self.executor = executor
+            return self.executor
+
+    def replace_broken(self, executor):
+        """
+        Shuts down an executor whose worker died, so the next task starts a new pool, unless another thread has
+        already replaced it.
+        """
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False)
+
+    def submit(self, function, *args):
+        """
+        Runs a function in one of the worker processes and returns a future for its result. A pool broken by an
+        earlier task is replaced before this one is submitted.
+        """
+        return self.submit_to_executor(function, *args)[1]
+
+    def submit_to_executor(self, function, *args):
+        """
+        Submits a function like submit, returning the executor it was submitted to along with its future.
+        """
+        executor = self.get_executor()
+        try:
+            return executor, executor.submit(function, *args)
+        except BrokenProcessPool:
+            self.replace_broken(executor)
+            executor = self.get_executor()
+            return executor, executor.submit(function, *args)
+
+    def warm_up(self):
+        """
+        Starts the worker processes and loads matplotlib in each of them.
+        """
+        executor = self.get_executor()
+        try:
+            return set(executor.map(warm_up_renderer, range(self.workers)))
+        except BrokenProcessPool:
+            self.replace_broken(executor)
+            raise
+
+    def render(self, patient_data):
+        """
+        Draws every chart for a patient in a worker process and waits for the image bytes.
+        """
+        executor, future = self.submit_to_executor(render_patient_charts, patient_data)
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            self.replace_broken(executor)
+            raise
+
+    def render_many(self, patients_data):
+        """
+        Draws the charts for a list of patients, spread across the worker processes.
+        :return: list of chart dictionaries in the same order as the patients given
+        """
+        executor = self.get_executor()
+        try:
+            return list(executor.map(render_patient_charts, patients_data))
+        except BrokenProcessPool:
+            self.replace_broken(executor)
+            raise
@@ -0,0 +1,43 @@
+import json
+import os
+
+# environment variable holding the path of the config file, and the prefix of variables overriding single settings
+CONFIG_PATH_VARIABLE = 'PATIENT_DOCUMENT_API_CONFIG'
+CONFIG_VARIABLE_PREFIX = 'PATIENT_DOCUMENT_API_'
+
+# the config of this process, loaded the first time it is asked for
+_config = None
+
+
+def load_config(path=None):
+    """
+    Loads the API settings from the config file and applies any overrides from the environment. The file is the one
+    named by PATIENT_DOCUMENT_API_CONFIG, or config.json next to this module, rather than whichever config.json is in
+    the current directory. Any other variable starting PATIENT_DOCUMENT_API_ overrides the setting of the same name in
+    lower case, for example PATIENT_DOCUMENT_API_FHIR_ENDPOINT. Values are read as JSON where possible, so numbers and
+    true or false keep their type, and as plain strings otherwise.
+    """
+    if path is None:
+        path = os.environ.get(CONFIG_PATH_VARIABLE,
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json'))
+    with open(path) as config_file:
+        data = json.load(config_file)
+
+    for name, value in os.environ.items():
+        if name.startswith(CONFIG_VARIABLE_PREFIX) and name != CONFIG_PATH_VARIABLE:
+            try:
+                data[name[len(CONFIG_VARIABLE_PREFIX):].lower()] = json.loads(value)
+            except ValueError:
+                data[name[len(CONFIG_VARIABLE_PREFIX):].lower()] = value
+    return data
+
+
+def get_config():
+    """
+    Returns the settings of this process, loading them the first time they are asked for. Server worker processes
+    are forked after the settings are loaded, so every worker shares the same copy.
+    """
+    global _config
+    if _config is None:
+        _config = load_config()
+    return _config
@@ -1,23 +1,26 @@
 def get_patient_name_data(patient_data):
-    prefix = patient_data["name"]["prefix"]
-    first_name = patient_data["name"]["first_name"]
-    last_name = patient_data["name"]["last_name"]
-    return prefix, first_name, last_name
+    name = patient_data.name
+    return name.prefix, name.first_name, name.last_name
 
 
 def get_patient_address_data(patient_data):
-    address_lines = patient_data["address"]["address_lines"]
-    city = patient_data["address"]["city"]
-    state = patient_data["address"]["state"]
-    postcode = patient_data["address"]["postcode"]
-    country = patient_data["address"]["country"]
-    return address_lines, city, state, postcode, country
+    address = patient_data.address
+    return address.address_lines, address.city, address.state, address.postcode, address.country
 
 
 def get_feedback_text(patient_data):
-    intro = patient_data["questions_and_messages"]["intro"]
-    recommendation = patient_data["questions_and_messages"]["recommendation"]
-    comment = patient_data["questions_and_messages"]["comment"]
-    hospital = patient_data["questions_and_messages"]["hospital"]
-    clinic = patient_data["questions_and_messages"]["clinic"]
-    return intro, recommendation, comment, hospital, clinic
+    text = patient_data.questions_and_messages
+    return text.intro, text.recommendation, text.comment, text.hospital, text.clinic
+
+
+def patient_info_values(patient):
+    """
+    Extracts the values filled into the patient details template from a patient.
+    """
+    return {"full_name": patient.full_name(), "uuid": patient.uuid, "given": patient.name.given,
+            "family": patient.name.family, "prefix": patient.name.prefix, "gender": patient.gender,
+            "birth_date": str(patient.birth_date), "address_line": patient.addresses[0].lines[0],
+            "city": patient.addresses[0].city, "state": patient.addresses[0].state,
+            "postal_code": patient.addresses[0].postal_code, "country": patient.addresses[0].country,
+            "marital_status": str(patient.marital_status), "language": patient.communications.languages[0],
+            "identifier_DL": patient.get_identifier('DL'), "identifier_SS": patient.get_identifier('SS')}
@@ -0,0 +1,52 @@
+from VitalSeries import as_series
+from ChartRenderer import chart_settings
+import hashlib
+import json
+
+# bumped whenever the layout of a generated document changes, so documents made by older code are regenerated
+DOCUMENT_VERSION = 1
+
+# name of the blob metadata entry holding the fingerprint of the inputs a document was generated from
+FINGERPRINT_KEY = 'fingerprint'
+
+
+def fingerprint(kind, *parts):
+    """
+    Returns a SHA-256 hex digest of everything a document is generated from.
+    :param kind: name of the type of document, so different documents for the same patient never share a fingerprint
+    :param parts: JSON serialisable inputs of the document
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps([kind, DOCUMENT_VERSION], separators=(',', ':')).encode('utf-8'))
+    for part in parts:
+        digest.update(json.dumps(part, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def feedback_fingerprint(patient_id, feedback_data):
+    """
+    Returns the fingerprint of a feedback form, made from the FeedbackData returned by generate_feedback_data.
+    """
+    return fingerprint('feedback', patient_id, feedback_data.to_json())
+
+
+def health_fingerprint(patient_id, name, patient_data):
+    """
+    Returns the fingerprint of a health report. The date and value arrays of each vital sign are hashed directly
+    rather than being converted to JSON first. The chart settings are included so reports are drawn again when they
+    change.
+    """
+    digest = hashlib.sha256(fingerprint('health', patient_id, name, chart_settings()).encode('ascii'))
+    for vital_sign, entry in patient_data.items():
+        series = as_series(entry)
+        digest.update(json.dumps([vital_sign, series.unit, len(series)]).encode('utf-8'))
+        digest.update(series.dates.tobytes())
+        digest.update(series.values.tobytes())
+    return digest.hexdigest()
+
+
+def patient_info_fingerprint(patient_info):
+    """
+    Returns the fingerprint of a patient details form, made from the patient fields shown on it.
+    """
+    return fingerprint('patient_info', patient_info)
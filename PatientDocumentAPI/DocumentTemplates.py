@@ -0,0 +1,267 @@
+from GenerateDocuments import FeedbackForm, PatientHealthForm, PatientDataForm
+from DataRetrieval import *
+from PatientRecords import FeedbackData, PatientName, PatientAddress
+from ChartRenderer import get_renderer, render_patient_charts
+from xml.sax.saxutils import escape
+from types import SimpleNamespace
+from io import BytesIO
+import threading
+import zipfile
+import re
+
+# splits the main document part into static xml and the names of the placeholders between them
+PLACEHOLDER = re.compile(r'\{\{(\w+)\}\}')
+LINE_BREAK = '</w:t><w:br/><w:t xml:space="preserve">'
+
+# templates are built the first time they are needed and kept for the life of the process
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def placeholder(name):
+    """
+    Returns the token written into a template where the value called name is filled in for each patient.
+    """
+    return '{{' + name + '}}'
+
+
+class DocumentTemplate():
+    """
+    A word document built once with placeholders in place of the details of a patient. The static parts of the
+    document are kept compressed in a zip archive, so filling in a patient only rewrites the main document part and
+    any chart images instead of building the whole document again.
+    """
+
+    def __init__(self, doc, images=None):
+        """
+        :param doc: python-docx Document containing placeholder tokens
+        :param images: dictionary mapping a name to the picture in doc that is swapped out for each patient
+        """
+        images = images or {}
+        self.image_parts = {name: doc.part.related_parts[self.image_rid(shape)].partname.membername
+                            for name, shape in images.items()}
+
+        source = BytesIO()
+        doc.save(source)
+        static = BytesIO()
+        with zipfile.ZipFile(source) as original, zipfile.ZipFile(static, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for info in original.infolist():
+                if info.filename == 'word/document.xml':
+                    self.chunks = PLACEHOLDER.split(original.read(info).decode('utf-8'))
+                elif info.filename not in self.image_parts.values():
+                    archive.writestr(info, original.read(info))
+        self.static = static.getvalue()
+        # the xml before and after the content of the body, which ends with the properties of the last section
+        self.head = self.chunks[0][:self.chunks[0].index('<w:body>') + len('<w:body>')]
+        self.tail = self.chunks[-1][self.chunks[-1].rindex('<w:sectPr'):]
+
+    @staticmethod
+    def image_rid(shape):
+        """
+        Returns the relationship ID linking an inline picture to its image part.
+        """
+        return shape._inline.graphic.graphicData.pic.blipFill.blip.embed
+
+    def fill(self, values):
+        """
+        Fills in the placeholders for a single patient and returns the xml of the main document part.
+        :param values: dictionary mapping each placeholder name to its text, or to a list of lines which are
+        separated by line breaks
+        """
+        parts = []
+        for index, chunk in enumerate(self.chunks):
+            if index % 2 == 0:
+                parts.append(chunk)
+            elif isinstance(values[chunk], (list, tuple)):
+                parts.append(LINE_BREAK.join(escape(str(line)) for line in values[chunk]))
+            else:
+                parts.append(escape(str(values[chunk])))
+        return ''.join(parts)
+
+    def body(self, values):
+        """
+        Fills in the placeholders for a single patient and returns only the content of the document body, without
+        the properties of its last section, ready to be merged with the bodies of other documents.
+        """
+        return self.fill(values)[len(self.head):-len(self.tail)]
+
+    def render(self, values, images=None):
+        """
+        Fills in the placeholders for a single patient and returns the finished document.
+        :param values: dictionary mapping each placeholder name to its text, or to a list of lines which are
+        separated by line breaks
+        :param images: dictionary mapping each image name to the bytes of the picture to use
+        :return: bytes of the .docx file
+        """
+        memfile = BytesIO(self.static)
+        with zipfile.ZipFile(memfile, 'a', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('word/document.xml', self.fill(values))
+            for name, member in self.image_parts.items():
+                archive.writestr(member, images[name], zipfile.ZIP_STORED)
+        return memfile.getvalue()
+
+
+def get_template(key, build):
+    """
+    Returns the cached template for key, building it with the build function the first time it is asked for.
+    """
+    with _templates_lock:
+        template = _templates.get(key)
+        if template is None:
+            template = build()
+            _templates[key] = template
+        return template
+
+
+def feedback_values(feedback_data):
+    """
+    Extracts the values filled into the feedback form template from the feedback data of a patient.
+    """
+    prefix, first_name, last_name = get_patient_name_data(feedback_data)
+    address_lines, city, state, postcode, country = get_patient_address_data(feedback_data)
+    return {"prefix": prefix, "first_name": first_name, "last_name": last_name, "address_lines": address_lines,
+            "city": city, "state": state, "postcode": postcode, "country": country}
+
+
+def build_feedback_template(feedback_data):
+    """
+    Builds the feedback form template using the questions from feedback_data and placeholders for everything else.
+    """
+    template_data = FeedbackData(PatientName(placeholder("prefix"), placeholder("first_name"),
+                                             placeholder("last_name")),
+                                 PatientAddress([placeholder("address_lines")], placeholder("city"),
+                                                placeholder("state"), placeholder("postcode"), placeholder("country")),
+                                 feedback_data.questions_and_messages)
+    form = FeedbackForm(placeholder("patient_id"), template_data)
+    form.build_feedback_form()
+    return DocumentTemplate(form.doc)
+
+
+def build_patient_info_template():
+    """
+    Builds the patient details template from a stand-in patient whose details are all placeholders.
+    """
+    address = SimpleNamespace(lines=[placeholder("address_line")], city=placeholder("city"),
+                              state=placeholder("state"), postal_code=placeholder("postal_code"),
+                              country=placeholder("country"))
+    patient = SimpleNamespace(uuid=placeholder("uuid"),
+                              full_name=lambda: placeholder("full_name"),
+                              name=SimpleNamespace(given=placeholder("given"), family=placeholder("family"),
+                                                   prefix=placeholder("prefix")),
+                              gender=placeholder("gender"),
+                              birth_date=placeholder("birth_date"),
+                              addresses=[address],
+                              marital_status=placeholder("marital_status"),
+                              communications=SimpleNamespace(languages=[placeholder("language")]),
+                              get_identifier=lambda code: placeholder("identifier_" + code))
+    form = PatientDataForm(patient)
+    form.build_patient_info_form()
+    return DocumentTemplate(form.doc)
+
+
+def build_health_template(vital_signs):
+    """
+    Builds the health data template with a placeholder chart for each vital sign. The placeholder charts are drawn
+    by the same renderer as the real ones so the pictures keep the same size when they are swapped.
+    """
+    renderer = get_renderer()
+    charts = {vital_sign: renderer.render(vital_sign, [], [], '') for vital_sign in vital_signs}
+    form = PatientHealthForm(placeholder("patient_id"), placeholder("name"),
+                             {vital_sign: None for vital_sign in vital_signs}, charts)
+    form.build_patient_data_form()
+    return DocumentTemplate(form.doc, dict(zip(vital_signs, form.doc.inline_shapes)))
+
+
+class TemplateFeedbackForm(FeedbackForm):
+    """
+    Feedback form filled in from a cached template rather than built from scratch for each patient.
+    """
+
+    def __init__(self, patient_id, feedback_data):
+        self.patient_id = patient_id
+        self.feedback_data = feedback_data
+
+    def template(self):
+        """
+        Returns the cached template for the questions asked on this feedback form.
+        """
+        return get_template(("feedback", self.feedback_data.questions_and_messages),
+                            lambda: build_feedback_template(self.feedback_data))
+
+    def render(self):
+        """
+        Returns the bytes of the finished feedback form.
+        """
+        return self.template().render(feedback_values(self.feedback_data))
+
+    def body(self):
+        """
+        Returns the template of the feedback form and the xml of its body, for merging into a print file.
+        """
+        template = self.template()
+        return template, template.body(feedback_values(self.feedback_data))
+
+    def generate_feedback_form(self):
+        """
+        Creates the Word document asking the patient for feedback.
+        :return: BytesIO holding the .docx file
+        """
+        return BytesIO(self.render())
+
+
+class TemplatePatientHealthForm(PatientHealthForm):
+    """
+    Health data document filled in from a cached template rather than built from scratch for each patient.
+    """
+
+    def __init__(self, patient_id, name, patient_data, charts=None):
+        self.patient_id = patient_id
+        self.name = name
+        self.patient_data = patient_data
+        self.charts = charts
+
+    def render(self):
+        """
+        Returns the bytes of the finished health data document.
+        """
+        vital_signs = tuple(self.patient_data.keys())
+        template = get_template(("health", vital_signs), lambda: build_health_template(vital_signs))
+        charts = self.charts if self.charts is not None else render_patient_charts(self.patient_data)
+        return template.render({"patient_id": self.patient_id, "name": self.name}, charts)
+
+    def generate_patient_data_form(self):
+        """
+        Creates a word document containing visualisations of patient health data.
+        :return: BytesIO holding the .docx file
+        """
+        return BytesIO(self.render())
+
+
+class TemplatePatientDataForm(PatientDataForm):
+    """
+    Patient details document filled in from a cached template rather than built from scratch for each patient.
+    """
+
+    def __init__(self, patient):
+        self.patient = patient
+
+    def render(self):
+        """
+        Returns the bytes of the finished patient details document.
+        """
+        template = get_template(("details",), build_patient_info_template)
+        return template.render(patient_info_values(self.patient))
+
+    def body(self):
+        """
+        Returns the template of the patient details document and the xml of its body, for merging into a print file.
+        """
+        template = get_template(("details",), build_patient_info_template)
+        return template, template.body(patient_info_values(self.patient))
+
+    def generate_patient_info_form(self):
+        """
+        Creates a word document with all of the patients personal information and asks them to check the details.
+        :return: BytesIO holding the .docx file
+        """
+        return BytesIO(self.render())
@@ -1,76 +1,656 @@
 from azure.common import AzureMissingResourceHttpError
-from flask import Flask, abort, make_response, jsonify
-from flask_restful import Api, Resource, reqparse
+from flask import Flask, Response, abort, make_response, jsonify, request, g, copy_current_request_context, redirect
+from flask_restful import Api, Resource, reqparse, inputs
 from fhir_parser.fhir import FHIR
-from GenerateDocuments import FeedbackForm, PatientHealthForm, PatientDataForm
-from AzureBlobStorage import *
+from BlobStore import BlobConditionFailed, create_blob_store
+from BatchJobs import BatchJobManager
+from PatientCache import CachingFHIR
+from ChartRenderer import ChartRenderPool, configure_charts
+from VitalSeries import VitalSignSeries
+from collections import OrderedDict
+from functools import partial
+from dateutil.parser import isoparse
+from datetime import timezone, timedelta
+from DataRetrieval import patient_info_values
+from PatientRecords import FeedbackData, FeedbackText, PatientAddress, PatientName
+from HealthHistory import HealthHistoryStore
+from Config import get_config
+from Metrics import metrics, span, start_request_timer, record_request
+from Profiler import SamplingProfiler
+from JobQueue import JobQueue, PRIORITIES
+from Sharding import FORWARDED_HEADER, HashRing, PeerClient, ShardedBatch
+from MergedDocuments import MergedDocumentWriter, convert_to_pdf
+from concurrent.futures import ThreadPoolExecutor
+from DocumentFingerprint import FINGERPRINT_KEY, feedback_fingerprint, health_fingerprint, patient_info_fingerprint, \
+    fingerprint
+from ResponseEncoding import MSGPACK_MIMETYPE, compress_response, msgpack, pack
 import os
 import json
+import atexit
+import hashlib
+import tempfile
+import threading
+import urllib.parse
+import time
 
 app = Flask(__name__)
 api = Api(app)
 
+vital_signs = ['Body Weight', 'Heart rate', 'Respiratory rate', 'Body Mass Index', 'Diastolic Blood Pressure',
+               'Systolic Blood Pressure']
+
+# the questions and messages on every feedback form, sent to clients once and afterwards referred to by version
+FEEDBACK_QUESTIONS = {"intro": "We welcome all feedback on the services we provide to tell us what we are doing right "
+                               "and where we can improve.",
+                      "recommendation": "Based on your recent experience of our services, how likely are you to "
+                                        "recommend us to friends or family if they needed similar care or treatment?",
+                      "comment": "With regards to your response to the previous question, what is the main reason "
+                                 "you feel this way?",
+                      "hospital": "What is the name of the hospital where you received treatment?",
+                      "clinic": "What is the name of the clinic/department where you were treated?",
+                      }
+FEEDBACK_QUESTIONS_VERSION = fingerprint('feedback_questions', FEEDBACK_QUESTIONS)[:16]
+FEEDBACK_TEXT = FeedbackText.from_json(FEEDBACK_QUESTIONS)
+
+# endpoints answering for a single patient, which in sharding mode send requests on to the node owning the patient
+PATIENT_ENDPOINTS = ('feedback', 'feedbackDocumentData', 'report', 'reportData', 'patientInfo', 'pack')
+
+# documents that can be asked for in a pack, and the name each is known by in the job queue and blob store
+PACK_DOCUMENTS = OrderedDict([('feedback', 'feedback'), ('health', 'health'), ('info', 'details')])
+
 
 def get_address(patient):
     """
-    Creates and returns a dictionary containing details of a patients address
+    Creates and returns a PatientAddress record containing details of a patients address
     """
-    address = {"address_lines": patient.addresses[0].lines, "city": patient.addresses[0].city,
-               "state": patient.addresses[0].state, "postcode": patient.addresses[0].postal_code,
-               "country": patient.addresses[0].country}
-    return address
+    return PatientAddress.from_patient(patient)
 
 
 def get_name(patient):
     """
-    Creates and returns a dictionary containing details of a patients address
+    Creates and returns a PatientName record containing the name of a patient
     """
-    name = {"prefix": patient.name.prefix, "first_name": patient.name.given,
-            "last_name": patient.name.family}
-    return name
+    return PatientName.from_patient(patient)
 
 
 def generate_feedback_data(patient):
     """
-    Creates a dictionary that stores all the data used to create a document asking for patient feedback including
-    name, address and questions to be asked.
+    Creates a FeedbackData record that stores all the data used to create a document asking for patient feedback
+    including name, address and questions to be asked. Every patient shares the same FeedbackText of questions.
     """
     address = get_address(patient)
 
     name = get_name(patient)
 
-    questions_and_messages = {"intro": "We welcome all feedback on the services we provide to tell us what we are "
-                                       "doing right and where we can improve.",
-                              "recommendation": "Based on your recent experience of our services, how likely are "
-                                                "you to recommend us to friends or family if they needed similar "
-                                                "care or treatment?",
-                              "comment": "With regards to your response to the previous question, what is the "
-                                         "main reason you feel this way?",
-                              "hospital": "What is the name of the hospital where you received treatment?",
-                              "clinic": "What is the name of the clinic/department where you were treated?",
-                              }
-
-    return {"name": name, "address": address, "questions_and_messages": questions_and_messages}
+    return FeedbackData(name, address, FEEDBACK_TEXT)
 
 
-def get_patient_data(observations, vital_sign):
+def extract_vital_signs(observations, signs, since=None, until=None):
     """
-    Creates a list of dates and values for observations made on Weight, BMI, Heart rate and Respiratory rate as well
-    as noting the unit used to measure them.
+    Creates a list of dates and values for each of the given vital signs, as well as noting the unit used to measure
+    them, in a single pass over the observations.
+    :param observations: list of observations made on a patient
+    :param signs: list of vital signs to extract, each given either as the display name or the code of the
+    observation component, for example 'Heart rate' or '8867-4'
+    :param since: if given, observations issued before this timezone aware datetime are skipped
+    :param until: if given, observations issued after this timezone aware datetime are skipped
+    :return: dictionary mapping each of the given signs to a tuple of its dates, values and unit. Values held as
+    numeric text are converted to numbers and readings that are not numbers are skipped.
     """
-    date = []
-    value = []
-    unit = ""
+    dates = {sign: [] for sign in signs}
+    values = {sign: [] for sign in signs}
+    units = {sign: "" for sign in signs}
     for observation in observations:
         if observation.type != "vital-signs":
             continue
+        if since is not None and observation.issued_datetime < since:
+            continue
+        if until is not None and observation.issued_datetime > until:
+            continue
         for component in observation.components:
-            if component.display == vital_sign:
-                date.append(observation.issued_datetime)
-                value.append(component.value)
-                unit = component.unit
+            if component.display in units:
+                sign = component.display
+            elif component.code in units:
+                sign = component.code
+            else:
+                continue
+            value = component.value
+            if value is not None and not isinstance(value, (int, float)):
+                # readings held as text are charted when they are numbers, and left out when they are not
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    continue
+            dates[sign].append(observation.issued_datetime)
+            values[sign].append(value)
+            units[sign] = component.unit
+
+    return {sign: (dates[sign], values[sign], units[sign]) for sign in signs}
+
+
+def get_patient_data(observations, vital_sign):
+    """
+    Creates a list of dates and values for observations made on Weight, BMI, Heart rate and Respiratory rate as well
+    as noting the unit used to measure them.
+    """
+    return extract_vital_signs(observations, [vital_sign])[vital_sign]
+
+
+def get_health_data(observations):
+    """
+    Creates a dictionary holding the series of dates and values of every vital sign shown in a patient health report.
+    """
+    patient_data = OrderedDict()
+    for vital_sign, (dates, values, unit) in extract_vital_signs(observations, vital_signs).items():
+        patient_data[vital_sign] = VitalSignSeries.from_lists(dates, values, unit)
+    return patient_data
+
+
+def update_health_data(patient_id, observations):
+    """
+    Brings the stored health data of a patient up to date and returns it. Only observations issued after the
+    patient's high-water mark are extracted and appended to the stored series, so nothing is extracted or written
+    when no new readings have arrived. Observations back-dated to before the high-water mark are not picked up until
+    the patient's stored history is cleared through the cache endpoint.
+    """
+    high_water_mark, patient_data = health_history.load(patient_id, vital_signs)
+    since = None if high_water_mark is None else high_water_mark + timedelta(milliseconds=1)
+    newest = max((observation.issued_datetime for observation in observations
+                  if observation.type == "vital-signs" and (since is None or observation.issued_datetime >= since)),
+                 default=None)
+    if newest is None:
+        return patient_data if patient_data is not None else get_health_data(observations)
+
+    new_data = extract_vital_signs(observations, vital_signs, since)
+    if patient_data is None:
+        patient_data = OrderedDict((vital_sign, VitalSignSeries.from_lists(dates, values, unit))
+                                   for vital_sign, (dates, values, unit) in new_data.items())
+    else:
+        for vital_sign, (dates, values, unit) in new_data.items():
+            patient_data[vital_sign] = patient_data[vital_sign].extend(VitalSignSeries.from_lists(dates, values, unit))
+    health_history.save(patient_id, newest, patient_data)
+    return patient_data
+
+
+def load_health_data(patient_id, observations):
+    """
+    Returns the health data shown in a patient's health report, updated incrementally from the stored history when
+    incremental health reports are turned on and extracted from every observation otherwise.
+    """
+    if health_history is not None:
+        return update_health_data(patient_id, observations)
+    return get_health_data(observations)
+
+
+def health_data_to_json(patient_data):
+    """
+    Creates the dictionary of dates, values and unit for each vital sign returned by the health data endpoints.
+    """
+    return {vital_sign: series.to_json() for vital_sign, series in patient_data.items()}
+
+
+def parse_utc_datetime(text):
+    """
+    Parses an ISO 8601 date or datetime, taking it to be UTC if it has no timezone. Returns None if text is None.
+    """
+    if text is None:
+        return None
+    date = isoparse(text)
+    return date if date.tzinfo is not None else date.replace(tzinfo=timezone.utc)
+
+
+def response_format(requested=None):
+    """
+    Returns the format to answer a data request in, json or msgpack, taken from the format argument if given and
+    otherwise from the Accept header. Raises ValueError if msgpack is asked for but is not installed.
+    """
+    if requested is None:
+        best = request.accept_mimetypes.best_match(['application/json', MSGPACK_MIMETYPE])
+        requested = 'msgpack' if best == MSGPACK_MIMETYPE else 'json'
+    if requested == 'msgpack' and msgpack is None:
+        raise ValueError('msgpack is not installed on the server')
+    return requested
+
+
+def make_data_response(payload, data_format, status=200):
+    """
+    Creates a response holding a payload in the format chosen by response_format.
+    """
+    if data_format == 'msgpack':
+        with span('serialise'):
+            return Response(pack(payload), status, mimetype=MSGPACK_MIMETYPE)
+    with span('serialise'):
+        return make_response(jsonify(payload), status)
+
+
+def stream_json_object(items):
+    """
+    Yields a JSON object in chunks, one key and value at a time, from an iterable of key and value pairs.
+    """
+    yield '{'
+    for index, (key, value) in enumerate(items):
+        yield (', ' if index else '') + json.dumps(key) + ': ' + json.dumps(value)
+    yield '}'
+
+
+def fetch_health_data(patient_id):
+    """
+    Fetches a patient and their observations from FHIR and returns the patient's name and health data. Used as the
+    first stage of a batch of health reports. Observations are fetched past the cache so a large batch does not
+    evict the patients being used by interactive requests.
+    """
+    with span('fhir', 'batch'):
+        patient = fhir_client.get_patient(patient_id)
+        observations = fhir_client.fhir.get_patient_observations(patient_id)
+    with span('extract', 'batch'):
+        return patient.full_name(), load_health_data(patient_id, observations)
+
+
+def upload_health_report(blob_name, document, metadata):
+    """
+    Stores a finished health report on Azure straight from memory, unless another node has stored the same report
+    while it was being rendered. Used as the last stage of a batch of health reports.
+    :param metadata: metadata made by health_report_metadata, holding the fingerprint of the report's inputs
+    """
+    with span('upload', 'batch'):
+        etag, digest = stored_document(health_data_container_name, blob_name)
+        if digest != metadata[FINGERPRINT_KEY]:
+            store_document(health_data_container_name, blob_name, document, metadata[FINGERPRINT_KEY], etag)
+
+
+def stored_document(container_name, blob_name):
+    """
+    Returns the ETag of a stored document and the fingerprint of the inputs it was generated from, using only the
+    blob's properties so the document itself is never downloaded. Both are None if the document is not stored.
+    """
+    etag, metadata = blob_store.get_properties(container_name, blob_name)
+    return etag, (metadata or {}).get(FINGERPRINT_KEY)
+
+
+def store_document(container_name, blob_name, document, digest, etag):
+    """
+    Uploads a document generated from inputs with the given fingerprint, only if the stored blob is still the version
+    it was checked against, so nodes making the same document at the same time never overwrite each other unnoticed.
+    When the upload is refused and the blob now holds a document made from the same inputs, the work has already been
+    done. Otherwise the upload is tried again against the new version, up to blob_write_attempts times.
+    :param document: bytes or a readable stream holding the document
+    :param etag: ETag of the stored document when it was checked, or None if it did not exist
+    :return: 'regenerated', or 'hit' if another node stored the same document first
+    """
+    for _ in range(blob_write_attempts):
+        condition = {'if_match': etag} if etag is not None else {'if_none_match': '*'}
+        try:
+            if isinstance(document, bytes):
+                blob_store.upload_bytes(container_name, blob_name, document, {FINGERPRINT_KEY: digest}, **condition)
+            else:
+                document.seek(0)
+                blob_store.upload_stream(container_name, blob_name, document, {FINGERPRINT_KEY: digest},
+                                         **condition)
+            return 'regenerated'
+        except BlobConditionFailed:
+            etag, stored_digest = stored_document(container_name, blob_name)
+            if stored_digest == digest:
+                return 'hit'
+    raise BlobConditionFailed('{} kept being changed by another writer'.format(blob_name))
+
+
+def health_report_metadata(patient_id, name, patient_data):
+    """
+    Returns the metadata to store with a patient's health report, or None if the stored report was generated from
+    the same data. Used by batches of health reports to skip unchanged patients.
+    """
+    digest = health_fingerprint(patient_id, name, patient_data)
+    if stored_document(health_data_container_name, patient_id + " health data.docx")[1] == digest:
+        return None
+    return {FINGERPRINT_KEY: digest}
+
+
+def with_document_status(response, status):
+    """
+    Adds a header to a response saying whether the stored document was already up to date, 'hit', or was
+    'regenerated'.
+    """
+    response.headers['X-Document-Cache'] = status
+    return response
+
+
+def matches_cohort(patient, cohort):
+    """
+    Checks whether a patient matches every criterion of a cohort filter. Supported criteria are gender, city, state,
+    country, min_age and max_age.
+    """
+    address = patient.addresses[0] if patient.addresses else None
+    for field in ('city', 'state', 'country'):
+        if field in cohort and (address is None or getattr(address, field) != cohort[field]):
+            return False
+    if 'gender' in cohort and patient.gender != cohort['gender']:
+        return False
+    if 'min_age' in cohort and patient.age() < float(cohort['min_age']):
+        return False
+    if 'max_age' in cohort and patient.age() > float(cohort['max_age']):
+        return False
+    return True
+
+
+def document_location(document, patient_id):
+    """
+    Returns the container and blob name a patient's feedback, health or details document is stored under.
+    """
+    if document == 'feedback':
+        return feedback_container_name, patient_id + " feedback request.docx"
+    if document == 'health':
+        return health_data_container_name, patient_id + " health data.docx"
+    return patient_info_container_name, patient_id + " details.docx"
+
 
-    return date, value, unit
+def document_class(document, use_templates=None):
+    """
+    Returns the class feedback, health or details documents are made with. The document modules, and with them
+    python-docx and matplotlib, are imported the first time a document is made rather than when the API starts, so
+    workers that only serve the data endpoints never load them.
+    :param use_templates: whether to fill in a template rather than build the document from scratch, defaulting to
+    use_document_templates from the config
+    """
+    if use_document_templates if use_templates is None else use_templates:
+        from DocumentTemplates import TemplateFeedbackForm, TemplatePatientHealthForm, TemplatePatientDataForm
+        return {'feedback': TemplateFeedbackForm, 'health': TemplatePatientHealthForm,
+                'details': TemplatePatientDataForm}[document]
+    from GenerateDocuments import FeedbackForm, PatientHealthForm, PatientDataForm
+    return {'feedback': FeedbackForm, 'health': PatientHealthForm, 'details': PatientDataForm}[document]
+
+
+def create_feedback_document(patient_id, force=False, patient=None):
+    """
+    Creates the feedback form of a patient and stores it on Azure, unless the stored form was made from the same
+    details and force is not set. Raises ConnectionError if the patient does not exist.
+    :param patient: the patient if already fetched from FHIR
+    :return: 'hit' or 'regenerated', and the feedback data the form was made from
+    """
+    if patient is None:
+        with span('fhir'):
+            patient = fhir_client.get_patient(patient_id)
+
+    feedback_data = generate_feedback_data(patient)
+    blob_name = document_location('feedback', patient_id)[1]
+    with span('cache_check'):
+        digest = feedback_fingerprint(patient_id, feedback_data)
+        etag, stored_digest = stored_document(feedback_container_name, blob_name)
+    if not force and stored_digest == digest:
+        return 'hit', feedback_data
+
+    with span('document'):
+        feedback_form = document_class('feedback')(patient_id, feedback_data)
+        document = feedback_form.generate_feedback_form()
+
+    with span('upload'):
+        status = store_document(feedback_container_name, blob_name, document, digest, etag)
+    return status, feedback_data
+
+
+def create_health_document(patient_id, force=False, patient=None, observations=None):
+    """
+    Creates the health report of a patient and stores it on Azure, unless the stored report was made from the same
+    name and readings and force is not set. Raises ConnectionError if the patient does not exist.
+    :param patient: the patient if already fetched from FHIR, along with their observations
+    :return: 'hit' or 'regenerated', and the health data the report was made from
+    """
+    if patient is None or observations is None:
+        with span('fhir'):
+            patient, observations = fhir_client.get_patient_with_observations(patient_id)
+    with span('extract'):
+        patient_data = load_health_data(patient_id, observations)
+    blob_name = document_location('health', patient_id)[1]
+    with span('cache_check'):
+        digest = health_fingerprint(patient_id, patient.full_name(), patient_data)
+        etag, stored_digest = stored_document(health_data_container_name, blob_name)
+    if not force and stored_digest == digest:
+        return 'hit', patient_data
+
+    with span('charts'):
+        charts = chart_pool.render(patient_data)
+    with span('document'):
+        patient_data_document = document_class('health')(patient_id, patient.full_name(), patient_data, charts)
+        document = patient_data_document.generate_patient_data_form()
+
+    with span('upload'):
+        status = store_document(health_data_container_name, blob_name, document, digest, etag)
+    return status, patient_data
+
+
+def create_patient_info_document(patient_id, force=False, patient=None):
+    """
+    Creates the details form of a patient and stores it on Azure, unless the stored form was made from the same
+    details and force is not set. Raises ConnectionError if the patient does not exist.
+    :param patient: the patient if already fetched from FHIR
+    :return: 'hit' or 'regenerated'
+    """
+    if patient is None:
+        with span('fhir'):
+            patient = fhir_client.get_patient(patient_id)
+
+    blob_name = document_location('details', patient_id)[1]
+    with span('cache_check'):
+        digest = patient_info_fingerprint(patient_info_values(patient))
+        etag, stored_digest = stored_document(patient_info_container_name, blob_name)
+    if not force and stored_digest == digest:
+        return 'hit'
+
+    with span('document'):
+        patient_data_form = document_class('details')(patient)
+        document = patient_data_form.generate_patient_info_form()
+
+    with span('upload'):
+        return store_document(patient_info_container_name, blob_name, document, digest, etag)
+
+
+def run_document_job(document, patient_id, force):
+    """
+    Creates one document for the background job queue. A job for a patient who does not exist fails with the error
+    Patient Does Not Exist.
+    :return: dictionary saying whether the document was regenerated and where it is stored
+    """
+    try:
+        if document == 'feedback':
+            status = create_feedback_document(patient_id, force)[0]
+        elif document == 'health':
+            status = create_health_document(patient_id, force)[0]
+        else:
+            status = create_patient_info_document(patient_id, force)
+    except ConnectionError:
+        raise LookupError('Patient Does Not Exist')
+    container_name, blob_name = document_location(document, patient_id)
+    return {"document": status, "container": container_name, "blob": blob_name}
+
+
+def create_pack_document(document, patient_id, force, patient, observations):
+    """
+    Creates one document of a patient's pack from the patient and observations already fetched for the whole pack.
+    Runs on the pack pool inside a copy of the request context, so its stages are recorded under the pack endpoint.
+    :return: 'hit' or 'regenerated', and the time spent in each stage
+    """
+    if document == 'feedback':
+        status = create_feedback_document(patient_id, force, patient)[0]
+    elif document == 'health':
+        status = create_health_document(patient_id, force, patient, observations)[0]
+    else:
+        status = create_patient_info_document(patient_id, force, patient)
+    return status, g.get('timings', [])
+
+
+def fetch_patient_or_none(patient_id):
+    """
+    Fetches a patient from FHIR past the cache, returning None if the patient does not exist.
+    """
+    try:
+        return fhir_client.fhir.get_patient(patient_id)
+    except ConnectionError:
+        return None
+
+
+def iterate_patients(patient_ids, window=64):
+    """
+    Fetches many patients, several at a time, and yields each patient ID with its patient, or None if the patient does
+    not exist, in the order given. Only window patients are fetched ahead of the one being used.
+    """
+    with ThreadPoolExecutor(batch_fetch_workers) as pool:
+        for start in range(0, len(patient_ids), window):
+            batch = patient_ids[start:start + window]
+            for patient_id, patient in zip(batch, pool.map(fetch_patient_or_none, batch)):
+                yield patient_id, patient
+
+
+def create_print_file(blob_name, force=False, ids=(), documents=('feedback',), file_format='docx'):
+    """
+    Merges the chosen documents of every patient into a single print file, one section per document, and uploads it
+    to Azure as one blob. The file is written to a temporary folder a document at a time and uploaded from there in
+    blocks, so memory use does not grow with the number of patients. Patients who do not exist are left out.
+    :param documents: list of documents to include for each patient, feedback and details
+    :param file_format: docx, or pdf to convert the merged document with the local pdf_converter
+    :return: dictionary saying where the print file is stored, how many patients it holds and which were missing
+    """
+    missing = []
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'print.docx')
+        with span('document'):
+            with open(path, 'wb') as output, MergedDocumentWriter(output) as writer:
+                for patient_id, patient in iterate_patients(list(ids)):
+                    if patient is None:
+                        missing.append(patient_id)
+                        continue
+                    for document in documents:
+                        if document == 'feedback':
+                            form = document_class('feedback', True)(patient_id, generate_feedback_data(patient))
+                        else:
+                            form = document_class('details', True)(patient)
+                        writer.add(*form.body())
+        if file_format == 'pdf':
+            with span('convert'):
+                path = convert_to_pdf(path, pdf_converter)
+        with span('upload'):
+            blob_store.upload_file(print_container_name, blob_name, path)
+    return {"container": print_container_name, "blob": blob_name, "patients": len(ids) - len(missing),
+            "missing": missing}
+
+
+def bulk_import_folder(folder):
+    """
+    Returns the full path of a folder of NDJSON files inside bulk_import_root, or None if the folder would be outside
+    it, so requests can only ingest files the operator has put there.
+    """
+    root = os.path.realpath(bulk_import_root)
+    path = os.path.realpath(os.path.join(root, folder))
+    return path if path == root or path.startswith(root + os.sep) else None
+
+
+def run_bulk_import(source, force=False, folder=None, replace=False):
+    """
+    Ingests a FHIR bulk export into the bulk data store for the background job queue, from a folder of NDJSON files
+    or by running an export on bulk_export_endpoint. Cached patients and observations are cleared afterwards so this
+    process serves the new data straight away, while other worker processes serve it once their caches expire.
+    :param source: key naming the import in the job queue, the folder or 'export', followed by ' (replace)' for an
+    import replacing the store
+    :param replace: whether the import replaces everything in the store rather than being added to it. The old
+    contents are served until the import has been read completely, and kept if it fails.
+    :return: dictionary of the number of resources ingested and the number now in the store
+    """
+    with span('ingest', 'bulk'):
+        if folder is not None:
+            counts = bulk_store.ingest_folder(bulk_import_folder(folder), replace)
+        else:
+            counts = bulk_store.ingest_export(bulk_export_endpoint, timeout=bulk_export_timeout, replace=replace)
+    fhir_client.invalidate()
+    return {"ingested": counts, "store": bulk_store.stats()}
+
+
+def add_background_arguments(parser):
+    """
+    Adds the arguments used to run a generate endpoint as a background job to a request parser.
+    """
+    parser.add_argument('background', type=inputs.boolean, default=False)
+    parser.add_argument('priority', type=str, choices=tuple(PRIORITIES), default='interactive')
+    parser.add_argument('callback', type=str)
+
+
+def queue_document_job(document, args):
+    """
+    Queues a document for a patient on the background job queue and returns the 202 response pointing at its status.
+    """
+    job = job_queue.submit(document, args['id'], args['priority'], args['force'], args['callback'])
+    return make_response(jsonify(dict(job, status_url=api.url_for(JobStatus, job_id=job['job_id']))), 202)
+
+
+def shard_patients(patient_ids):
+    """
+    Splits patient IDs between the nodes owning them in sharding mode. Outside sharding mode, and for requests another
+    node has forwarded here, every patient is handled by this node.
+    :return: ordered dictionary mapping each node, shard_self for this one, to its list of patient IDs
+    """
+    if shard_ring is None or FORWARDED_HEADER in request.headers:
+        return OrderedDict([(shard_self, list(patient_ids))])
+    return shard_ring.partition(patient_ids)
+
+
+def peer_error(answer):
+    """
+    Returns why a node did not accept a forwarded request, from the ConnectionError raised sending it or the status
+    code and JSON body of its answer.
+    """
+    if isinstance(answer, ConnectionError):
+        return str(answer)
+    body = answer[1] if isinstance(answer[1], dict) else {}
+    return body.get('message', 'Status code: {}'.format(answer[0]))
+
+
+def submit_sharded_batch(parts):
+    """
+    Starts a batch of health reports on every node owning some of its patients, this one included, and returns the
+    sharded batch tracking the job of each node.
+    :param parts: ordered dictionary mapping each node to its list of patient IDs
+    """
+    shares = OrderedDict()
+    if shard_self in parts:
+        job = batch_manager.submit(parts[shard_self])
+        shares[shard_self] = {"job_id": job.job_id, "total": len(job.statuses)}
+    answers = peer_client.fan_out('POST', OrderedDict((node, ('/batch/healthReports', {'ids': ids}))
+                                                      for node, ids in parts.items() if node != shard_self))
+    for node, answer in answers.items():
+        if isinstance(answer, ConnectionError) or answer[0] != 202:
+            shares[node] = {"error": peer_error(answer), "patient_ids": parts[node]}
+        else:
+            shares[node] = {"job_id": answer[1]['job_id'], "total": answer[1]['total']}
+
+    batch = ShardedBatch(shares)
+    with sharded_batches_lock:
+        expire_sharded_batches()
+        sharded_batches[batch.job_id] = batch
+    return batch
+
+
+def expire_sharded_batches():
+    """
+    Removes sharded batches that finished more than batch_retention seconds ago, or whose progress nobody has asked
+    for in that time. Must be called holding sharded_batches_lock.
+    """
+    cutoff = time.time() - batch_retention
+    for job_id in [job_id for job_id, batch in sharded_batches.items() if (batch.finished or batch.checked) < cutoff]:
+        del sharded_batches[job_id]
+
+
+def sharded_batch_summary(batch, status_filter=None):
+    """
+    Asks every node of a sharded batch for the progress of its share and combines them into one summary.
+    """
+    query = '?' + urllib.parse.urlencode({'status': status_filter}) if status_filter else ''
+    answers = peer_client.fan_out('GET', OrderedDict((node, ('/batch/healthReports/' + part['job_id'] + query, None))
+                                                     for node, part in batch.parts.items()
+                                                     if node != shard_self and 'job_id' in part))
+    summaries = {node: answer if isinstance(answer, ConnectionError) else answer[1]
+                 for node, answer in answers.items()}
+    local = batch.parts.get(shard_self, {})
+    if 'job_id' in local:
+        job = batch_manager.get(local['job_id'])
+        summaries[shard_self] = job.summary(status_filter) if job is not None else {'message': 'Job Does Not Exist'}
+    return batch.summary(summaries, status_filter)
 
 
 class GenerateFeedbackReport(Resource):
@@ -81,32 +661,30 @@ class GenerateFeedbackReport(Resource):
     def __init__(self):
         self.reqparse = reqparse.RequestParser()
         self.reqparse.add_argument('id', type=str)
+        self.reqparse.add_argument('force', type=inputs.boolean, default=False)
+        add_background_arguments(self.reqparse)
         super(GenerateFeedbackReport, self).__init__()
 
     def get(self):
         """
         The GET request for this endpoint not only returns the data about the patient and the questions used to
         create a patient feedback form in JSON, but also creates a word document and stores it on an Azure account.
+        The document is only created again if the patient's details have changed since it was last stored, or force
+        is passed, and the X-Document-Cache header of the response says which happened. Passing background=true
+        queues the document instead and returns 202 with the job to poll.
         """
         args = self.reqparse.parse_args()
         if args['id'] is None:
             abort(400)
+        if args['background']:
+            return queue_document_job('feedback', args)
 
-        fhir_parser = FHIR('https://localhost:5001/api/', verify_ssl=False)
         try:
-            patient = fhir_parser.get_patient(args['id'])
+            status, feedback_data = create_feedback_document(args['id'], args['force'])
         except ConnectionError:
             return make_response(jsonify({'message': 'Patient Does Not Exist'}), 404)
 
-        feedback_data = generate_feedback_data(patient)
-
-        feedback_form = FeedbackForm(args['id'], feedback_data)
-        feedback_form.generate_feedback_form()
-
-        write_data_to_azure(args['id'] + " feedback request.docx", storage_account_name, storage_account_key, feedback_container_name)
-        os.remove(args['id'] + " feedback request.docx")
-
-        return make_response(generate_feedback_data(patient), 200)
+        return with_document_status(make_response(feedback_data.to_json(), 200), status)
 
 
 class GenerateFeedbackReportData(Resource):
@@ -117,30 +695,63 @@ class GenerateFeedbackReportData(Resource):
     def __init__(self):
         self.reqparse = reqparse.RequestParser()
         self.reqparse.add_argument('id', type=str)
+        self.reqparse.add_argument('format', type=str, choices=('json', 'msgpack'), location='args')
+        self.reqparse.add_argument('questions_version', type=str, location='args')
         super(GenerateFeedbackReportData, self).__init__()
 
     def get(self):
         """
         The GET request for this endpoint is JSON on data about the patient and the questions used to create
-        a patient feedback form without creating the document on an Azure account.
+        a patient feedback form without creating the document on an Azure account. The response includes the
+        version of the questions, and a client passing the version it already holds as questions_version is sent
+        the version alone instead of the text, which can also be fetched from /FormFiller/questions/<version>.
+        Passing format=msgpack, or accepting application/msgpack, returns the same data as MessagePack.
         """
         args = self.reqparse.parse_args()
         if args['id'] is None:
             abort(400)
+        try:
+            data_format = response_format(args['format'])
+        except ValueError as error:
+            return make_response(jsonify({'message': str(error)}), 406)
 
-        fhir_parser = FHIR('https://localhost:5001/api/', verify_ssl=False)
         try:
-            patient = fhir_parser.get_patient(args['id'])
+            with span('fhir'):
+                patient = fhir_client.get_patient(args['id'])
         except ConnectionError:
             return make_response(jsonify({'message': 'Patient Does Not Exist'}), 404)
 
-        return make_response(generate_feedback_data(patient), 200)
+        feedback_data = generate_feedback_data(patient).to_json()
+        feedback_data["questions_version"] = FEEDBACK_QUESTIONS_VERSION
+        if args['questions_version'] == FEEDBACK_QUESTIONS_VERSION:
+            del feedback_data["questions_and_messages"]
+        return make_data_response(feedback_data, data_format)
+
+
+class FeedbackQuestions(Resource):
+    """
+    Class used to look up the questions and messages asked on feedback forms by their version.
+    """
+
+    def get(self, version):
+        """
+        The GET request for this endpoint returns the questions and messages of a version as JSON. A version never
+        changes, so the response may be cached by clients for as long as they like.
+        """
+        if version != FEEDBACK_QUESTIONS_VERSION:
+            return make_response(jsonify({'message': 'Unknown questions version'}), 404)
+        response = make_response(jsonify({"questions_version": version,
+                                          "questions_and_messages": FEEDBACK_QUESTIONS}), 200)
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
 
 
 class GeneratePatientReport(Resource):
     def __init__(self):
         self.reqparse = reqparse.RequestParser()
         self.reqparse.add_argument('id', type=str)
+        self.reqparse.add_argument('force', type=inputs.boolean, default=False)
+        add_background_arguments(self.reqparse)
         super(GeneratePatientReport, self).__init__()
 
     def get(self):
@@ -148,35 +759,23 @@ class GeneratePatientReport(Resource):
         The GET response for this endpoint not only returns JSON containing information on the readings and dates of
         those readings for patient health data regarding weight, heart rate, BMI , diastolic blood pressure,
         systolic blood pressure and respiratory rate, but also creates a word document containing visualisations of
-        the data and saves it to an Azure storage account.
+        the data and saves it to an Azure storage account. The document is only created again if the patient's
+        name or readings have changed since it was last stored, or force is passed, and the X-Document-Cache header
+        of the response says which happened. Passing background=true queues the document instead and returns 202
+        with the job to poll.
         """
         args = self.reqparse.parse_args()
         if args['id'] is None:
             abort(400)
+        if args['background']:
+            return queue_document_job('health', args)
 
-        patient_data = {}
-
-        fhir_parser = FHIR('https://localhost:5001/api/', verify_ssl=False)
         try:
-            patient = fhir_parser.get_patient(args['id'])
+            status, patient_data = create_health_document(args['id'], args['force'])
         except ConnectionError:
             return make_response(jsonify({'message': 'Patient Does Not Exist'}), 404)
-        observations = fhir_parser.get_patient_observations(args['id'])
-        vital_signs = ['Body Weight', 'Heart rate', 'Respiratory rate', 'Body Mass Index', 'Diastolic Blood Pressure',
-                       'Systolic Blood Pressure']
 
-        for vital_sign in vital_signs:
-            value_dates, values, unit = get_patient_data(observations, vital_sign)
-            dates = [str(date) for date in value_dates]
-            patient_data[vital_sign] = {"Dates": dates, "Values": values, 'Unit': unit}
-
-        patient_data_document = PatientHealthForm(args['id'], patient.full_name(), patient_data)
-        patient_data_document.generate_patient_data_form()
-
-        write_data_to_azure(args['id'] + " health data.docx", storage_account_name, storage_account_key, health_data_container_name)
-        os.remove(args['id'] + " health data.docx")
-
-        return make_response(patient_data, 200)
+        return with_document_status(make_response(health_data_to_json(patient_data), 200), status)
 
 
 class GeneratePatientReportData(Resource):
@@ -188,34 +787,78 @@ class GeneratePatientReportData(Resource):
     def __init__(self):
         self.reqparse = reqparse.RequestParser()
         self.reqparse.add_argument('id', type=str)
+        self.reqparse.add_argument('resample', type=str)
+        self.reqparse.add_argument('max_points', type=int)
+        self.reqparse.add_argument('signs', type=str)
+        self.reqparse.add_argument('since', type=str)
+        self.reqparse.add_argument('until', type=str)
+        self.reqparse.add_argument('stream', type=str, choices=('ndjson', 'json'))
+        self.reqparse.add_argument('format', type=str, choices=('json', 'msgpack'), location='args')
         super(GeneratePatientReportData, self).__init__()
 
     def get(self):
         """
         The GET response for the endpoint is JSON containing information on the readings and dates of those readings
         for patient health data regarding weight, heart rate, BMI , diastolic blood pressure, systolic blood pressure
-        and respiratory rate.
+        and respiratory rate. Passing resample, for example D or W, returns the daily or weekly mean of the readings
+        instead, and passing max_points downsamples each vital sign to at most that many readings. signs limits the
+        response to a comma separated list of vital signs, and since and until to readings between two ISO 8601
+        dates. Passing stream=ndjson sends one line of JSON per vital sign and stream=json sends the usual JSON in
+        chunks. Observations are fetched and every vital sign extracted from them before anything is sent, so only
+        converting, resampling and serialising each vital sign happen as the response is streamed.
+        Passing format=msgpack, or accepting application/msgpack, returns MessagePack instead, with the Dates of each
+        vital sign packed as int64 milliseconds since the epoch and the Values as float64, both little-endian.
         """
         args = self.reqparse.parse_args()
         if args['id'] is None:
             abort(400)
+        try:
+            data_format = response_format(args['format'])
+        except ValueError as error:
+            return make_response(jsonify({'message': str(error)}), 406)
+        if data_format == 'msgpack' and args['stream'] is not None:
+            return make_response(jsonify({'message': 'stream is only available for JSON'}), 400)
+
+        signs = args['signs'].split(',') if args['signs'] else vital_signs
+        try:
+            since = parse_utc_datetime(args['since'])
+            until = parse_utc_datetime(args['until'])
+        except ValueError:
+            return make_response(jsonify({'message': 'since and until must be ISO 8601 dates'}), 400)
+        if args['resample'] is not None:
+            try:
+                VitalSignSeries([], [], '').resample(args['resample'])
+            except (TypeError, ValueError):
+                return make_response(jsonify({'message': 'Unknown resample frequency'}), 400)
 
-        fhir_parser = FHIR('https://localhost:5001/api/', verify_ssl=False)
         try:
-            observations = fhir_parser.get_patient_observations(args['id'])
+            with span('fhir'):
+                observations = fhir_client.get_patient_observations(args['id'])
         except ConnectionError:
             return make_response(jsonify({'message': 'Patient Does Not Exist'}), 404)
 
-        vital_signs = ['Body Weight', 'Heart rate', 'Respiratory rate', 'Body Mass Index', 'Diastolic Blood Pressure',
-                       'Systolic Blood Pressure']
-        patient_data = {}
+        with span('extract'):
+            extracted = extract_vital_signs(observations, signs, since, until)
+
+        def series_json(columns=False):
+            # each vital sign is converted and serialised only when it is about to be sent
+            for vital_sign, (dates, values, unit) in extracted.items():
+                series = VitalSignSeries.from_lists(dates, values, unit)
+                if args['resample'] is not None:
+                    series = series.resample(args['resample'])
+                if args['max_points'] is not None:
+                    series = series.lttb(args['max_points'])
+                yield vital_sign, series.to_columns() if columns else series.to_json()
 
-        for vital_sign in vital_signs:
-            dates, values, unit = get_patient_data(observations, vital_sign)
-            dates = [str(date) for date in dates]
-            patient_data[vital_sign] = {"Dates": dates, "Values": values, 'Unit': unit}
+        if data_format == 'msgpack':
+            return make_data_response(dict(series_json(columns=True)), data_format)
 
-        return make_response(patient_data, 200)
+        if args['stream'] == 'ndjson':
+            return Response((json.dumps(dict(series, Sign=vital_sign)) + '\n' for vital_sign, series in series_json()),
+                            mimetype='application/x-ndjson')
+        if args['stream'] == 'json':
+            return Response(stream_json_object(series_json()), mimetype='application/json')
+        return make_response(dict(series_json()), 200)
 
 
 class GeneratePatientInformation(Resource):
@@ -226,48 +869,611 @@ class GeneratePatientInformation(Resource):
     def __init__(self):
         self.reqparse = reqparse.RequestParser()
         self.reqparse.add_argument('id', type=str)
+        self.reqparse.add_argument('force', type=inputs.boolean, default=False)
+        add_background_arguments(self.reqparse)
         super(GeneratePatientInformation, self).__init__()
 
     def get(self):
         """
         The GET response for the endpoint is JSON containing a message as to whether or not the document was
-        successfully created and stored on Azure
+        successfully created and stored on Azure. The document is only created again if the patient's details have
+        changed since it was last stored, or force is passed, and the document field of the response says which
+        happened. Passing background=true queues the document instead and returns 202 with the job to poll.
         """
         args = self.reqparse.parse_args()
         if args['id'] is None:
             abort(400)
+        if args['background']:
+            return queue_document_job('details', args)
 
-        fhir_parser = FHIR('https://localhost:5001/api/', verify_ssl=False)
         try:
-            patient = fhir_parser.get_patient(args['id'])
+            status = create_patient_info_document(args['id'], args['force'])
         except ConnectionError:
             return make_response(jsonify({'message': 'Patient Does Not Exist'}), 404)
 
-        patient_data_form = PatientDataForm(patient)
-        patient_data_form.generate_patient_info_form()
+        if status == 'hit':
+            return with_document_status(make_response(jsonify({'message': 'Document is up to date',
+                                                               'document': 'hit'}), 200), 'hit')
+        return with_document_status(make_response(jsonify({'message': 'Document created successfully',
+                                                           'document': 'regenerated'}), 200), 'regenerated')
+
+
+class GeneratePatientPack(Resource):
+    """
+    Class used to create several documents for a patient in one request.
+    """
+
+    def __init__(self):
+        self.reqparse = reqparse.RequestParser()
+        self.reqparse.add_argument('id', type=str, location='args')
+        self.reqparse.add_argument('docs', type=str, default=','.join(PACK_DOCUMENTS), location='args')
+        self.reqparse.add_argument('force', type=inputs.boolean, default=False, location='args')
+        super(GeneratePatientPack, self).__init__()
+
+    def get(self):
+        """
+        The GET request for this endpoint creates the documents listed in docs, a comma separated list of feedback,
+        health and info, for a patient and stores each on Azure, as the separate endpoints for each document would.
+        The patient, and their observations if a health report is asked for, are fetched from FHIR once for the
+        whole pack, then the documents are made and uploaded at the same time on the pack pool. The response gives
+        the status of each document, where it is stored and the milliseconds spent in each stage, and is 500 if any
+        document failed.
+        """
+        args = self.reqparse.parse_args()
+        if args['id'] is None:
+            abort(400)
+        documents = [document.strip() for document in args['docs'].split(',') if document.strip()]
+        if not documents or any(document not in PACK_DOCUMENTS for document in documents):
+            return make_response(jsonify({'message': 'docs must list some of ' + ', '.join(PACK_DOCUMENTS)}), 400)
+        documents = list(OrderedDict.fromkeys(documents))
+        patient_id = args['id']
+
+        try:
+            with span('fhir'):
+                if 'health' in documents:
+                    patient, observations = fhir_client.get_patient_with_observations(patient_id)
+                else:
+                    patient, observations = fhir_client.get_patient(patient_id), None
+        except ConnectionError:
+            return make_response(jsonify({'message': 'Patient Does Not Exist'}), 404)
+
+        futures = OrderedDict((document, pack_pool.submit(copy_current_request_context(create_pack_document),
+                                                          PACK_DOCUMENTS[document], patient_id, args['force'],
+                                                          patient, observations))
+                              for document in documents)
+        results = OrderedDict()
+        for document, future in futures.items():
+            container_name, blob_name = document_location(PACK_DOCUMENTS[document], patient_id)
+            result = {"container": container_name, "blob": blob_name}
+            try:
+                status, timings = future.result()
+            except Exception as error:
+                result.update(status='failed', error=str(error) or type(error).__name__)
+            else:
+                result.update(status=status, timings_ms={stage: round(seconds * 1000, 3) for stage, seconds in timings})
+                # the stages of every document are sent back in the Server-Timing header as well
+                g.setdefault('timings', []).extend((document + '.' + stage, seconds) for stage, seconds in timings)
+            results[document] = result
+
+        failed = any(result['status'] == 'failed' for result in results.values())
+        return make_response(jsonify({'id': patient_id, 'documents': results}), 500 if failed else 200)
+
+
+class BatchHealthReports(Resource):
+    """
+    Class used to start generating health data documents for a whole list of patients in one job.
+    """
+
+    def __init__(self):
+        self.reqparse = reqparse.RequestParser()
+        self.reqparse.add_argument('ids', type=str, action='append', location='json')
+        self.reqparse.add_argument('cohort', type=dict, location='json')
+        super(BatchHealthReports, self).__init__()
+
+    def post(self):
+        """
+        The POST request for this endpoint takes either a list of patient IDs or a cohort filter as JSON and starts a
+        batch job creating a health data document for each patient. The response contains the ID of the job which can
+        be used to poll its progress. In sharding mode the patients are split between the nodes owning them and each
+        node runs a batch job for its share, listed under nodes, while the returned job tracks them all.
+        """
+        args = self.reqparse.parse_args()
+        if args['ids'] is None and args['cohort'] is None:
+            abort(400)
+
+        patient_ids = list(args['ids'] or [])
+        if args['cohort'] is not None:
+            try:
+                patients = fhir_client.get_all_patients()
+            except ConnectionError:
+                return make_response(jsonify({'message': 'Patients could not be retrieved'}), 502)
+            patient_ids += [patient.uuid for patient in patients if matches_cohort(patient, args['cohort'])]
+
+        if not patient_ids:
+            return make_response(jsonify({'message': 'No patients matched the request'}), 404)
+
+        parts = shard_patients(OrderedDict.fromkeys(patient_ids))
+        if list(parts) != [shard_self]:
+            batch = submit_sharded_batch(parts)
+            return make_response(jsonify({'job_id': batch.job_id, 'total': sum(len(ids) for ids in parts.values()),
+                                          'status_url': '/batch/healthReports/' + batch.job_id,
+                                          'nodes': batch.nodes()}), 202)
+
+        job = batch_manager.submit(patient_ids)
+        return make_response(jsonify({'job_id': job.job_id, 'total': len(job.statuses),
+                                      'status_url': '/batch/healthReports/' + job.job_id}), 202)
+
+
+class BatchPrintFile(Resource):
+    """
+    Class used to merge the feedback forms or details documents of many patients into one file ready to print.
+    """
+
+    def __init__(self):
+        self.reqparse = reqparse.RequestParser()
+        self.reqparse.add_argument('ids', type=str, action='append', location='json')
+        self.reqparse.add_argument('cohort', type=dict, location='json')
+        self.reqparse.add_argument('documents', type=str, action='append', choices=('feedback', 'details'),
+                                   location='json')
+        self.reqparse.add_argument('format', type=str, choices=('docx', 'pdf'), default='docx', location='json')
+        self.reqparse.add_argument('name', type=str, location='json')
+        self.reqparse.add_argument('callback', type=str, location='json')
+        super(BatchPrintFile, self).__init__()
+
+    def post(self):
+        """
+        The POST request for this endpoint takes either a list of patient IDs or a cohort filter as JSON, along with
+        the documents to include for each patient, feedback and/or details, and the format, docx or pdf. A job is
+        queued in the bulk lane to build one print file with a section per document, and the response is 202 with
+        the job to poll. The file is named after its patients and documents unless a name is given, so asking for
+        the same print file again while it is being built returns the same job.
+        """
+        args = self.reqparse.parse_args()
+        if args['ids'] is None and args['cohort'] is None:
+            abort(400)
+
+        patient_ids = list(args['ids'] or [])
+        if args['cohort'] is not None:
+            try:
+                patients = fhir_client.get_all_patients()
+            except ConnectionError:
+                return make_response(jsonify({'message': 'Patients could not be retrieved'}), 502)
+            patient_ids += [patient.uuid for patient in patients if matches_cohort(patient, args['cohort'])]
+
+        if not patient_ids:
+            return make_response(jsonify({'message': 'No patients matched the request'}), 404)
+
+        documents = args['documents'] or ['feedback']
+        name = args['name'] or '%s print %s' % (' '.join(documents),
+                                                hashlib.sha1('\n'.join(patient_ids).encode('utf-8')).hexdigest()[:12])
+        blob_name = name + '.' + args['format']
+        job = job_queue.submit('print', blob_name, 'bulk', callback=args['callback'],
+                               options={'ids': patient_ids, 'documents': documents, 'file_format': args['format']})
+        return make_response(jsonify(dict(job, total=len(patient_ids),
+                                          status_url=api.url_for(JobStatus, job_id=job['job_id']))), 202)
+
+
+class BatchHealthReportStatus(Resource):
+    """
+    Class used to check on the progress of a batch of health data documents.
+    """
+
+    def __init__(self):
+        self.reqparse = reqparse.RequestParser()
+        self.reqparse.add_argument('status', type=str, location='args')
+        super(BatchHealthReportStatus, self).__init__()
+
+    def get(self, job_id):
+        """
+        The GET response for this endpoint is JSON containing the overall progress of the job and the status of each
+        patient in it. Passing a status only lists the patients currently at that status, for example failed. For a
+        job split between nodes the progress of every node is combined, and nodes gives the progress and throughput
+        of each node in patients completed per second.
+        """
+        args = self.reqparse.parse_args()
+        with sharded_batches_lock:
+            expire_sharded_batches()
+            batch = sharded_batches.get(job_id)
+        if batch is not None:
+            return make_response(jsonify(sharded_batch_summary(batch, args['status'])), 200)
+        job = batch_manager.get(job_id)
+        if job is None:
+            return make_response(jsonify({'message': 'Job Does Not Exist'}), 404)
+
+        return make_response(jsonify(job.summary(args['status'])), 200)
+
+
+class DocumentJobs(Resource):
+    """
+    Class used to queue documents for many patients on the background job queue.
+    """
+
+    def __init__(self):
+        self.reqparse = reqparse.RequestParser()
+        self.reqparse.add_argument('document', type=str, choices=('feedback', 'health', 'details'), required=True,
+                                   location='json')
+        self.reqparse.add_argument('ids', type=str, action='append', required=True, location='json')
+        self.reqparse.add_argument('priority', type=str, choices=tuple(PRIORITIES), default='bulk', location='json')
+        self.reqparse.add_argument('force', type=inputs.boolean, default=False, location='json')
+        self.reqparse.add_argument('callback', type=str, location='json')
+        super(DocumentJobs, self).__init__()
+
+    def post(self):
+        """
+        The POST request for this endpoint takes JSON with the document type, feedback, health or details, and the
+        list of patient ids to create it for. One job is queued per patient in the bulk lane unless priority says
+        otherwise, and the response is 202 with every job. Patients already waiting for the same document share the
+        existing job. In sharding mode each patient's job is queued on the node owning them, which is named by the
+        node of the job along with the full URL of its status.
+        """
+        args = self.reqparse.parse_args()
+        parts = shard_patients(args['ids'])
+        jobs = []
+        for patient_id in parts.get(shard_self, []):
+            job = job_queue.submit(args['document'], patient_id, args['priority'], args['force'], args['callback'])
+            jobs.append(dict(job, status_url=api.url_for(JobStatus, job_id=job['job_id'])))
+            if shard_ring is not None:
+                jobs[-1].update(node=shard_self, status_url=shard_self + jobs[-1]['status_url'])
+
+        payload = {key: args[key] for key in ('document', 'priority', 'force', 'callback')}
+        forwarded = OrderedDict((node, ('/jobs', dict(payload, ids=ids))) for node, ids in parts.items()
+                                if node != shard_self)
+        answers = peer_client.fan_out('POST', forwarded) if forwarded else {}
+        for node, answer in answers.items():
+            if isinstance(answer, ConnectionError) or answer[0] != 202:
+                jobs.extend({'document': args['document'], 'patient_id': patient_id, 'state': 'failed',
+                             'error': peer_error(answer), 'node': node} for patient_id in parts[node])
+            else:
+                # the node owning the patients names itself and gives the full status URL of each job
+                jobs.extend(answer[1]['jobs'])
+        return make_response(jsonify({'jobs': jobs}), 202)
+
+    def get(self):
+        """
+        The GET response for this endpoint is the number of jobs in each state.
+        """
+        return make_response(jsonify(job_queue.counts()), 200)
+
+
+class JobStatus(Resource):
+    """
+    Class used to check on a single job of the background job queue.
+    """
+
+    def get(self, job_id):
+        """
+        The GET response for this endpoint is JSON describing the job: its state, queued, running, done or failed,
+        when it was created, started and finished, and once done whether the document was regenerated and where
+        it is stored.
+        """
+        job = job_queue.get(job_id)
+        if job is None:
+            return make_response(jsonify({'message': 'Job Does Not Exist'}), 404)
+        return make_response(jsonify(job), 200)
+
 
-        write_data_to_azure(args['id'] + " details.docx", storage_account_name, storage_account_key,
-                            patient_info_container_name)
-        os.remove(args['id'] + " details.docx")
+class BulkImport(Resource):
+    """
+    Class used to fill the bulk data store the API reads patients and observations from when fhir_source is bulk.
+    """
 
-        return make_response(jsonify({'message': 'Document created successfully'}, 200))
+    def __init__(self):
+        self.reqparse = reqparse.RequestParser()
+        self.reqparse.add_argument('folder', type=str, location='json')
+        self.reqparse.add_argument('export', type=inputs.boolean, default=False, location='json')
+        self.reqparse.add_argument('replace', type=inputs.boolean, default=False, location='json')
+        self.reqparse.add_argument('callback', type=str, location='json')
+        super(BulkImport, self).__init__()
+
+    def get(self):
+        """
+        The GET response for this endpoint is the number of patients and observations in the bulk data store.
+        """
+        if bulk_store is None:
+            return make_response(jsonify({'message': 'The API is not reading from a bulk data store'}), 409)
+        return make_response(jsonify(bulk_store.stats()), 200)
+
+    def post(self):
+        """
+        The POST request for this endpoint takes JSON with either folder, a folder of Patient and Observation NDJSON
+        files inside bulk_import_root, or export set to true to run a FHIR bulk export on bulk_export_endpoint.
+        Passing replace swaps the whole store for the import once it has been read completely. A job is queued in
+        the bulk lane to stream the files into the store, and the response is 202 with the job to poll.
+        """
+        if bulk_store is None:
+            return make_response(jsonify({'message': 'The API is not reading from a bulk data store'}), 409)
+        args = self.reqparse.parse_args()
+        if (args['folder'] is None) == (not args['export']):
+            return make_response(jsonify({'message': 'Either folder or export must be given'}), 400)
+        if args['folder'] is not None:
+            path = bulk_import_folder(args['folder'])
+            if path is None or not os.path.isdir(path):
+                return make_response(jsonify({'message': 'Folder Does Not Exist'}), 404)
+
+        # an import replacing the store is a different job from one adding the same files to it
+        source = 'export' if args['export'] else args['folder']
+        if args['replace']:
+            source += ' (replace)'
+        job = job_queue.submit('bulk_import', source, 'bulk', callback=args['callback'],
+                               options={'folder': args['folder'], 'replace': args['replace']})
+        return make_response(jsonify(dict(job, status_url=api.url_for(JobStatus, job_id=job['job_id']))), 202)
+
+
+class FHIRCache(Resource):
+    """
+    Class used to inspect and clear the cache of patients and observations fetched from FHIR.
+    """
+
+    def __init__(self):
+        self.reqparse = reqparse.RequestParser()
+        self.reqparse.add_argument('id', type=str, location='args')
+        super(FHIRCache, self).__init__()
+
+    def get(self):
+        """
+        The GET response for this endpoint is JSON containing the size and hit, miss and eviction counts of the
+        patient and observation caches.
+        """
+        return make_response(jsonify(fhir_client.stats()), 200)
+
+    def delete(self):
+        """
+        The DELETE request for this endpoint removes a patient and their observations from the cache so the next
+        request fetches them from FHIR again, along with the patient's stored health history when incremental health
+        reports are turned on. Without an id the whole cache is cleared.
+        """
+        args = self.reqparse.parse_args()
+        fhir_client.invalidate(args['id'])
+        if health_history is not None:
+            health_history.invalidate(args['id'])
+        return make_response(jsonify({'message': 'Cache cleared'}), 200)
+
+
+def warm_up():
+    """
+    Loads matplotlib in every chart worker process and python-docx in this one, and builds the health report template
+    when templates are used, by generating a health report with no readings. Called by the server before a worker
+    accepts requests so the first requests are not slowed down by imports and template building.
+    """
+    chart_pool.warm_up()
+    patient_data = OrderedDict((vital_sign, VitalSignSeries([], [], "")) for vital_sign in vital_signs)
+    charts = chart_pool.render(patient_data)
+    document_class('health')("warm-up", "warm-up", patient_data, charts).generate_patient_data_form()
+
+
+class MetricsExport(Resource):
+    """
+    Class used to export the timings of each stage of every endpoint, along with cache and pool gauges, for
+    Prometheus to scrape.
+    """
+
+    def get(self):
+        """
+        The GET response for this endpoint is every metric of this worker process in the Prometheus text format.
+        """
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+class ProfilerControl(Resource):
+    """
+    Class used to switch the sampling profiler on and off while the API is running and to collect its results.
+    """
+
+    def __init__(self):
+        self.reqparse = reqparse.RequestParser()
+        self.reqparse.add_argument('enabled', type=inputs.boolean, location='json')
+        self.reqparse.add_argument('interval', type=float, location='json')
+        self.reqparse.add_argument('reset', type=inputs.boolean, default=False, location='json')
+        super(ProfilerControl, self).__init__()
+
+    def get(self):
+        """
+        The GET response for this endpoint is the stacks sampled so far in the collapsed stack format used by flame
+        graph tools.
+        """
+        return Response(profiler.collapsed(), mimetype='text/plain')
+
+    def post(self):
+        """
+        The POST request for this endpoint takes JSON with enabled to start or stop the profiler, interval to set
+        the seconds between samples and reset to throw away the samples collected so far. The response is the
+        status of the profiler.
+        """
+        args = self.reqparse.parse_args()
+        if args['interval'] is not None and args['interval'] <= 0:
+            return make_response(jsonify({'message': 'interval must be greater than 0'}), 400)
+        if args['reset']:
+            profiler.reset()
+        if args['enabled'] is True:
+            profiler.start(args['interval'] or profiler_interval)
+        elif args['enabled'] is False:
+            profiler.stop()
+        return make_response(jsonify(profiler.status()), 200)
+
+
+@app.before_request
+def before_request():
+    start_request_timer()
+    # in sharding mode a patient's documents are only made by the node owning them
+    if shard_ring is not None and request.endpoint in PATIENT_ENDPOINTS and request.args.get('id'):
+        owner = shard_ring.node_for(request.args['id'])
+        if owner != shard_self:
+            return redirect(owner + request.full_path, 307)
+
+
+@app.after_request
+def after_request(response):
+    """
+    Compresses responses for clients that accept it when compress_responses is set, and records the time taken by
+    every request, adding a Server-Timing header when server_timing is set in the config or the request passes
+    server_timing=true.
+    """
+    if compress_responses:
+        response = compress_response(response, compress_min_size, gzip_level, brotli_quality)
+    return record_request(response, server_timing or request.args.get('server_timing') in ('1', 'true'))
 
 
 # declares the routing for each endpoint
 api.add_resource(GenerateFeedbackReport, '/FormFiller/feedback', endpoint='feedback')
 api.add_resource(GenerateFeedbackReportData, '/FormFiller/feedbackDocumentData', endpoint='feedbackDocumentData')
+api.add_resource(FeedbackQuestions, '/FormFiller/questions/<string:version>', endpoint='feedbackQuestions')
 api.add_resource(GeneratePatientReport, '/report/patientReport', endpoint='report')
 api.add_resource(GeneratePatientReportData, '/report/rawData', endpoint='reportData')
 api.add_resource(GeneratePatientInformation, '/info/infoDocument', endpoint='patientInfo')
+api.add_resource(GeneratePatientPack, '/pack', endpoint='pack')
+api.add_resource(BatchHealthReports, '/batch/healthReports', endpoint='batchReports')
+api.add_resource(BatchPrintFile, '/batch/printFile', endpoint='batchPrintFile')
+api.add_resource(BatchHealthReportStatus, '/batch/healthReports/<string:job_id>', endpoint='batchReportStatus')
+api.add_resource(DocumentJobs, '/jobs', endpoint='jobs')
+api.add_resource(JobStatus, '/jobs/<string:job_id>', endpoint='jobStatus')
+api.add_resource(BulkImport, '/bulk', endpoint='bulk')
+api.add_resource(FHIRCache, '/cache', endpoint='cache')
+api.add_resource(MetricsExport, '/metrics', endpoint='metrics')
+api.add_resource(ProfilerControl, '/profiler', endpoint='profiler')
+
+# loads the details for the azure storage account and every other setting from the config file and environment.
+data = get_config()
+storage_account_name = data["account_name"]
+storage_account_key = data["account_key"]
+feedback_container_name = data["feedback_container_name"]
+health_data_container_name = data["health_data_container_name"]
+patient_info_container_name = data['patient_info_container_name']
+vital_signs = data.get('vital_signs', vital_signs)
+fhir_endpoint = data.get('fhir_endpoint', 'https://localhost:5001/api/')
+fhir_source = data.get('fhir_source', 'api')
+bulk_data_path = data.get('bulk_data_path', 'bulk_data.sqlite3')
+bulk_import_root = data.get('bulk_import_root', 'bulk_export')
+bulk_export_endpoint = data.get('bulk_export_endpoint') or fhir_endpoint
+bulk_export_timeout = data.get('bulk_export_timeout', 540)
+fhir_async = data.get('fhir_async', False)
+fhir_max_connections = data.get('fhir_max_connections', 32)
+fhir_max_concurrent_requests = data.get('fhir_max_concurrent_requests', 8)
+fhir_cache_patients = data.get('fhir_cache_patients', 1000)
+fhir_cache_observations = data.get('fhir_cache_observations', 200)
+fhir_cache_ttl = data.get('fhir_cache_ttl', 300)
+# every server worker process has a pool of its own, so by default the cores are shared out between them
+render_workers = data.get('render_workers') or max(1, os.cpu_count() // data.get('server_processes', 1))
+chart_settings = {"width": data.get('chart_width', 6.4), "height": data.get('chart_height', 4.8),
+                  "dpi": data.get('chart_dpi', 100), "image_format": data.get('chart_format', 'png'),
+                  "max_points": data.get('chart_max_points', 2000),
+                  "downsample": data.get('chart_downsample', 'minmax'),
+                  "max_bytes": data.get('chart_max_bytes', 262144)}
+batch_fetch_workers = data.get('batch_fetch_workers', 8)
+batch_upload_workers = data.get('batch_upload_workers', 8)
+batch_retention = data.get('batch_retention', 86400)
+use_document_templates = data.get('use_document_templates', False)
+incremental_health_reports = data.get('incremental_health_reports', False)
+health_history_path = data.get('health_history_path', 'health_history.sqlite3')
+server_timing = data.get('server_timing', False)
+compress_responses = data.get('compress_responses', True)
+compress_min_size = data.get('compress_min_size', 1024)
+gzip_level = data.get('gzip_level', 6)
+brotli_quality = data.get('brotli_quality', 4)
+job_queue_path = data.get('job_queue_path', 'jobs.sqlite3')
+print_container_name = data.get('print_container_name') or feedback_container_name
+pdf_converter = data.get('pdf_converter', 'soffice')
+job_workers = data.get('job_workers', 2)
+job_timeout = data.get('job_timeout', 600)
+job_retention = data.get('job_retention', 86400)
+pack_workers = data.get('pack_workers', 6)
+blob_write_attempts = data.get('blob_write_attempts', 3)
+shard_nodes = [node.rstrip('/') for node in data.get('shard_nodes', [])]
+shard_self = data.get('shard_self', '').rstrip('/')
+shard_replicas = data.get('shard_replicas', 100)
+shard_timeout = data.get('shard_timeout', 30)
+profiler_interval = data.get('profiler_interval', 0.01)
+
+# one blob store client is shared by every request and worker thread
+blob_store = create_blob_store(data)
+
+# one FHIR client is shared by every request, with recently fetched patients and observations cached. The async
+# client fetches a patient and their observations concurrently over pooled connections. With fhir_source set to bulk
+# patients and observations are read from a local store filled from FHIR bulk exports instead, so reports on whole
+# cohorts make no requests to the FHIR server.
+bulk_store = None
+if fhir_source == 'bulk':
+    # an export still running when its job's lease ran out would be started again by another worker
+    if bulk_export_timeout >= job_timeout:
+        raise ValueError('bulk_export_timeout must be less than job_timeout')
+    from BulkData import BulkDataStore
+    bulk_store = BulkDataStore(bulk_data_path)
+    atexit.register(bulk_store.close)
+    fhir = bulk_store
+elif fhir_async:
+    # aiohttp is only imported when the async client is used
+    from AsyncFHIR import AsyncFHIR
+    fhir = AsyncFHIR(fhir_endpoint, verify_ssl=False, max_connections=fhir_max_connections,
+                     max_concurrent_requests=fhir_max_concurrent_requests)
+    atexit.register(fhir.close)
+else:
+    fhir = FHIR(fhir_endpoint, verify_ssl=False)
+fhir_client = CachingFHIR(fhir, fhir_cache_patients, fhir_cache_observations, fhir_cache_ttl)
+
+# in incremental mode the vital sign series of each patient are kept between reports and only new observations are
+# added to them
+if incremental_health_reports:
+    health_history = HealthHistoryStore(health_history_path)
+    atexit.register(health_history.close)
+else:
+    health_history = None
+
+# in sharding mode every node owns the patients the hash ring gives it, makes only their documents and hands bulk
+# requests for other patients on to the nodes owning them
+if shard_nodes:
+    if shard_self not in shard_nodes:
+        raise ValueError('shard_self must be one of shard_nodes')
+    shard_ring = HashRing(shard_nodes, shard_replicas)
+    peer_client = PeerClient(shard_timeout)
+    atexit.register(peer_client.close)
+else:
+    shard_ring = None
+    peer_client = None
+sharded_batches = {}
+sharded_batches_lock = threading.Lock()
+
+# the documents of a pack are made and uploaded at the same time by these threads
+pack_pool = ThreadPoolExecutor(pack_workers, thread_name_prefix='pack')
+atexit.register(pack_pool.shutdown)
+
+# charts are drawn in worker processes so that requests handled on different threads never share matplotlib state.
+# This process draws the placeholder charts of the health report template, so it uses the same settings.
+configure_charts(chart_settings)
+# the workers make whole health reports for batches, so the document module is imported before they are forked
+chart_pool = ChartRenderPool(render_workers, chart_settings,
+                             ['DocumentTemplates' if use_document_templates else 'GenerateDocuments'])
+batch_manager = BatchJobManager(fetch_health_data, upload_health_report, chart_pool, batch_fetch_workers,
+                                batch_upload_workers, use_templates=use_document_templates,
+                                cache_stage=health_report_metadata, retention=batch_retention)
+
+# documents asked for with background=true or through /jobs are made by worker threads from a queue kept on disk
+job_handlers = {document: partial(run_document_job, document) for document in ('feedback', 'health', 'details')}
+job_handlers['print'] = create_print_file
+if bulk_store is not None:
+    job_handlers['bulk_import'] = run_bulk_import
+job_queue = JobQueue(job_queue_path, job_handlers, job_workers, job_timeout, job_retention)
+atexit.register(job_queue.stop)
+
+# the profiler is only started when asked for through the profiler endpoint or the profiler_enabled setting
+profiler = SamplingProfiler()
+if data.get('profiler_enabled', False):
+    profiler.start(profiler_interval)
 
-# loads the details for the azure storage account from the config file.
-with open('config.json') as config_file:
-    data = json.load(config_file)
-    storage_account_name = data["account_name"]
-    storage_account_key = data["account_key"]
-    feedback_container_name = data["feedback_container_name"]
-    health_data_container_name = data["health_data_container_name"]
-    patient_info_container_name = data['patient_info_container_name']
+for stat, name, description in (('size', 'fhir_cache_entries', 'Entries held in the FHIR caches'),
+                                ('hits', 'fhir_cache_hits', 'Lookups answered by the FHIR caches'),
+                                ('misses', 'fhir_cache_misses', 'Lookups the FHIR caches could not answer'),
+                                ('evictions', 'fhir_cache_evictions', 'Entries evicted from the FHIR caches')):
+    metrics.register_gauge(name, description, lambda stat=stat: {(('cache', cache),): stats[stat]
+                                                                  for cache, stats in fhir_client.stats().items()})
+metrics.register_gauge('chart_workers', 'Worker processes drawing charts', lambda: chart_pool.workers)
+metrics.register_gauge('batch_jobs', 'Batch jobs kept, running or finished within batch_retention',
+                       lambda: batch_manager.stats()['jobs'])
+metrics.register_gauge('document_jobs', 'Background document jobs by state',
+                       lambda: {(('state', state),): count for state, count in job_queue.counts().items()})
+if bulk_store is not None:
+    metrics.register_gauge('bulk_data_resources', 'Resources held in the bulk data store',
+                           lambda: {(('resource', resource),): count for resource, count in bulk_store.stats().items()})
+metrics.register_gauge('batch_patients_in_flight', 'Patients in a batch fetched but not yet uploaded',
+                       lambda: batch_manager.stats()['in_flight'])
 
 if __name__ == '__main__':
     app.run(debug=True, port=5010)
@@ -2,8 +2,7 @@ from DataRetrieval import *
 import docx
 from docx.shared import Inches
 from io import BytesIO
-from dateutil.parser import parse
-import matplotlib.pyplot as plt
+from ChartRenderer import render_patient_charts
 
 
 def add_response_line(paragraph, run_number):
@@ -17,10 +16,22 @@ def add_response_line(paragraph, run_number):
     paragraph.add_run("________________________________________________________")
 
 
+def save_to_memory(doc):
+    """
+    Saves a document into an in-memory buffer rather than a file in the working directory
+    :param doc: Document to save
+    :return: BytesIO holding the .docx file, positioned at the start so it can be read straight away
+    """
+    memfile = BytesIO()
+    doc.save(memfile)
+    memfile.seek(0)
+    return memfile
+
+
 def add_address(feedback_data, doc):
     """
     Adds address of the patient to the top right of the page
-    :param feedback_data: dictionary containing data on the patient from which address data is extracted.
+    :param feedback_data: FeedbackData of the patient from which address data is extracted.
     :param doc: Document to add address to
     """
     address_line, city, state, postcode, country = get_patient_address_data(feedback_data)
@@ -37,7 +48,7 @@ def add_address(feedback_data, doc):
 def add_greeting_with_name(feedback_data, doc):
     """
     Adds greeting with the name of the patient to the page
-    :param feedback_data: dictionary containing data on the patient from which name data is extracted.
+    :param feedback_data: FeedbackData of the patient from which name data is extracted.
     :param doc: Document to add address to
     """
     prefix, first_name, last_name = get_patient_name_data(feedback_data)
@@ -60,6 +71,14 @@ class FeedbackForm():
     def generate_feedback_form(self):
         """
         Creates the Word document asking the patient for feedback.
+        :return: BytesIO holding the .docx file, positioned at the start
+        """
+        self.build_feedback_form()
+        return save_to_memory(self.doc)
+
+    def build_feedback_form(self):
+        """
+        Adds the contents of the feedback form to the document without saving it.
         """
         add_address(self.feedback_data, self.doc)
         self.doc.add_paragraph('Patient Feedback Form', 'Title')
@@ -74,7 +93,6 @@ class FeedbackForm():
         ask_for_recommendation.runs[0].add_break()
         self.add_feedback_table()
         self.add_comment_box(self.comment)
-        self.doc.save(self.patient_id + " feedback request.docx")
 
     def add_feedback_table(self):
         """
@@ -106,39 +124,39 @@ class FeedbackForm():
 
 class PatientHealthForm():
 
-    def __init__(self, patient_id, name, patient_data):
+    def __init__(self, patient_id, name, patient_data, charts=None):
+        """
+        :param charts: optional dictionary of already rendered charts for each vital sign, as returned by
+        render_patient_charts. When not given the charts are rendered in this process.
+        """
         self.doc = docx.Document()
         self.patient_id = patient_id
         self.name = name
         self.patient_data = patient_data
+        self.charts = charts
 
     def generate_patient_data_form(self):
         """
         Creates a word document containing visualisations of patient health data regarding Weight, BMI, Heart rate
         and Respiratory rate
+        :return: BytesIO holding the .docx file, positioned at the start
+        """
+        self.build_patient_data_form()
+        return save_to_memory(self.doc)
+
+    def build_patient_data_form(self):
+        """
+        Adds the title, patient details and a chart for each vital sign to the document without saving it.
         """
         self.doc.add_paragraph('Patient Health Data', 'Title')
         self.doc.add_paragraph("Name: " + self.name)
         self.doc.add_paragraph("ID: " + self.patient_id)
         self.doc.add_paragraph("This document contains graphs detailing changes in the patients vital signs over time\n")
 
+        charts = self.charts if self.charts is not None else render_patient_charts(self.patient_data)
         for data_type in self.patient_data.keys():
-            dates = self.patient_data[data_type]['Dates']
-            values = self.patient_data[data_type]['Values']
-            unit = self.patient_data[data_type]['Unit']
-            dates = [parse(date) for date in dates]
-
-            memfile = BytesIO()
-            plt.figure()
-            plt.plot_date(dates, values, color='orange')
-            plt.xlabel('Date')
-            plt.ylabel(unit)
-            plt.title(data_type)
-            plt.savefig(memfile)
             self.doc.add_paragraph(data_type + " over time").runs[0].bold = True
-            self.doc.add_picture(memfile, height=Inches(3))
-
-        self.doc.save(self.patient_id + " health data.docx")
+            self.doc.add_picture(BytesIO(charts[data_type]), height=Inches(3))
 
 
 class PatientDataForm():
@@ -151,6 +169,14 @@ class PatientDataForm():
         """
         Creates a word document with all of the patients personal information and asks them to check the details.
         Provides lines below the details for the patients to update the data if any of it is wrong or out of date.
+        :return: BytesIO holding the .docx file, positioned at the start
+        """
+        self.build_patient_info_form()
+        return save_to_memory(self.doc)
+
+    def build_patient_info_form(self):
+        """
+        Adds each of the patient's details followed by a response line to the document without saving it.
         """
         para_1 = self.doc.add_paragraph('Patient Details', 'Title')
         para_2 = self.doc.add_paragraph("This document contains the personal information pertaining to " + self.patient.full_name())
@@ -188,7 +214,6 @@ class PatientDataForm():
         add_response_line(para_17, 0)
         para_18 = self.doc.add_paragraph("Social Security Number: " + self.patient.get_identifier("SS"))
         add_response_line(para_18, 0)
-        self.doc.save(self.patient.uuid + " details.docx")
 
 
 
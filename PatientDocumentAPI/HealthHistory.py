@@ -0,0 +1,78 @@
+from collections import OrderedDict
+from datetime import datetime, timezone
+from VitalSeries import VitalSignSeries
+import numpy as np
+import threading
+import sqlite3
+
+
+class HealthHistoryStore():
+    """
+    Local SQLite store of the vital sign series already extracted for each patient, along with the issue time of the
+    newest observation they were extracted from. Health reports only need to add the observations issued after that
+    high-water mark instead of going through the patient's whole history again. Each series is stored as the raw
+    bytes of its numpy date and value arrays.
+    """
+
+    def __init__(self, path='health_history.sqlite3'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS patients (patient_id TEXT PRIMARY KEY, '
+                                    'high_water_mark INTEGER NOT NULL, signs TEXT NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS series (patient_id TEXT NOT NULL, '
+                                    'position INTEGER NOT NULL, sign TEXT NOT NULL, unit TEXT NOT NULL, '
+                                    'dates BLOB NOT NULL, vals BLOB NOT NULL, PRIMARY KEY (patient_id, position))')
+
+    def load(self, patient_id, signs):
+        """
+        Returns the high-water mark of a patient as a timezone aware datetime and their stored health data, or None
+        and None if nothing is stored or it was stored for a different list of vital signs.
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT high_water_mark, signs FROM patients WHERE patient_id = ?',
+                                          (patient_id,)).fetchone()
+            if row is None or row[1] != '\n'.join(signs):
+                return None, None
+            rows = self.connection.execute('SELECT sign, unit, dates, vals FROM series WHERE patient_id = ? '
+                                           'ORDER BY position', (patient_id,)).fetchall()
+
+        patient_data = OrderedDict()
+        for sign, unit, dates, values in rows:
+            patient_data[sign] = VitalSignSeries(np.frombuffer(dates, dtype='datetime64[ms]'),
+                                                 np.frombuffer(values, dtype=np.float64), unit)
+        high_water_mark = datetime.fromtimestamp(row[0] / 1000, timezone.utc)
+        return high_water_mark, patient_data
+
+    def save(self, patient_id, high_water_mark, patient_data):
+        """
+        Replaces the stored health data of a patient.
+        :param high_water_mark: issue time of the newest observation the health data was extracted from
+        :param patient_data: ordered dictionary mapping each vital sign to its VitalSignSeries
+        """
+        milliseconds = int(round(high_water_mark.timestamp() * 1000))
+        rows = [(patient_id, position, sign, series.unit, series.dates.astype('datetime64[ms]').tobytes(),
+                 series.values.tobytes()) for position, (sign, series) in enumerate(patient_data.items())]
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM series WHERE patient_id = ?', (patient_id,))
+            self.connection.execute('INSERT OR REPLACE INTO patients VALUES (?, ?, ?)',
+                                    (patient_id, milliseconds, '\n'.join(patient_data.keys())))
+            self.connection.executemany('INSERT INTO series VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def invalidate(self, patient_id=None):
+        """
+        Removes the stored health data of a patient, or of every patient if no patient ID is given, so it is rebuilt
+        from their full history next time.
+        """
+        with self.lock, self.connection:
+            if patient_id is None:
+                self.connection.execute('DELETE FROM series')
+                self.connection.execute('DELETE FROM patients')
+            else:
+                self.connection.execute('DELETE FROM series WHERE patient_id = ?', (patient_id,))
+                self.connection.execute('DELETE FROM patients WHERE patient_id = ?', (patient_id,))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
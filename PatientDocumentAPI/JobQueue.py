@@ -0,0 +1,238 @@
+import threading
+import requests
+import sqlite3
+import logging
+import uuid
+import json
+import time
+
+# lanes a job can be queued in, jobs in a lower lane are always started first
+PRIORITIES = {'interactive': 0, 'bulk': 1}
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue():
+    """
+    Persistent queue of document generation jobs kept in a local SQLite file, worked through by a pool of background
+    threads. Several API worker processes can share one file: a job is claimed inside an immediate transaction so only
+    one process runs it. While a job runs its worker renews a lease on it every job_timeout / 3 seconds, and a job
+    whose lease has not been renewed for job_timeout seconds, because its worker died, is claimed again. A worker
+    that lost its claim this way does not overwrite the result of the worker that took the job over. Submitting a job
+    for a patient and document type that is already waiting or running returns the existing job instead of queueing a
+    second one.
+    """
+
+    def __init__(self, path, handlers, workers=2, job_timeout=600, retention=86400, poll_interval=1.0):
+        """
+        :param path: path of the SQLite file holding the queue
+        :param handlers: dictionary mapping each document type to a function taking a patient ID, the force flag and
+        the options of the job as keyword arguments, and returning a JSON serialisable result
+        :param workers: number of threads running jobs in this process
+        :param job_timeout: seconds without its lease being renewed after which a running job is assumed to have been
+        abandoned and is run again
+        :param retention: seconds finished jobs are kept for before they are removed
+        :param poll_interval: seconds between checks for jobs queued by other processes
+        """
+        self.handlers = handlers
+        self.job_timeout = job_timeout
+        self.retention = retention
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.wake = threading.Condition()
+        self.stopped = threading.Event()
+        # start time of each job this process is running, which its lease is renewed under
+        self.running = {}
+        self.running_lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, document TEXT NOT NULL, '
+                                    'patient_id TEXT NOT NULL, priority INTEGER NOT NULL, force INTEGER NOT NULL, '
+                                    'state TEXT NOT NULL, created REAL NOT NULL, started REAL, finished REAL, '
+                                    'heartbeat REAL, callbacks TEXT NOT NULL, options TEXT, result TEXT, error TEXT)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS jobs_by_lane ON jobs (state, priority, created)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS jobs_by_patient ON jobs (document, patient_id, state)')
+        self.threads = [threading.Thread(target=self._work, name='JobQueue-%d' % index, daemon=True)
+                        for index in range(workers)]
+        self.threads.append(threading.Thread(target=self._renew, name='JobQueue-lease', daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, document, patient_id, priority='interactive', force=False, callback=None, options=None):
+        """
+        Queues a job, or returns the job already waiting or running for the same patient and document type. A
+        duplicate submitted in a higher priority lane moves the waiting job into that lane.
+        :param patient_id: patient the document is for, or for documents covering many patients any key naming the
+        document, such as its blob name
+        :param callback: URL the finished job is POSTed to as JSON
+        :param options: dictionary of extra JSON serialisable keyword arguments passed to the handler
+        :return: dictionary describing the job
+        """
+        if document not in self.handlers:
+            raise ValueError('Unknown document type ' + document)
+        if priority not in PRIORITIES:
+            raise ValueError('Unknown priority ' + priority)
+        lane = PRIORITIES[priority]
+
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.connection.execute("SELECT job_id, callbacks FROM jobs WHERE document = ? AND "
+                                              "patient_id = ? AND state IN ('queued', 'running')",
+                                              (document, patient_id)).fetchone()
+                if row is None:
+                    job_id = str(uuid.uuid4())
+                    self.connection.execute("INSERT INTO jobs (job_id, document, patient_id, priority, force, state, "
+                                            "created, callbacks, options) VALUES (?, ?, ?, ?, ?, 'queued', ?, ?, ?)",
+                                            (job_id, document, patient_id, lane, int(force), time.time(),
+                                             json.dumps([callback] if callback else []), json.dumps(options or {})))
+                else:
+                    job_id = row[0]
+                    callbacks = json.loads(row[1])
+                    if callback and callback not in callbacks:
+                        callbacks.append(callback)
+                    self.connection.execute("UPDATE jobs SET priority = MIN(priority, ?), force = MAX(force, ?), "
+                                            "callbacks = ? WHERE job_id = ?",
+                                            (lane, int(force), json.dumps(callbacks), job_id))
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+
+        with self.wake:
+            self.wake.notify()
+        return self.get(job_id)
+
+    def get(self, job_id):
+        """
+        Returns a dictionary describing a job, or None if there is no such job.
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT job_id, document, patient_id, priority, state, created, started, '
+                                          'finished, result, error FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        lanes = {lane: name for name, lane in PRIORITIES.items()}
+        job = {"job_id": row[0], "document": row[1], "patient_id": row[2], "priority": lanes.get(row[3], row[3]),
+               "state": row[4], "created": row[5], "started": row[6], "finished": row[7]}
+        if row[8] is not None:
+            job["result"] = json.loads(row[8])
+        if row[9] is not None:
+            job["error"] = row[9]
+        return job
+
+    def counts(self):
+        """
+        Returns the number of jobs in each state.
+        """
+        with self.lock:
+            return dict(self.connection.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+    def stop(self):
+        """
+        Stops the worker threads once their current jobs finish.
+        """
+        self.stopped.set()
+        with self.wake:
+            self.wake.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def _claim(self):
+        """
+        Marks the next job to run as running and returns its ID, document type, patient ID, force flag, options and
+        start time, or None if no job is waiting. Running jobs whose lease has not been renewed for job_timeout seconds
+        are claimed again.
+        """
+        now = time.time()
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.connection.execute("SELECT job_id, document, patient_id, force, options FROM jobs WHERE "
+                                              "state = 'queued' OR (state = 'running' AND heartbeat < ?) "
+                                              "ORDER BY priority, created LIMIT 1",
+                                              (now - self.job_timeout,)).fetchone()
+                if row is not None:
+                    self.connection.execute("UPDATE jobs SET state = 'running', started = ?, heartbeat = ? "
+                                            "WHERE job_id = ?", (now, now, row[0]))
+                    row = row + (now,)
+                self.connection.execute("DELETE FROM jobs WHERE state IN ('done', 'failed') AND finished < ?",
+                                        (now - self.retention,))
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+        return row
+
+    def _renew(self):
+        """
+        Renews the lease on every job this process is running every job_timeout / 3 seconds, so they are not claimed
+        again by another worker while they are still running.
+        """
+        while not self.stopped.wait(self.job_timeout / 3):
+            with self.running_lock:
+                running = list(self.running.items())
+            if not running:
+                continue
+            try:
+                with self.lock:
+                    self.connection.executemany("UPDATE jobs SET heartbeat = ? WHERE job_id = ? AND started = ? AND "
+                                                "state = 'running'",
+                                                [(time.time(), job_id, started) for job_id, started in running])
+            except sqlite3.Error as error:
+                logger.warning('Could not renew the lease on running jobs: %s', error)
+
+    def _finish(self, job_id, started, state, result=None, error=None):
+        """
+        Records the result of a job and POSTs it to its callbacks, unless the job was claimed again by another worker
+        since it was started.
+        """
+        result = None if result is None else json.dumps(result)
+        with self.lock:
+            updated = self.connection.execute("UPDATE jobs SET state = ?, finished = ?, result = ?, error = ? "
+                                              "WHERE job_id = ? AND started = ? AND state = 'running'",
+                                              (state, time.time(), result, error, job_id, started)).rowcount
+            if not updated:
+                logger.warning('Job %s was claimed by another worker, its result is discarded', job_id)
+                return
+            callbacks = json.loads(self.connection.execute('SELECT callbacks FROM jobs WHERE job_id = ?',
+                                                           (job_id,)).fetchone()[0])
+        job = self.get(job_id)
+        for callback in callbacks:
+            try:
+                requests.post(callback, json=job, timeout=10)
+            except requests.RequestException as error:
+                logger.warning('Callback to %s for job %s failed: %s', callback, job_id, error)
+
+    def _work(self):
+        while not self.stopped.is_set():
+            try:
+                job = self._claim()
+            except sqlite3.Error as error:
+                logger.warning('Could not claim a job: %s', error)
+                job = None
+            if job is None:
+                with self.wake:
+                    self.wake.wait(self.poll_interval)
+                continue
+
+            job_id, document, patient_id, force, options, started = job
+            with self.running_lock:
+                self.running[job_id] = started
+            try:
+                try:
+                    result = self.handlers[document](patient_id, bool(force), **json.loads(options or '{}'))
+                except Exception as error:
+                    self._finish(job_id, started, 'failed', error=str(error) or type(error).__name__)
+                else:
+                    self._finish(job_id, started, 'done', result=result)
+            except Exception:
+                logger.exception('Could not record the result of job %s', job_id)
+                try:
+                    self._finish(job_id, started, 'failed', error='Result could not be recorded')
+                except Exception:
+                    logger.exception('Could not mark job %s as failed', job_id)
+            finally:
+                with self.running_lock:
+                    del self.running[job_id]
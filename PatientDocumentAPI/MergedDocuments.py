@@ -0,0 +1,86 @@
+from io import BytesIO
+import subprocess
+import zipfile
+import os
+
+
+class MergedDocumentWriter():
+    """
+    Writes the bodies of many template documents into a single word document, one section per document, so a whole
+    batch can be printed in one go. The document is streamed into the zip file as each body is added and never held
+    in memory as a whole, so memory use stays the same however many documents are merged.
+    """
+
+    def __init__(self, fileobj):
+        """
+        :param fileobj: writable binary file the .docx is written to, usually a file on disk
+        """
+        self.fileobj = fileobj
+        self.archive = None
+        self.document = None
+        self.tail = None
+        self.section_break = None
+        self.sections = 0
+
+    def add(self, template, body):
+        """
+        Adds one document to the end of the merged document, starting it on a new page.
+        :param template: DocumentTemplate the body was filled in from. The styles and other parts of the merged
+        document are taken from the template of the first document added.
+        :param body: xml of the document body, as returned by DocumentTemplate.body
+        """
+        if self.archive is None:
+            self._start(template)
+        else:
+            self.document.write(self.section_break)
+        self.document.write(body.encode('utf-8'))
+        self.sections += 1
+
+    def _start(self, template):
+        self.archive = zipfile.ZipFile(self.fileobj, 'w', zipfile.ZIP_DEFLATED)
+        with zipfile.ZipFile(BytesIO(template.static)) as static:
+            for info in static.infolist():
+                self.archive.writestr(info, static.read(info))
+        self.document = self.archive.open('word/document.xml', 'w', force_zip64=True)
+        self.document.write(template.head.encode('utf-8'))
+        self.tail = template.tail.encode('utf-8')
+        # an empty paragraph holding a copy of the section properties ends a section, and the next starts on a new page
+        properties = template.tail[:template.tail.rindex('</w:body>')]
+        self.section_break = ('<w:p><w:pPr>' + properties + '</w:pPr></w:p>').encode('utf-8')
+
+    def close(self):
+        """
+        Finishes the merged document. Raises ValueError if no documents were added.
+        """
+        if self.archive is None:
+            raise ValueError('No documents were added to the print file')
+        self.document.write(self.tail)
+        self.document.close()
+        self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        if exception_type is None:
+            self.close()
+        elif self.archive is not None:
+            self.document.close()
+            self.archive.close()
+
+
+def convert_to_pdf(path, converter='soffice', timeout=3600):
+    """
+    Converts a .docx file to PDF with a local LibreOffice install, writing the PDF next to it.
+    :param converter: LibreOffice command, either on the PATH or as a full path
+    :return: path of the PDF
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    try:
+        subprocess.run([converter, '--headless', '--convert-to', 'pdf', '--outdir', folder, path], check=True,
+                       timeout=timeout, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise RuntimeError('PDF converter ' + converter + ' was not found')
+    except subprocess.CalledProcessError as error:
+        raise RuntimeError('PDF conversion failed: ' + error.stderr.decode('utf-8', 'replace').strip())
+    return os.path.splitext(path)[0] + '.pdf'
@@ -0,0 +1,158 @@
+from flask import g, has_request_context, request
+from contextlib import contextmanager
+import threading
+import bisect
+import time
+
+# upper bounds in seconds of the histogram buckets, the last bucket holding everything slower
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram():
+    """
+    Thread safe Prometheus style histogram of durations with fixed buckets.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.sum += seconds
+
+    def snapshot(self):
+        """
+        Returns the cumulative count of each bucket, including the final +Inf bucket, and the sum of every duration.
+        """
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = []
+        running = 0
+        for count in counts:
+            running += count
+            cumulative.append(running)
+        return cumulative, total
+
+
+class MetricsRegistry():
+    """
+    Collects the time spent in each stage of each endpoint, counts responses by endpoint and status code, and reads
+    gauges such as cache sizes when the metrics are exported. Every worker process keeps its own registry.
+    """
+
+    def __init__(self, prefix='patient_document'):
+        self.prefix = prefix
+        self.histograms = {}
+        self.responses = {}
+        self.gauges = []
+        self.lock = threading.Lock()
+
+    def observe(self, endpoint, stage, seconds):
+        """
+        Records the time taken by one stage of handling a request to an endpoint.
+        """
+        key = (endpoint, stage)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        histogram.observe(seconds)
+
+    def count_response(self, endpoint, status):
+        with self.lock:
+            self.responses[(endpoint, status)] = self.responses.get((endpoint, status), 0) + 1
+
+    def register_gauge(self, name, description, read):
+        """
+        Adds a gauge read when the metrics are exported.
+        :param read: function returning either a number or a dictionary mapping label dictionaries, given as tuples
+        of name and value pairs, to numbers
+        """
+        with self.lock:
+            self.gauges.append((self.prefix + '_' + name, description, read))
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            responses = sorted(self.responses.items())
+            gauges = list(self.gauges)
+
+        name = self.prefix + '_stage_seconds'
+        lines = ['# HELP ' + name + ' Time spent in each stage of handling a request', '# TYPE ' + name + ' histogram']
+        for (endpoint, stage), histogram in histograms:
+            labels = 'endpoint="%s",stage="%s"' % (endpoint, stage)
+            cumulative, total = histogram.snapshot()
+            for bound, count in zip(histogram.buckets + ('+Inf',), cumulative):
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, count))
+            lines.append('%s_sum{%s} %f' % (name, labels, total))
+            lines.append('%s_count{%s} %d' % (name, labels, cumulative[-1]))
+
+        name = self.prefix + '_responses_total'
+        lines += ['# HELP ' + name + ' Responses sent by endpoint and status code', '# TYPE ' + name + ' counter']
+        for (endpoint, status), count in responses:
+            lines.append('%s{endpoint="%s",status="%d"} %d' % (name, endpoint, status, count))
+
+        for name, description, read in gauges:
+            lines += ['# HELP ' + name + ' ' + description, '# TYPE ' + name + ' gauge']
+            value = read()
+            if isinstance(value, dict):
+                for labels, number in value.items():
+                    label_text = ','.join('%s="%s"' % (label, label_value) for label, label_value in labels)
+                    lines.append('%s{%s} %s' % (name, label_text, number))
+            else:
+                lines.append('%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+
+# the registry of this process
+metrics = MetricsRegistry()
+
+
+@contextmanager
+def span(stage, endpoint=None):
+    """
+    Times the code inside the with block as one stage of the current request. The time is added to the histogram for
+    the endpoint and stage and, inside a request, kept so it can be sent back in a Server-Timing header.
+    :param endpoint: name the time is recorded under, defaulting to the endpoint of the current request or to
+    background outside of a request
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if has_request_context():
+            g.setdefault('timings', []).append((stage, seconds))
+            endpoint = endpoint or request.endpoint
+        metrics.observe(endpoint or 'background', stage, seconds)
+
+
+def start_request_timer():
+    """
+    Notes when the current request started. Registered to run before every request.
+    """
+    g.request_start = time.perf_counter()
+
+
+def record_request(response, server_timing=False):
+    """
+    Records the total time taken by the current request and its status code and, if server_timing is set, adds a
+    Server-Timing header listing the time spent in each stage.
+    """
+    endpoint = request.endpoint or 'none'
+    total = time.perf_counter() - g.get('request_start', time.perf_counter())
+    metrics.observe(endpoint, 'total', total)
+    metrics.count_response(endpoint, response.status_code)
+    if server_timing:
+        timings = g.get('timings', []) + [('total', total)]
+        response.headers['Server-Timing'] = ', '.join('%s;dur=%.3f' % (stage, seconds * 1000)
+                                                      for stage, seconds in timings)
+    return response
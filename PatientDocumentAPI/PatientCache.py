@@ -0,0 +1,147 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache():
+    """
+    Thread safe cache holding at most max_size entries, each of which expires ttl seconds after it was stored. When
+    the cache is full the least recently used entry is evicted to make room.
+    """
+
+    def __init__(self, max_size=1000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Returns the value stored for key, or None if there is no value or it has expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        """
+        Stores value for key, evicting the least recently used entries if the cache is full.
+        """
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        """
+        Removes the entry for key, or every entry if no key is given.
+        """
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def stats(self):
+        """
+        Returns a dictionary of the size of the cache and its hit, miss and eviction counters.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self.entries), "max_size": self.max_size, "ttl": self.ttl, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions,
+                    "hit_ratio": self.hits / lookups if lookups else 0.0}
+
+
+class CachingFHIR():
+    """
+    Wraps a single FHIR client shared by the whole process and caches the patients and observations it returns,
+    keyed by patient ID, so repeated requests and requests to different endpoints for the same patient do not go
+    back to the FHIR server. Failed requests are never cached.
+    """
+
+    def __init__(self, fhir, max_patients=1000, max_observations=200, ttl=300):
+        """
+        :param fhir: the fhir_parser FHIR client requests are passed on to
+        :param max_patients: maximum number of patients kept in the cache
+        :param max_observations: maximum number of patients whose observations are kept in the cache, usually lower
+        than max_patients as observation histories are much bigger
+        :param ttl: number of seconds before a cached patient or observation list is fetched again
+        """
+        self.fhir = fhir
+        self.patients = TTLCache(max_patients, ttl)
+        self.observations = TTLCache(max_observations, ttl)
+
+    def get_patient(self, patient_id):
+        """
+        Returns the patient with the given ID, from the cache if possible.
+        """
+        patient = self.patients.get(patient_id)
+        if patient is None:
+            patient = self.fhir.get_patient(patient_id)
+            self.patients.put(patient_id, patient)
+        return patient
+
+    def get_patient_observations(self, patient_id):
+        """
+        Returns every observation made on the patient with the given ID, from the cache if possible.
+        """
+        observations = self.observations.get(patient_id)
+        if observations is None:
+            observations = self.fhir.get_patient_observations(patient_id)
+            self.observations.put(patient_id, observations)
+        return observations
+
+    def get_patient_with_observations(self, patient_id):
+        """
+        Returns a patient and their observations, from the cache if possible. When neither is cached and the wrapped
+        client can fetch both at once, such as AsyncFHIR, the two requests are made concurrently.
+        """
+        patient = self.patients.get(patient_id)
+        observations = self.observations.get(patient_id)
+        if patient is None and observations is None and hasattr(self.fhir, 'get_patient_with_observations'):
+            patient, observations = self.fhir.get_patient_with_observations(patient_id)
+            self.patients.put(patient_id, patient)
+            self.observations.put(patient_id, observations)
+        if patient is None:
+            patient = self.fhir.get_patient(patient_id)
+            self.patients.put(patient_id, patient)
+        if observations is None:
+            observations = self.fhir.get_patient_observations(patient_id)
+            self.observations.put(patient_id, observations)
+        return patient, observations
+
+    def get_all_patients(self):
+        """
+        Returns every patient on the FHIR server. The result is not cached but each patient is, ready for the
+        requests that usually follow.
+        """
+        patients = self.fhir.get_all_patients()
+        for patient in patients:
+            self.patients.put(patient.uuid, patient)
+        return patients
+
+    def invalidate(self, patient_id=None):
+        """
+        Removes a patient and their observations from the cache, or everything if no patient ID is given.
+        """
+        self.patients.invalidate(patient_id)
+        self.observations.invalidate(patient_id)
+
+    def stats(self):
+        """
+        Returns the counters of both caches.
+        """
+        return {"patients": self.patients.stats(), "observations": self.observations.stats()}
@@ -0,0 +1,98 @@
+class Record():
+    """
+    Base of the small fixed-field records holding the data a document is made from. Fields are kept in __slots__
+    rather than a dictionary per instance, which keeps large batches of patients small in memory, and to_json turns
+    a record into exactly the JSON the endpoints return, with each field under the same name.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_json(cls, entry):
+        """
+        Creates a record from the dictionary returned by to_json.
+        """
+        return cls(*(entry[field] for field in cls.__slots__))
+
+    def to_json(self):
+        values = {}
+        for field in self.__slots__:
+            value = getattr(self, field)
+            values[field] = value.to_json() if isinstance(value, Record) else value
+        return values
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, field) == getattr(other, field)
+                                                 for field in self.__slots__)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(repr(getattr(self, field)) for field in self.__slots__))
+
+
+class PatientName(Record):
+    """
+    Name of a patient as written on their feedback form.
+    """
+    __slots__ = ('prefix', 'first_name', 'last_name')
+
+    def __init__(self, prefix, first_name, last_name):
+        self.prefix = prefix
+        self.first_name = first_name
+        self.last_name = last_name
+
+    @classmethod
+    def from_patient(cls, patient):
+        return cls(patient.name.prefix, patient.name.given, patient.name.family)
+
+
+class PatientAddress(Record):
+    """
+    First address of a patient, which their feedback form is sent to.
+    """
+    __slots__ = ('address_lines', 'city', 'state', 'postcode', 'country')
+
+    def __init__(self, address_lines, city, state, postcode, country):
+        self.address_lines = address_lines
+        self.city = city
+        self.state = state
+        self.postcode = postcode
+        self.country = country
+
+    @classmethod
+    def from_patient(cls, patient):
+        address = patient.addresses[0]
+        return cls(address.lines, address.city, address.state, address.postal_code, address.country)
+
+
+class FeedbackText(Record):
+    """
+    Questions and messages on a feedback form. They are the same for every patient, so a single instance is shared
+    by all of them, and as they never change they can be used as a key for the feedback form template.
+    """
+    __slots__ = ('intro', 'recommendation', 'comment', 'hospital', 'clinic')
+
+    def __init__(self, intro, recommendation, comment, hospital, clinic):
+        self.intro = intro
+        self.recommendation = recommendation
+        self.comment = comment
+        self.hospital = hospital
+        self.clinic = clinic
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, field) for field in self.__slots__))
+
+
+class FeedbackData(Record):
+    """
+    Everything a patient's feedback form is made from, returned by the feedback endpoints as JSON.
+    """
+    __slots__ = ('name', 'address', 'questions_and_messages')
+
+    def __init__(self, name, address, questions_and_messages):
+        self.name = name
+        self.address = address
+        self.questions_and_messages = questions_and_messages
+
+    @classmethod
+    def from_json(cls, entry):
+        return cls(PatientName.from_json(entry["name"]), PatientAddress.from_json(entry["address"]),
+                   FeedbackText.from_json(entry["questions_and_messages"]))
@@ -0,0 +1,84 @@
+import threading
+import sys
+import os
+
+
+class SamplingProfiler():
+    """
+    Profiler that can be switched on and off while the API is running. A background thread looks at the stack of
+    every other thread at a fixed interval and counts how often each stack is seen. The counts are returned in the
+    collapsed stack format read by flame graph tools, one stack per line with the frames separated by semicolons.
+    """
+
+    def __init__(self, max_stacks=10000):
+        """
+        :param max_stacks: maximum number of different stacks counted, stacks seen after that are counted together
+        """
+        self.max_stacks = max_stacks
+        self.stacks = {}
+        self.samples = 0
+        self.interval = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, interval=0.01):
+        """
+        Starts sampling every interval seconds, or changes the interval if already sampling.
+        """
+        with self.lock:
+            self.interval = interval
+            if self.running:
+                return
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._sample, name='SamplingProfiler', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """
+        Stops sampling, keeping the counts collected so far.
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.thread = None
+
+    def reset(self):
+        with self.lock:
+            self.stacks = {}
+            self.samples = 0
+
+    def collapsed(self):
+        """
+        Returns the sampled stacks in collapsed stack format, most common first.
+        """
+        with self.lock:
+            stacks = sorted(self.stacks.items(), key=lambda item: item[1], reverse=True)
+        return ''.join('%s %d\n' % (stack, count) for stack, count in stacks)
+
+    def status(self):
+        with self.lock:
+            return {"running": self.running, "interval": self.interval, "samples": self.samples,
+                    "stacks": len(self.stacks)}
+
+    def _sample(self):
+        own_thread = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack = ';'.join(reversed(frames))
+                with self.lock:
+                    if stack not in self.stacks and len(self.stacks) >= self.max_stacks:
+                        stack = '[other]'
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                    self.samples += 1
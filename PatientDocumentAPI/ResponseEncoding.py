@@ -0,0 +1,96 @@
+from flask import request
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    # without brotli responses are only ever compressed with gzip
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:
+    # without msgpack the data endpoints only answer in JSON
+    msgpack = None
+
+MSGPACK_MIMETYPE = 'application/msgpack'
+
+# responses of these types are worth compressing, documents and images are already compressed
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson', MSGPACK_MIMETYPE, 'text/plain')
+
+
+def available_encodings():
+    """
+    Returns the content encodings responses can be compressed with, best first.
+    """
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def choose_encoding():
+    """
+    Returns the best content encoding the client of the current request accepts, or None to send the response as it
+    is.
+    """
+    return request.accept_encodings.best_match(available_encodings())
+
+
+def compressor(encoding, gzip_level=6, brotli_quality=4):
+    """
+    Returns three functions: one compressing a chunk of a response, one flushing everything compressed so far so it
+    can be sent, and one finishing the compressed stream.
+    """
+    if encoding == 'br':
+        stream = brotli.Compressor(quality=brotli_quality)
+        return stream.process, stream.flush, stream.finish
+    # a window size of 31 makes zlib write a gzip header and trailer
+    stream = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+    return stream.compress, lambda: stream.flush(zlib.Z_SYNC_FLUSH), stream.flush
+
+
+def compressed_chunks(chunks, compress, flush, finish):
+    """
+    Compresses a streamed response as it is sent, flushing after each chunk so clients receive each part of the
+    stream as soon as it is ready.
+    """
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compress(chunk) + flush()
+        if data:
+            yield data
+    yield finish()
+
+
+def compress_response(response, min_size=1024, gzip_level=6, brotli_quality=4):
+    """
+    Compresses a response with brotli or gzip if the client accepts either, the response is of a compressible type
+    and, unless it is streamed, at least min_size bytes. Registered to run after every request.
+    """
+    response.vary.add('Accept-Encoding')
+    if response.status_code < 200 or response.status_code in (204, 304) or 'Content-Encoding' in response.headers:
+        return response
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+
+    compress, flush, finish = compressor(encoding, gzip_level, brotli_quality)
+    if response.is_streamed:
+        response.response = compressed_chunks(response.response, compress, flush, finish)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(compress(data) + finish())
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def pack(payload):
+    """
+    Serialises a payload with MessagePack. Bytes, such as the packed arrays of a vital sign series, are written as
+    MessagePack binary.
+    """
+    return msgpack.packb(payload, use_bin_type=True)
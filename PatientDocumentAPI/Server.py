@@ -0,0 +1,159 @@
+from werkzeug.serving import run_simple
+from werkzeug.wsgi import ClosingIterator
+from Config import get_config
+from Metrics import metrics
+import threading
+import argparse
+import json
+import os
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    # gunicorn does not run on Windows, where the API falls back to a single process server
+    BaseApplication = object
+
+
+class RequestLimiter():
+    """
+    WSGI middleware bounding the number of requests a worker process handles at once. Requests beyond max_in_flight
+    wait in a queue of at most max_queue requests; once the queue is full new requests are turned away straight
+    away with 429, and requests that wait longer than queue_timeout seconds are turned away with 503, so an
+    overloaded server answers quickly instead of piling up threads. Requests to exempt_paths, such as metrics
+    scrapes, are never limited.
+    """
+
+    def __init__(self, app, max_in_flight=4, max_queue=16, queue_timeout=10, retry_after=1,
+                 exempt_paths=('/metrics',)):
+        self.app = app
+        self.exempt_paths = exempt_paths
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.active = 0
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') in self.exempt_paths:
+            return self.app(environ, start_response)
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                if self.waiting >= self.max_queue:
+                    return self.reject(start_response, '429 Too Many Requests', 'Server is busy, try again later')
+                self.waiting += 1
+            try:
+                acquired = self.slots.acquire(timeout=self.queue_timeout)
+            finally:
+                with self.lock:
+                    self.waiting -= 1
+            if not acquired:
+                return self.reject(start_response, '503 Service Unavailable', 'Request timed out waiting to be handled')
+
+        with self.lock:
+            self.active += 1
+        try:
+            # the slot is held until the whole response, which may be streamed, has been sent
+            return ClosingIterator(self.app(environ, start_response), self.release)
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+        self.slots.release()
+
+    def reject(self, start_response, status, message):
+        """
+        Sends a JSON error response telling the client when to try again.
+        """
+        body = json.dumps({'message': message}).encode('utf-8')
+        start_response(status, [('Content-Type', 'application/json'), ('Content-Length', str(len(body))),
+                                ('Retry-After', str(self.retry_after))])
+        return [body]
+
+
+def create_app():
+    """
+    Imports the API, which loads its settings and creates its shared clients, and wraps it in a RequestLimiter.
+    """
+    import FormAPI
+    data = get_config()
+    limiter = RequestLimiter(FormAPI.app, max_in_flight=data.get('server_max_in_flight', 4),
+                             max_queue=data.get('server_max_queue', 16),
+                             queue_timeout=data.get('server_queue_timeout', 10))
+    metrics.register_gauge('requests_in_flight', 'Requests being handled by this worker', lambda: limiter.active)
+    metrics.register_gauge('requests_waiting', 'Requests queued waiting to be handled by this worker',
+                           lambda: limiter.waiting)
+    return limiter
+
+
+def warm_up_worker(worker=None):
+    """
+    Warms up the API in a worker process before it starts accepting requests, if server_warm_up is set.
+    """
+    if get_config().get('server_warm_up', True):
+        import FormAPI
+        FormAPI.warm_up()
+        if worker is not None:
+            worker.log.info('Worker %s warmed up', worker.pid)
+
+
+class PatientDocumentServer(BaseApplication):
+    """
+    Serves the API from a number of gunicorn worker processes, each handling requests on a pool of threads. Every
+    worker imports the API and loads its settings once, after it has been forked, and warms up before it takes any
+    requests. Batch jobs, sharded batches, the patient cache, the profiler and the metrics are held in the memory of
+    each worker, so with more than one worker a request for them only sees the worker it reaches. One worker is
+    used by default; charts and documents are still drawn on a pool of processes.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        super(PatientDocumentServer, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return create_app()
+
+
+def main():
+    data = get_config()
+    parser = argparse.ArgumentParser(description='Serves the patient document API')
+    parser.add_argument('--host', default=data.get('server_host', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=data.get('server_port', 5010))
+    parser.add_argument('--workers', type=int, default=data.get('server_workers', 1),
+                        help='number of worker processes, 0 for one per CPU core')
+    args = parser.parse_args()
+
+    if BaseApplication is object:
+        print('gunicorn is not available, serving from a single process')
+        app = create_app()
+        warm_up_worker()
+        run_simple(args.host, args.port, app, threaded=True)
+        return
+
+    max_in_flight = data.get('server_max_in_flight', 4)
+    max_queue = data.get('server_max_queue', 16)
+    # workers are forked with this copy of the settings, and size their chart pools by how many of them there are
+    data['server_processes'] = args.workers or os.cpu_count()
+    PatientDocumentServer({
+        'bind': '%s:%d' % (args.host, args.port),
+        'workers': data['server_processes'],
+        'worker_class': 'gthread',
+        # enough threads for every request being handled or queued, plus a few spare to turn away the rest
+        'threads': max_in_flight + max_queue + 2,
+        'timeout': data.get('server_timeout', 120),
+        'graceful_timeout': data.get('server_graceful_timeout', 30),
+        'post_worker_init': warm_up_worker,
+    }).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import threading
+import hashlib
+import bisect
+import uuid
+import time
+
+# header sent with requests forwarded to another node, which handles them itself rather than sharding them again
+FORWARDED_HEADER = 'X-Shard-Forwarded'
+
+
+def ring_hash(key):
+    """
+    Returns the position of a key on the hash ring, the same in every process and on every node.
+    """
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing():
+    """
+    Consistent hash ring sharing patient IDs between the nodes of the API. Each node is placed on the ring at replicas
+    points and owns the IDs hashing to just before each of them, so every node owns about the same share of patients
+    and adding or removing a node only moves the patients next to its own points. Every node must be given the same
+    list of nodes.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        """
+        :param nodes: base URL of every node, such as http://10.0.0.1:5010, including this one
+        :param replicas: number of points each node has on the ring
+        """
+        self.nodes = sorted(set(nodes))
+        self.replicas = replicas
+        points = sorted((ring_hash('%s#%d' % (node, replica)), node) for node in self.nodes
+                        for replica in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    def node_for(self, patient_id):
+        """
+        Returns the node owning a patient.
+        """
+        index = bisect.bisect(self.hashes, ring_hash(str(patient_id))) % len(self.hashes)
+        return self.owners[index]
+
+    def partition(self, patient_ids):
+        """
+        Splits a list of patient IDs between the nodes owning them, keeping their order.
+        :return: ordered dictionary mapping each node with any of the patients to its list of patient IDs
+        """
+        parts = OrderedDict()
+        for patient_id in patient_ids:
+            parts.setdefault(self.node_for(patient_id), []).append(patient_id)
+        return parts
+
+
+class PeerClient():
+    """
+    Sends requests to the other nodes over pooled connections, several nodes at a time. Every request carries
+    FORWARDED_HEADER so the node receiving it does the work itself.
+    """
+
+    def __init__(self, timeout=30, workers=8):
+        """
+        :param timeout: seconds to wait for a node to answer
+        :param workers: number of nodes sent requests at the same time
+        """
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='peers')
+        self.session = None
+        self.session_lock = threading.Lock()
+
+    def request(self, method, node, path, payload=None):
+        """
+        Sends one request to a node and returns the status code and JSON body of its answer. Raises ConnectionError
+        if the node cannot be reached.
+        """
+        import requests
+        with self.session_lock:
+            if self.session is None:
+                self.session = requests.Session()
+        try:
+            response = self.session.request(method, node + path, json=payload, timeout=self.timeout,
+                                            headers={FORWARDED_HEADER: '1'})
+            return response.status_code, response.json()
+        except (requests.RequestException, ValueError) as error:
+            raise ConnectionError('Node {} did not answer: {}'.format(node, error))
+
+    def fan_out(self, method, requests_by_node):
+        """
+        Sends a request to each of several nodes at the same time.
+        :param requests_by_node: ordered dictionary mapping each node to the path and JSON payload to send it
+        :return: ordered dictionary mapping each node to its status code and JSON body, or to the ConnectionError
+        raised if it could not be reached
+        """
+        futures = OrderedDict((node, self.pool.submit(self.request, method, node, path, payload))
+                              for node, (path, payload) in requests_by_node.items())
+        answers = OrderedDict()
+        for node, future in futures.items():
+            try:
+                answers[node] = future.result()
+            except ConnectionError as error:
+                answers[node] = error
+        return answers
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+
+class ShardedBatch():
+    """
+    A batch of health reports split between the nodes owning its patients, recording the batch job each node runs
+    its share in, or why the share could not be handed to the node.
+    """
+
+    def __init__(self, parts):
+        """
+        :param parts: ordered dictionary mapping each node to a dictionary with the job_id and total of its batch
+        job, or with the error raised handing it over and the patient_ids it was given
+        """
+        self.job_id = str(uuid.uuid4())
+        self.created = time.time()
+        # when the batch was last summarised and when it was first seen to have finished, for expiring it
+        self.checked = self.created
+        self.finished = None
+        self.parts = parts
+
+    def nodes(self):
+        """
+        Returns the job ID and number of patients of each node's share, or why it could not be handed over.
+        """
+        return OrderedDict((node, {"job_id": part["job_id"], "total": part["total"]} if "job_id" in part else
+                            {"error": part["error"], "total": len(part["patient_ids"])})
+                           for node, part in self.parts.items())
+
+    def summary(self, node_summaries, status_filter=None):
+        """
+        Combines the summaries of every node's batch job into one in the same form, with each node's progress and
+        throughput, in patients completed per second, under nodes. Patients whose node could not be given them are
+        failed, and a node that does not answer keeps the batch running.
+        :param node_summaries: dictionary mapping each node with a job to its summary, or to the ConnectionError
+        raised asking for it
+        """
+        counts = {}
+        patients = OrderedDict()
+        nodes = OrderedDict()
+        total = completed = 0
+        finished = True
+        for node, part in self.parts.items():
+            if "job_id" not in part:
+                # the patients never reached their node so they count as failed straight away
+                summary = {"state": "finished", "total": len(part["patient_ids"]),
+                           "completed": len(part["patient_ids"]), "counts": {"failed": len(part["patient_ids"])},
+                           "elapsed": 0.0,
+                           "patients": OrderedDict((patient_id, {"status": "failed", "error": part["error"]})
+                                                   for patient_id in part["patient_ids"]
+                                                   if status_filter in (None, "failed"))}
+            else:
+                summary = node_summaries.get(node)
+            if not isinstance(summary, dict) or "counts" not in summary:
+                finished = False
+                total += part["total"]
+                error = summary.get("message") if isinstance(summary, dict) else summary
+                nodes[node] = {"state": "unknown", "total": part["total"], "completed": 0, "throughput": 0.0,
+                               "error": str(error)}
+                continue
+
+            for status, count in summary["counts"].items():
+                counts[status] = counts.get(status, 0) + count
+            patients.update(summary["patients"])
+            total += summary["total"]
+            completed += summary["completed"]
+            finished = finished and summary["state"] == "finished"
+            nodes[node] = {"state": summary["state"], "total": summary["total"], "completed": summary["completed"],
+                           "elapsed": summary["elapsed"],
+                           "throughput": summary["completed"] / summary["elapsed"] if summary["elapsed"] else 0.0}
+            if "error" in part:
+                nodes[node]["error"] = part["error"]
+
+        self.checked = time.time()
+        if finished and self.finished is None:
+            self.finished = self.checked
+        # every node starts its share as the batch is created, so a finished batch took as long as its slowest node
+        if finished:
+            elapsed = max([node["elapsed"] for node in nodes.values()] or [0.0])
+        else:
+            elapsed = time.time() - self.created
+        return {"job_id": self.job_id,
+                "state": "finished" if finished else "running",
+                "total": total,
+                "completed": completed,
+                "progress": completed / total if total else 1.0,
+                "counts": counts,
+                "elapsed": elapsed,
+                "throughput": completed / elapsed if elapsed else 0.0,
+                "nodes": nodes,
+                "patients": patients}
@@ -0,0 +1,169 @@
+from datetime import timezone
+from dateutil.parser import isoparse
+import numpy as np
+
+# numpy counts weeks from the epoch, a Thursday, so dates are shifted by this much to make weeks start on a Monday
+WEEK_OFFSET = np.timedelta64(3, 'D')
+
+
+def to_epoch_milliseconds(dates):
+    """
+    Converts a list of datetimes to milliseconds since the epoch. Datetimes without a timezone are taken to be UTC.
+    """
+    return np.fromiter(((date if date.tzinfo is not None else date.replace(tzinfo=timezone.utc)).timestamp() * 1000
+                        for date in dates), dtype=np.float64, count=len(dates))
+
+
+class VitalSignSeries():
+    """
+    Readings of a single vital sign stored as a pair of numpy arrays, datetime64 dates and float values, sorted by
+    date. Missing readings are stored as NaN. Shared by the JSON endpoints and the chart renderer so dates never need
+    to be formatted and parsed back again between the two.
+    """
+    __slots__ = ('dates', 'values', 'unit')
+
+    def __init__(self, dates, values, unit):
+        self.dates = np.asarray(dates, dtype='datetime64[ms]')
+        self.values = np.asarray(values, dtype=np.float64)
+        self.unit = unit or ""
+
+    @classmethod
+    def from_lists(cls, dates, values, unit):
+        """
+        Creates a series from the lists of datetimes and values extracted from a patient's observations.
+        """
+        milliseconds = to_epoch_milliseconds(dates).astype(np.int64)
+        values = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+        order = np.argsort(milliseconds, kind='stable')
+        return cls(milliseconds[order].view('datetime64[ms]'), values[order], unit)
+
+    @classmethod
+    def from_json(cls, entry):
+        """
+        Creates a series from the dictionary of Dates, Values and Unit returned by the rawData endpoint.
+        """
+        return cls.from_lists([isoparse(date) for date in entry['Dates']], entry['Values'], entry['Unit'])
+
+    def __len__(self):
+        return len(self.dates)
+
+    def to_json(self):
+        """
+        Creates the dictionary of Dates, Values and Unit returned by the endpoints. Dates are ISO 8601 strings in UTC
+        and missing readings are None.
+        """
+        whole_seconds = not np.any(self.dates.astype(np.int64) % 1000)
+        dates = np.datetime_as_string(self.dates, unit='s' if whole_seconds else 'ms', timezone='UTC')
+        values = np.where(np.isnan(self.values), None, self.values)
+        return {"Dates": dates.tolist(), "Values": values.tolist(), "Unit": self.unit}
+
+    def to_columns(self):
+        """
+        Creates a compact dictionary of the series for binary formats such as MessagePack. Dates are packed as
+        little-endian int64 milliseconds since the epoch and Values as little-endian float64, with NaN for missing
+        readings, so a client can load each column straight into an array.
+        """
+        return {"Dates": self.dates.astype('<i8').tobytes(), "Values": self.values.astype('<f8').tobytes(),
+                "Unit": self.unit}
+
+    def extend(self, other):
+        """
+        Returns a new series holding the readings of both series, sorted by date.
+        """
+        dates = np.concatenate((self.dates, other.dates))
+        values = np.concatenate((self.values, other.values))
+        order = np.argsort(dates, kind='stable')
+        return VitalSignSeries(dates[order], values[order], self.unit or other.unit)
+
+    def between(self, since=None, until=None):
+        """
+        Returns the part of the series between two dates, either of which may be left out.
+        """
+        keep = np.ones(len(self.dates), dtype=bool)
+        if since is not None:
+            keep &= self.dates >= np.datetime64(since, 'ms')
+        if until is not None:
+            keep &= self.dates <= np.datetime64(until, 'ms')
+        return VitalSignSeries(self.dates[keep], self.values[keep], self.unit)
+
+    def resample(self, frequency='D', how='mean'):
+        """
+        Aggregates the readings into one value per period, dated at the start of the period.
+        :param frequency: numpy datetime unit of each period, for example 'h', 'D', 'W' or 'M'. Weeks start on Monday.
+        :param how: 'mean', 'min' or 'max' of the readings in each period
+        """
+        valid = ~np.isnan(self.values)
+        dates = self.dates[valid]
+        values = self.values[valid]
+        if frequency == 'W':
+            periods = (dates + WEEK_OFFSET).astype('datetime64[W]').astype('datetime64[ms]') - WEEK_OFFSET
+        else:
+            periods = dates.astype('datetime64[' + frequency + ']').astype('datetime64[ms]')
+        starts, inverse = np.unique(periods, return_inverse=True)
+
+        if how == 'mean':
+            aggregated = np.bincount(inverse, weights=values, minlength=len(starts)) / np.bincount(inverse)
+        elif how in ('min', 'max'):
+            aggregated = np.full(len(starts), np.inf if how == 'min' else -np.inf)
+            (np.minimum if how == 'min' else np.maximum).at(aggregated, inverse, values)
+        else:
+            raise ValueError('Unknown aggregation ' + how)
+        return VitalSignSeries(starts, aggregated, self.unit)
+
+    def envelope(self, threshold):
+        """
+        Downsamples the series to at most threshold points by splitting it into threshold // 2 stretches of equal
+        numbers of readings and keeping the lowest and highest reading of each, in date order. Unlike averaging this
+        keeps every spike, and every step is a whole array operation so it stays fast on very long series.
+        """
+        valid = ~np.isnan(self.values)
+        dates = self.dates[valid]
+        values = self.values[valid]
+        buckets = threshold // 2
+        if threshold >= len(dates) or buckets < 1:
+            return VitalSignSeries(dates, values, self.unit)
+
+        starts = np.linspace(0, len(values), buckets + 1).astype(np.int64)[:-1]
+        bucket_of = np.repeat(np.arange(buckets), np.diff(np.append(starts, len(values))))
+        selected = []
+        for extreme in (np.minimum, np.maximum):
+            # the first reading in each stretch equal to the stretch's extreme
+            matches = np.flatnonzero(values == extreme.reduceat(values, starts)[bucket_of])
+            selected.append(matches[np.unique(bucket_of[matches], return_index=True)[1]])
+        selected = np.unique(np.concatenate(selected))
+        return VitalSignSeries(dates[selected], values[selected], self.unit)
+
+    def lttb(self, threshold):
+        """
+        Downsamples the series to at most threshold points with the Largest-Triangle-Three-Buckets algorithm, which
+        keeps the points that matter most to the shape of a chart. The first and last readings are always kept.
+        """
+        valid = ~np.isnan(self.values)
+        dates = self.dates[valid]
+        values = self.values[valid]
+        if threshold >= len(dates) or threshold < 3:
+            return VitalSignSeries(dates, values, self.unit)
+
+        x = dates.astype(np.int64).astype(np.float64)
+        # every point apart from the first and last falls into one of threshold - 2 buckets
+        edges = np.linspace(1, len(x) - 1, threshold - 1).astype(np.int64)
+        selected = np.empty(threshold, dtype=np.int64)
+        selected[0] = 0
+        selected[-1] = len(x) - 1
+        for bucket in range(threshold - 2):
+            start, end = edges[bucket], edges[bucket + 1]
+            next_start, next_end = end, edges[bucket + 2] if bucket + 2 < len(edges) else len(x)
+            average_x = x[next_start:next_end].mean()
+            average_y = values[next_start:next_end].mean()
+            previous = selected[bucket]
+            areas = np.abs((x[previous] - average_x) * (values[start:end] - values[previous])
+                           - (x[previous] - x[start:end]) * (average_y - values[previous]))
+            selected[bucket + 1] = start + np.argmax(areas)
+        return VitalSignSeries(dates[selected], values[selected], self.unit)
+
+
+def as_series(entry):
+    """
+    Returns entry as a VitalSignSeries, converting it first if it is a dictionary of Dates, Values and Unit.
+    """
+    return entry if isinstance(entry, VitalSignSeries) else VitalSignSeries.from_json(entry)
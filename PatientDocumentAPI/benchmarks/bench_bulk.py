@@ -0,0 +1,66 @@
+from synthetic import API_DIR
+from stub_fhir import start_stub_server
+from BulkData import BulkDataStore
+from fhir_parser.fhir import FHIR
+import tracemalloc
+import tempfile
+import argparse
+import time
+import os
+
+
+def fetch_cohort(client, patient_ids):
+    """
+    Fetches every patient of a cohort and their observations one patient at a time.
+    :return: seconds taken and the total number of observations fetched
+    """
+    start = time.perf_counter()
+    observations = 0
+    for patient_id in patient_ids:
+        client.get_patient(patient_id)
+        observations += len(client.get_patient_observations(patient_id))
+    return time.perf_counter() - start, observations
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares fetching a whole cohort from the FHIR server one patient at '
+                                                 'a time with ingesting a bulk export once and reading the cohort '
+                                                 'from the bulk data store.')
+    parser.add_argument('--patients', type=int, default=200)
+    parser.add_argument('--observations', type=int, default=500, help='observations per patient')
+    args = parser.parse_args()
+
+    stub = start_stub_server(patients=args.patients, observations=args.observations)
+    endpoint = 'http://127.0.0.1:%d/api/' % stub.server_address[1]
+    patient_ids = [str(index) for index in range(args.patients)]
+    os.chdir(API_DIR)
+
+    seconds, observations = fetch_cohort(FHIR(endpoint, verify_ssl=False), patient_ids)
+    print('%-34s %9.2fs  %8.0f observations/s' % ('per patient requests to FHIR', seconds, observations / seconds))
+
+    store = BulkDataStore(os.path.join(tempfile.mkdtemp(), 'bulk_data.sqlite3'))
+    start = time.perf_counter()
+    counts = store.ingest_export(endpoint)
+    seconds = time.perf_counter() - start
+    print('%-34s %9.2fs  %8.0f resources/s' % ('bulk export ingested', seconds,
+                                                (counts["patients"] + counts["observations"]) / seconds))
+
+    # ingesting again under tracemalloc shows memory does not grow with the size of the export
+    store.clear()
+    tracemalloc.start()
+    store.ingest_export(endpoint)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print('%-34s %9.1fMB for %d resources' % ('peak memory while ingesting', peak / 1024 / 1024,
+                                              counts["patients"] + counts["observations"]))
+
+    # the stub is stopped so any request the store made to FHIR would fail
+    stub.shutdown()
+    stub.server_close()
+    seconds, observations = fetch_cohort(store, patient_ids)
+    print('%-34s %9.2fs  %8.0f observations/s' % ('cohort read from the bulk store', seconds, observations / seconds))
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+from synthetic import make_health_data, HISTORY_SIZES
+from ChartRenderer import ChartRenderer
+from GenerateDocuments import PatientHealthForm
+from VitalSeries import as_series
+import argparse
+import time
+
+
+def render_report(renderer, patient_data):
+    """
+    Draws every chart of a health report with renderer and builds the report around them.
+    :return: seconds spent drawing each chart, bytes of each chart and bytes of the finished .docx
+    """
+    seconds = []
+    charts = {}
+    for vital_sign, series in patient_data.items():
+        start = time.perf_counter()
+        charts[vital_sign] = renderer.render_series(vital_sign, series)
+        seconds.append(time.perf_counter() - start)
+    document = PatientHealthForm('synthetic', 'Synthetic Patient', patient_data, charts).generate_patient_data_form()
+    return seconds, [len(chart) for chart in charts.values()], len(document.getvalue())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the time taken to draw health report charts and the size '
+                                                 'of the reports with every reading drawn against the chart '
+                                                 'settings given.')
+    parser.add_argument('--histories', nargs='+', choices=sorted(HISTORY_SIZES), default=['small', 'typical', 'long'],
+                        help='readings per vital sign to measure, named after the benchmark history sizes')
+    parser.add_argument('--dpi', type=int, default=100)
+    parser.add_argument('--format', choices=('png', 'jpeg'), default='png')
+    parser.add_argument('--max-points', type=int, default=2000)
+    parser.add_argument('--downsample', choices=('minmax', 'lttb'), default='minmax')
+    parser.add_argument('--max-bytes', type=int, default=262144)
+    args = parser.parse_args()
+
+    policies = [('before', ChartRenderer(max_points=0)),
+                ('after', ChartRenderer(dpi=args.dpi, image_format=args.format, max_points=args.max_points,
+                                        downsample=args.downsample, max_bytes=args.max_bytes))]
+
+    print('%-8s %-7s %8s %13s %13s %13s %11s' % ('history', 'policy', 'points', 'mean chart ms', 'max chart ms',
+                                                 'max chart KB', 'report KB'))
+    for history in args.histories:
+        points = HISTORY_SIZES[history]
+        patient_data = {vital_sign: as_series(entry) for vital_sign, entry in make_health_data(points).items()}
+        for name, renderer in policies:
+            render_report(renderer, patient_data)
+            seconds, chart_sizes, report_size = render_report(renderer, patient_data)
+            print('%-8s %-7s %8d %13.1f %13.1f %13.1f %11.1f'
+                  % (history, name, points, 1000 * sum(seconds) / len(seconds), 1000 * max(seconds),
+                     max(chart_sizes) / 1024, report_size / 1024))
+
+
+if __name__ == '__main__':
+    main()
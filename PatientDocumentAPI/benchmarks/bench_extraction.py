@@ -0,0 +1,59 @@
+from synthetic import make_observations, VITAL_SIGNS, API_DIR
+import argparse
+import time
+import os
+
+
+def scan_per_sign(observations, signs):
+    """
+    The original extraction, scanning every observation once for each vital sign, kept for comparison.
+    """
+    result = {}
+    for sign in signs:
+        date, value, unit = [], [], ""
+        for observation in observations:
+            if observation.type != "vital-signs":
+                continue
+            for component in observation.components:
+                if component.display == sign:
+                    date.append(observation.issued_datetime)
+                    value.append(component.value)
+                    unit = component.unit
+        result[sign] = (date, value, unit)
+    return result
+
+
+def best_time(function, repeats):
+    """
+    Returns the fastest of several runs of function, in seconds.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares vital sign extraction over growing observation counts.')
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000',
+                        help='comma separated observation counts to benchmark')
+    parser.add_argument('--repeats', type=int, default=3, help='runs per size, the fastest is reported')
+    args = parser.parse_args()
+
+    os.chdir(API_DIR)
+    from FormAPI import extract_vital_signs
+
+    signs = [display for display, code, unit, low, high in VITAL_SIGNS]
+    print('%10s %14s %14s %8s' % ('obs', 'per sign (s)', 'single (s)', 'speedup'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        observations = make_observations('benchmark', size)
+        assert scan_per_sign(observations, signs) == extract_vital_signs(observations, signs)
+        old = best_time(lambda: scan_per_sign(observations, signs), args.repeats)
+        new = best_time(lambda: extract_vital_signs(observations, signs), args.repeats)
+        print('%10d %14.4f %14.4f %7.1fx' % (size, old, new, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+from synthetic import make_patient, make_health_data, HISTORY_SIZES, API_DIR
+from bench_suite import configure_api
+from VitalSeries import as_series
+from ResponseEncoding import brotli, msgpack, pack, compressor
+import tempfile
+import argparse
+import time
+import json
+import os
+
+
+def serialise_time(function, count):
+    """
+    Calls function count times after one warm-up call and returns the mean milliseconds per call and its result.
+    """
+    result = function()
+    start = time.perf_counter()
+    for _ in range(count):
+        function()
+    return 1000 * (time.perf_counter() - start) / count, result
+
+
+def compress(data, encoding):
+    compress_chunk, _, finish = compressor(encoding)
+    return compress_chunk(data) + finish()
+
+
+def encodings():
+    """
+    Returns the ways a payload can be sent, each a name, a serialiser and a content encoding or None.
+    """
+    formats = [('json', lambda payload: json.dumps(payload).encode('utf-8'))]
+    if msgpack is not None:
+        formats.append(('msgpack', pack))
+    for name, serialise in formats:
+        yield name, serialise, None
+        yield name + '+gzip', serialise, 'gzip'
+        if brotli is not None:
+            yield name + '+br', serialise, 'br'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the size and serialisation time of the rawData and '
+                                                 'feedbackDocumentData payloads in each format and encoding.')
+    parser.add_argument('--count', type=int, default=20, help='number of timed serialisations per case')
+    parser.add_argument('--histories', nargs='+', choices=sorted(HISTORY_SIZES), default=['small', 'typical', 'long'],
+                        help='readings per vital sign to measure, named after the benchmark history sizes')
+    args = parser.parse_args()
+
+    configure_api('http://127.0.0.1:1/api/', tempfile.mkdtemp(), False, 1)
+    os.chdir(API_DIR)
+    import FormAPI
+
+    print('%-8s %-22s %-14s %10s %13s' % ('payload', 'history', 'encoding', 'bytes', 'serialise ms'))
+    for history in args.histories:
+        health_data = make_health_data(HISTORY_SIZES[history])
+        series = {vital_sign: as_series(entry) for vital_sign, entry in health_data.items()}
+        for name, serialise, encoding in encodings():
+            if name.startswith('msgpack'):
+                build = lambda: {vital_sign: entry.to_columns() for vital_sign, entry in series.items()}
+            else:
+                build = lambda: {vital_sign: entry.to_json() for vital_sign, entry in series.items()}
+            milliseconds, data = serialise_time(lambda: compress(serialise(build()), encoding) if encoding
+                                                else serialise(build()), args.count)
+            print('%-8s %-22s %-14s %10d %13.2f' % ('rawData', history, name, len(data), milliseconds))
+
+    feedback_data = dict(FormAPI.generate_feedback_data(make_patient(1)).to_json(),
+                         questions_version=FormAPI.FEEDBACK_QUESTIONS_VERSION)
+    referenced = {key: value for key, value in feedback_data.items() if key != 'questions_and_messages'}
+    for questions, payload in (('questions inline', feedback_data), ('questions by version', referenced)):
+        for name, serialise, encoding in encodings():
+            milliseconds, data = serialise_time(lambda: compress(serialise(payload), encoding) if encoding
+                                                else serialise(payload), args.count)
+            print('%-8s %-22s %-14s %10d %13.3f' % ('feedback', questions, name, len(data), milliseconds))
+    FormAPI.job_queue.stop()
+
+
+if __name__ == '__main__':
+    main()
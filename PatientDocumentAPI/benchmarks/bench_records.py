@@ -0,0 +1,84 @@
+from synthetic import make_patient, API_DIR
+from bench_suite import configure_api
+from DataRetrieval import get_patient_name_data, get_patient_address_data, get_feedback_text
+import tracemalloc
+import tempfile
+import argparse
+import time
+import json
+import os
+
+
+def dict_feedback_data(patient, questions):
+    """
+    Builds the nested dictionaries feedback data was held in before it was held in records, for comparison.
+    """
+    address = {"address_lines": patient.addresses[0].lines, "city": patient.addresses[0].city,
+               "state": patient.addresses[0].state, "postcode": patient.addresses[0].postal_code,
+               "country": patient.addresses[0].country}
+    name = {"prefix": patient.name.prefix, "first_name": patient.name.given, "last_name": patient.name.family}
+    return {"name": name, "address": address, "questions_and_messages": dict(questions)}
+
+
+def dict_lookups(feedback_data):
+    name = feedback_data["name"]
+    address = feedback_data["address"]
+    text = feedback_data["questions_and_messages"]
+    return (name["prefix"], name["first_name"], name["last_name"], address["address_lines"], address["city"],
+            address["state"], address["postcode"], address["country"], text["intro"], text["recommendation"],
+            text["comment"], text["hospital"], text["clinic"])
+
+
+def record_lookups(feedback_data):
+    return get_patient_name_data(feedback_data) + get_patient_address_data(feedback_data) + \
+        get_feedback_text(feedback_data)
+
+
+def build_memory(build, patients):
+    """
+    Builds feedback data for every patient and returns it with the bytes allocated per patient to hold it.
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    built = [build(patient) for patient in patients]
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return built, allocated / len(patients)
+
+
+def rate(function, items):
+    """
+    Calls function on every item and returns the calls per second.
+    """
+    start = time.perf_counter()
+    for item in items:
+        function(item)
+    return len(items) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the memory and speed of feedback data held in records '
+                                                 'with the nested dictionaries it used to be held in.')
+    parser.add_argument('--patients', type=int, default=20000, help='number of synthetic patients')
+    args = parser.parse_args()
+
+    configure_api('http://127.0.0.1:1/api/', tempfile.mkdtemp(), False, 1)
+    os.chdir(API_DIR)
+    import FormAPI
+
+    patients = [make_patient(index) for index in range(args.patients)]
+    versions = [('dicts', lambda patient: dict_feedback_data(patient, FormAPI.FEEDBACK_QUESTIONS), dict_lookups,
+                 lambda feedback_data: json.dumps(feedback_data)),
+                ('records', FormAPI.generate_feedback_data, record_lookups,
+                 lambda feedback_data: json.dumps(feedback_data.to_json()))]
+
+    print('%-8s %14s %12s %13s %11s' % ('version', 'bytes/patient', 'builds/s', 'lookups/s', 'json/s'))
+    for name, build, lookups, serialise in versions:
+        built, per_patient = build_memory(build, patients)
+        print('%-8s %14.0f %12.0f %13.0f %11.0f' % (name, per_patient, rate(build, patients), rate(lookups, built),
+                                                     rate(serialise, built)))
+    FormAPI.job_queue.stop()
+
+
+if __name__ == '__main__':
+    main()
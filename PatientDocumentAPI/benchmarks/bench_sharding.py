@@ -0,0 +1,107 @@
+from synthetic import API_DIR
+from stub_fhir import start_stub_server
+from bench_suite import configure_api
+import subprocess
+import argparse
+import tempfile
+import requests
+import socket
+import json
+import time
+import sys
+import os
+
+
+def free_port():
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        return listener.getsockname()[1]
+
+
+def start_nodes(count, blob_root, workers, render_workers):
+    """
+    Starts count API nodes in sharding mode, each a server of its own with its own job queue, sharing the stub FHIR
+    server and a local blob store, and waits until every node answers.
+    :return: list of the base URL and process of each node
+    """
+    ports = [free_port() for _ in range(count)]
+    urls = ['http://127.0.0.1:%d' % port for port in ports]
+    nodes = []
+    for url, port in zip(urls, ports):
+        environment = dict(os.environ)
+        overrides = {'shard_nodes': urls if count > 1 else [], 'shard_self': url if count > 1 else '',
+                     'server_warm_up': False, 'server_max_in_flight': 8, 'render_workers': render_workers,
+                     'job_queue_path': os.path.join(blob_root, 'jobs %d.sqlite3' % port)}
+        for key, value in overrides.items():
+            environment['PATIENT_DOCUMENT_API_' + key.upper()] = json.dumps(value)
+        process = subprocess.Popen([sys.executable, 'Server.py', '--port', str(port), '--workers', str(workers)],
+                                   cwd=API_DIR, env=environment, stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL)
+        nodes.append((url, process))
+
+    deadline = time.monotonic() + 60
+    for url, process in nodes:
+        while True:
+            try:
+                requests.get(url + '/metrics', timeout=1)
+                break
+            except requests.RequestException:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    raise RuntimeError('Node %s did not start' % url)
+                time.sleep(0.2)
+    return nodes
+
+
+def run_batch(url, patient_ids):
+    """
+    Starts a batch of health reports on one node and waits for every node to finish its share.
+    :return: the final summary of the batch
+    """
+    job = requests.post(url + '/batch/healthReports', json={'ids': patient_ids}).json()
+    while True:
+        summary = requests.get(url + job['status_url']).json()
+        if summary['state'] == 'finished':
+            return summary
+        time.sleep(0.25)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs one batch of health reports on clusters of 1 up to --nodes '
+                                                 'sharded API nodes and reports the throughput of each node and how '
+                                                 'close the whole cluster comes to scaling linearly.')
+    parser.add_argument('--nodes', type=int, default=3, help='largest number of nodes to run')
+    parser.add_argument('--patients', type=int, default=60)
+    parser.add_argument('--observations', type=int, default=500, help='observations per patient')
+    parser.add_argument('--workers', type=int, default=1, help='server worker processes per node')
+    parser.add_argument('--render-workers', type=int, default=1, help='chart processes per node')
+    args = parser.parse_args()
+
+    stub = start_stub_server(patients=args.patients, observations=args.observations)
+    patient_ids = [str(index) for index in range(args.patients)]
+    base_throughput = None
+    print('%-6s %-24s %9s %10s %11s %11s' % ('nodes', 'node', 'patients', 'elapsed s', 'patients/s', 'efficiency'))
+    for count in range(1, args.nodes + 1):
+        blob_root = tempfile.mkdtemp()
+        configure_api('http://127.0.0.1:%d/api/' % stub.server_address[1], blob_root, False, args.render_workers)
+        nodes = start_nodes(count, blob_root, args.workers, args.render_workers)
+        try:
+            summary = run_batch(nodes[0][0], patient_ids)
+        finally:
+            for _, process in nodes:
+                process.terminate()
+                process.wait()
+
+        failed = summary['counts'].get('failed', 0)
+        if failed:
+            raise RuntimeError('%d patients failed: %s' % (failed, list(summary['patients'].items())[:3]))
+        for node, progress in summary.get('nodes', {}).items():
+            print('%-6s %-24s %9d %10.2f %11.2f' % ('', node, progress['completed'], progress['elapsed'],
+                                                    progress['throughput']))
+        throughput = summary['completed'] / summary['elapsed']
+        base_throughput = base_throughput or throughput
+        print('%-6d %-24s %9d %10.2f %11.2f %10.0f%%' % (count, 'cluster', summary['completed'], summary['elapsed'],
+                                                          throughput, 100 * throughput / (base_throughput * count)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+from synthetic import API_DIR
+from stub_fhir import start_stub_server
+from bench_suite import configure_api, percentile
+import subprocess
+import argparse
+import tempfile
+import json
+import sys
+import os
+
+# first request each worker answers, a data endpoint that never needs python-docx or matplotlib and a document one
+FIRST_REQUESTS = {'data': '/FormFiller/feedbackDocumentData?id=1',
+                  'document': '/FormFiller/feedback?force=true&id=1'}
+
+# run in a fresh interpreter: imports the API, answers one request and reports how long each step took
+WORKER_SCRIPT = '''
+import time
+start = time.perf_counter()
+import json, sys
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+
+import FormAPI
+imported = time.perf_counter()
+idle_rss = rss_mb()
+response = FormAPI.app.test_client().get(sys.argv[1], json={})
+answered = time.perf_counter()
+FormAPI.job_queue.stop()
+print(json.dumps({"status": response.status_code, "import_ms": 1000 * (imported - start),
+                  "first_request_ms": 1000 * (answered - imported), "ready_ms": 1000 * (answered - start),
+                  "idle_rss_mb": idle_rss, "rss_after_request_mb": rss_mb()}))
+'''
+
+
+def run_worker(path, importtime=False):
+    """
+    Starts a new interpreter that imports the API and answers one request.
+    :return: dictionary of its timings and memory use, and the -X importtime report if asked for
+    """
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', WORKER_SCRIPT, path]
+    process = subprocess.run(command, cwd=API_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+                             universal_newlines=True)
+    return json.loads(process.stdout.strip().splitlines()[-1]), process.stderr
+
+
+def slowest_imports(report, count):
+    """
+    Returns the modules imported directly by FormAPI, or by nothing else first, that took longest including
+    everything they imported.
+    """
+    imports = []
+    for line in report.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # top level imports and those made directly by FormAPI are indented by at most three spaces
+        if len(name) - len(name.lstrip()) <= 3:
+            imports.append((int(cumulative) / 1000, name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures how long a new API worker takes to import the API and '
+                                                 'answer its first request, and its memory use when idle.')
+    parser.add_argument('--runs', type=int, default=5, help='number of fresh interpreters started per request')
+    parser.add_argument('--top', type=int, default=15, help='number of slowest imports listed')
+    parser.add_argument('--target-first-request-ms', type=float, default=800,
+                        help='target for the p50 time from interpreter start to the first data response')
+    parser.add_argument('--target-idle-rss-mb', type=float, default=80,
+                        help='target for the p50 resident memory of a worker that has imported the API')
+    args = parser.parse_args()
+
+    stub = start_stub_server(patients=5, observations=100)
+    configure_api('http://127.0.0.1:%d/api/' % stub.server_address[1], tempfile.mkdtemp(), False, 1)
+    os.environ['PATIENT_DOCUMENT_API_JOB_QUEUE_PATH'] = json.dumps(os.path.join(tempfile.mkdtemp(), 'jobs.sqlite3'))
+
+    _, report = run_worker(FIRST_REQUESTS['data'], importtime=True)
+    print('%10s  %s' % ('cumulative', 'slowest imports of FormAPI'))
+    for milliseconds, name in slowest_imports(report, args.top):
+        print('%8.1fms  %s' % (milliseconds, name))
+
+    print()
+    print('%-9s %10s %12s %10s %10s %14s' % ('request', 'import ms', 'request ms', 'ready ms', 'idle RSS',
+                                             'RSS after req'))
+    summary = {}
+    for name, path in FIRST_REQUESTS.items():
+        runs = [run_worker(path)[0] for _ in range(args.runs)]
+        if any(run["status"] != 200 for run in runs):
+            raise RuntimeError('%s answered %s' % (path, [run["status"] for run in runs]))
+        summary[name] = {key: percentile(sorted(run[key] for run in runs), 0.5)
+                         for key in ('import_ms', 'first_request_ms', 'ready_ms', 'idle_rss_mb',
+                                     'rss_after_request_mb')}
+        result = summary[name]
+        print('%-9s %10.1f %12.1f %10.1f %9.1fMB %12.1fMB'
+              % (name, result["import_ms"], result["first_request_ms"], result["ready_ms"], result["idle_rss_mb"],
+                 result["rss_after_request_mb"]))
+
+    print()
+    checks = [('time to first data request', summary['data']['ready_ms'], args.target_first_request_ms, 'ms'),
+              ('idle RSS', summary['data']['idle_rss_mb'], args.target_idle_rss_mb, 'MB')]
+    failed = False
+    for label, value, target, unit in checks:
+        passed = value <= target
+        failed = failed or not passed
+        print('%-28s %8.1f%s  target %8.1f%s  %s' % (label, value, unit, target, unit, 'ok' if passed else 'MISSED'))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+from synthetic import make_patient, make_observations, HISTORY_SIZES, API_DIR
+from stub_fhir import start_stub_server
+import subprocess
+import tracemalloc
+import argparse
+import platform
+import tempfile
+import time
+import json
+import sys
+import os
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, where peak RSS is not reported
+    resource = None
+
+ENDPOINTS = [('feedback', '/FormFiller/feedback?force=true&id='),
+             ('details', '/info/infoDocument?force=true&id='),
+             ('health', '/report/patientReport?force=true&id='),
+             ('rawData', '/report/rawData?id=')]
+
+
+def configure_api(fhir_endpoint, blob_root, templates, render_workers):
+    """
+    Points the API at the stub FHIR server and a local blob store through environment overrides. Must be called
+    before FormAPI is imported.
+    """
+    overrides = {'fhir_endpoint': fhir_endpoint, 'blob_backend': 'local', 'blob_local_root': blob_root,
+                 'feedback_container_name': 'feedback', 'health_data_container_name': 'health',
+                 'patient_info_container_name': 'info', 'use_document_templates': templates,
+                 'render_workers': render_workers, 'incremental_health_reports': False}
+    for key, value in overrides.items():
+        os.environ['PATIENT_DOCUMENT_API_' + key.upper()] = json.dumps(value)
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of this process so far in megabytes, or None where it cannot be measured.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on macOS and kilobytes everywhere else
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def percentile(sorted_values, fraction):
+    """
+    Returns the value at the given fraction of a sorted list using the nearest rank method.
+    """
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def measure(kind, name, history, function, count, allocation_count):
+    """
+    Times count calls of function after one warm-up call, then traces the memory allocated by a few more calls.
+    :return: dictionary of the results for one generator or endpoint
+    """
+    function()
+    latencies = []
+    start = time.perf_counter()
+    for index in range(count):
+        call_start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - call_start)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for index in range(allocation_count):
+        function()
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    statistics = after.compare_to(before, 'filename')
+
+    return {"kind": kind, "name": name, "history": history, "count": count,
+            "docs_per_second": count / elapsed,
+            "latency_ms": {"mean": 1000 * elapsed / count, "p50": 1000 * percentile(latencies, 0.50),
+                           "p95": 1000 * percentile(latencies, 0.95), "p99": 1000 * percentile(latencies, 0.99)},
+            "peak_rss_mb": peak_rss_mb(),
+            "allocations": {"traced_calls": allocation_count, "peak_kb": peak / 1024,
+                            "blocks_per_call": sum(stat.count_diff for stat in statistics if stat.count_diff > 0)
+                            / max(allocation_count, 1)}}
+
+
+def generator_cases(FormAPI, history_sizes):
+    """
+    Returns the generators to measure, calling the form classes the API is configured to use directly.
+    """
+    patient = make_patient(1)
+    feedback_data = FormAPI.generate_feedback_data(patient)
+    cases = [('feedback', None, lambda: FormAPI.document_class('feedback')(patient.uuid, feedback_data)
+              .generate_feedback_form()),
+             ('details', None, lambda: FormAPI.document_class('details')(patient).generate_patient_info_form())]
+    for history, size in history_sizes:
+        patient_data = FormAPI.get_health_data(make_observations(patient.uuid, size))
+        cases.append(('health', history,
+                      lambda patient_data=patient_data: FormAPI.document_class('health')(patient.uuid,
+                                                                                         patient.full_name(),
+                                                                                         patient_data)
+                      .generate_patient_data_form()))
+    return cases
+
+
+def endpoint_cases(FormAPI, history, patients):
+    """
+    Returns the endpoints to measure against one stub FHIR server. Every call asks for a different patient and the
+    FHIR cache is cleared first, so each call pays for fetching from FHIR, rendering and uploading.
+    """
+    client = FormAPI.app.test_client()
+    calls = {"count": 0}
+
+    def call(path):
+        calls["count"] += 1
+        FormAPI.fhir_client.invalidate()
+        response = client.get(path + str(calls["count"] % patients), json={})
+        if response.status_code != 200:
+            raise RuntimeError('%s answered %d: %s' % (path, response.status_code, response.get_data(as_text=True)))
+
+    return [(name, history, lambda path=path: call(path)) for name, path in ENDPOINTS]
+
+
+def git_commit():
+    """
+    Returns the hash of the commit being benchmarked, or None outside a git checkout.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=API_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous_path):
+    """
+    Prints the change in docs/sec and p95 latency of every case also found in an earlier results file.
+    """
+    with open(previous_path) as previous_file:
+        previous = {(entry["kind"], entry["name"], entry["history"]): entry
+                    for entry in json.load(previous_file)["results"]}
+    print()
+    print('%-9s %-9s %-8s %12s %12s' % ('kind', 'name', 'history', 'docs/s', 'p95'))
+    for entry in results:
+        old = previous.get((entry["kind"], entry["name"], entry["history"]))
+        if old is not None:
+            print('%-9s %-9s %-8s %+11.1f%% %+11.1f%%'
+                  % (entry["kind"], entry["name"], entry["history"] or '-',
+                     100 * (entry["docs_per_second"] / old["docs_per_second"] - 1),
+                     100 * (entry["latency_ms"]["p95"] / old["latency_ms"]["p95"] - 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the document generators and the endpoints wrapping them '
+                                                 'against a stub FHIR server and a local blob store.')
+    parser.add_argument('--count', type=int, default=20, help='number of timed calls per case')
+    parser.add_argument('--allocation-count', type=int, default=3,
+                        help='number of calls traced for allocations per case')
+    parser.add_argument('--histories', nargs='+', choices=sorted(HISTORY_SIZES), default=['small', 'typical', 'long'],
+                        help='observation history sizes to measure')
+    parser.add_argument('--patients', type=int, default=20, help='number of patients served by each stub')
+    parser.add_argument('--templates', action='store_true', help='use the document templates instead of builders')
+    parser.add_argument('--render-workers', type=int, default=2, help='chart worker processes used by the API')
+    parser.add_argument('--skip-endpoints', action='store_true', help='only measure the generators')
+    parser.add_argument('--output', default='benchmark_results.json', help='file the results are written to')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+    history_sizes = [(history, HISTORY_SIZES[history]) for history in args.histories]
+
+    stubs = {history: start_stub_server(patients=args.patients, observations=size) for history, size in history_sizes}
+    first_stub = stubs[history_sizes[0][0]]
+    configure_api('http://127.0.0.1:%d/api/' % first_stub.server_address[1], tempfile.mkdtemp(), args.templates,
+                  args.render_workers)
+    os.chdir(API_DIR)
+    import FormAPI
+
+    results = []
+    for name, history, function in generator_cases(FormAPI, history_sizes):
+        results.append(measure('generator', name, history, function, args.count, args.allocation_count))
+        print('generator %-9s %-8s %8.1f doc/s' % (name, history or '-', results[-1]["docs_per_second"]))
+
+    if not args.skip_endpoints:
+        for history, _ in history_sizes:
+            FormAPI.fhir.endpoint = 'http://127.0.0.1:%d/api/' % stubs[history].server_address[1]
+            for name, _, function in endpoint_cases(FormAPI, history, args.patients):
+                results.append(measure('endpoint', name, history, function, args.count, args.allocation_count))
+                print('endpoint  %-9s %-8s %8.1f req/s' % (name, history, results[-1]["docs_per_second"]))
+
+    print()
+    print('%-9s %-9s %-8s %9s %9s %9s %9s %9s %11s' % ('kind', 'name', 'history', 'docs/s', 'p50 ms', 'p95 ms',
+                                                       'p99 ms', 'RSS MB', 'blocks/doc'))
+    for entry in results:
+        latency = entry["latency_ms"]
+        print('%-9s %-9s %-8s %9.1f %9.1f %9.1f %9.1f %9s %11.0f'
+              % (entry["kind"], entry["name"], entry["history"] or '-', entry["docs_per_second"], latency["p50"],
+                 latency["p95"], latency["p99"],
+                 '-' if entry["peak_rss_mb"] is None else '%.1f' % entry["peak_rss_mb"],
+                 entry["allocations"]["blocks_per_call"]))
+
+    with open(output, 'w') as output_file:
+        json.dump({"commit": git_commit(), "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                   "python": platform.python_version(), "platform": platform.platform(),
+                   "cpu_count": os.cpu_count(), "templates": args.templates, "results": results},
+                  output_file, indent=2)
+    print('Results written to ' + output)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+from synthetic import make_patient, make_health_data, API_DIR
+from GenerateDocuments import FeedbackForm, PatientHealthForm, PatientDataForm
+from DocumentTemplates import TemplateFeedbackForm, TemplatePatientHealthForm, TemplatePatientDataForm
+from ChartRenderer import render_patient_charts
+from io import BytesIO
+import argparse
+import time
+import os
+
+
+def build_with_builder(form, build):
+    """
+    Builds a document with the python-docx builder and saves it into memory.
+    """
+    build(form)
+    memfile = BytesIO()
+    form.doc.save(memfile)
+    return memfile.getvalue()
+
+
+def docs_per_second(function, count):
+    """
+    Calls function count times and returns how many it managed per second.
+    """
+    function()
+    start = time.perf_counter()
+    for _ in range(count):
+        function()
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares docs/sec of the document builders and templates.')
+    parser.add_argument('--count', type=int, default=200, help='number of documents to generate per form')
+    args = parser.parse_args()
+
+    os.chdir(API_DIR)
+    from FormAPI import generate_feedback_data
+
+    patient = make_patient(1)
+    feedback_data = generate_feedback_data(patient)
+    patient_data = make_health_data(365)
+    charts = render_patient_charts(patient_data)
+
+    cases = [('feedback',
+              lambda: build_with_builder(FeedbackForm(patient.uuid, feedback_data), FeedbackForm.build_feedback_form),
+              lambda: TemplateFeedbackForm(patient.uuid, feedback_data).render()),
+             ('details',
+              lambda: build_with_builder(PatientDataForm(patient), PatientDataForm.build_patient_info_form),
+              lambda: TemplatePatientDataForm(patient).render()),
+             ('health',
+              lambda: build_with_builder(PatientHealthForm(patient.uuid, patient.full_name(), patient_data, charts),
+                                         PatientHealthForm.build_patient_data_form),
+              lambda: TemplatePatientHealthForm(patient.uuid, patient.full_name(), patient_data, charts).render())]
+
+    print('%-10s %14s %14s %8s' % ('form', 'builder doc/s', 'template doc/s', 'speedup'))
+    for name, builder, template in cases:
+        builder_rate = docs_per_second(builder, args.count)
+        template_rate = docs_per_second(template, args.count)
+        print('%-10s %14.1f %14.1f %7.1fx' % (name, builder_rate, template_rate, template_rate / builder_rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+from synthetic import API_DIR
+from BlobStore import create_blob_store
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import tempfile
+import json
+import time
+import os
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures uploads/sec through the shared blob store.')
+    parser.add_argument('--backend', choices=['local', 'azure'], default='local',
+                        help='local uses a temporary folder, azure uses the account in config.json')
+    parser.add_argument('--container', default='benchmark', help='container the blobs are uploaded to')
+    parser.add_argument('--size', type=int, default=200 * 1024, help='size in bytes of each blob')
+    parser.add_argument('--count', type=int, default=200, help='number of blobs to upload')
+    parser.add_argument('--threads', type=int, default=8, help='number of uploads running at once')
+    args = parser.parse_args()
+
+    with open(os.path.join(API_DIR, 'config.json')) as config_file:
+        config = json.load(config_file)
+    config['blob_backend'] = args.backend
+    if args.backend == 'local':
+        config['blob_local_root'] = tempfile.mkdtemp()
+    store = create_blob_store(config)
+
+    data = os.urandom(args.size)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as pool:
+        list(pool.map(lambda index: store.upload_bytes(args.container, 'benchmark %d.docx' % index, data),
+                      range(args.count)))
+    elapsed = time.perf_counter() - start
+    print('%d uploads of %d bytes in %.2fs: %.1f uploads/s, %.1f MB/s'
+          % (args.count, args.size, elapsed, args.count / elapsed, args.count * args.size / elapsed / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+from synthetic import make_patient, make_observations, patient_to_json, observation_to_json, bundle
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import argparse
+import threading
+import json
+
+
+class StubFHIRData():
+    """
+    The synthetic patients served by the stub, with the JSON of each patient's observations built once and kept.
+    """
+
+    def __init__(self, patients=100, observations=1000, page_size=100, paged=False):
+        """
+        :param patients: number of patients, with IDs from 0 upwards
+        :param observations: number of observations each patient has
+        :param page_size: number of observations in each bundle
+        :param paged: when set the observation route answers with the first bundle only and a next link to the rest,
+        otherwise it answers with the list of every bundle as the GOSH FHIR API does
+        """
+        self.patients = {str(index): patient_to_json(make_patient(index)) for index in range(patients)}
+        for patient_id, resource in self.patients.items():
+            resource["id"] = patient_id
+        self.observations = observations
+        self.page_size = page_size
+        self.paged = paged
+        self.observation_pages = {}
+        self.lock = threading.Lock()
+
+    def export_lines(self, resource_type):
+        """
+        Yields the NDJSON lines of a bulk export of every patient or every observation.
+        """
+        if resource_type == 'Patient':
+            for resource in self.patients.values():
+                yield json.dumps(resource) + '\n'
+            return
+        for patient_id in self.patients:
+            for observation in make_observations(patient_id, self.observations, seed=int(patient_id)):
+                yield json.dumps(observation_to_json(observation)) + '\n'
+
+    def pages(self, patient_id):
+        """
+        Returns the observations of a patient split into pages of JSON resources.
+        """
+        with self.lock:
+            if patient_id not in self.observation_pages:
+                resources = [observation_to_json(observation)
+                             for observation in make_observations(patient_id, self.observations,
+                                                                  seed=int(patient_id))]
+                self.observation_pages[patient_id] = [resources[start:start + self.page_size]
+                                                      for start in range(0, len(resources), self.page_size)] or [[]]
+            return self.observation_pages[patient_id]
+
+
+class StubFHIRHandler(BaseHTTPRequestHandler):
+    """
+    Answers the routes of the FHIR API used by the fhir_parser package: /api/Patient/, /api/Patient/<id> and
+    /api/Observation/<id>, with ?page=<n> selecting a single page of observations. A bulk export is started with
+    /api/$export, finishes at once and its NDJSON files are streamed from /api/$export-file/<type>.
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def url(self, path):
+        return 'http://%s:%d/api/%s' % (self.server.server_address[0], self.server.server_address[1], path)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        store = self.server.data
+        if parts[:1] != ['api'] or len(parts) < 2:
+            return self.send_json({}, 404)
+
+        if parts[1] == '$export':
+            self.send_response(202)
+            self.send_header('Content-Location', self.url('$export-status'))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if parts[1] == '$export-status':
+            return self.send_json({"transactionTime": "2020-01-01T00:00:00Z", "requiresAccessToken": False,
+                                   "output": [{"type": resource_type, "url": self.url('$export-file/' + resource_type)}
+                                              for resource_type in ('Patient', 'Observation')], "error": []})
+        if parts[1] == '$export-file' and len(parts) == 3:
+            # the file is sent as it is generated and ends when the connection is closed
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/fhir+ndjson')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            for line in store.export_lines(parts[2]):
+                self.wfile.write(line.encode('utf-8'))
+            self.close_connection = True
+            return
+        if parts[1] == 'Patient' and len(parts) == 2:
+            return self.send_json([bundle(list(store.patients.values()))])
+        if parts[1] in ('Patient', 'Observation') and parts[2] not in store.patients:
+            return self.send_json({"resourceType": "OperationOutcome",
+                                   "issue": [{"diagnostics": "Resource " + parts[2] + " not found"}]}, 404)
+        if parts[1] == 'Patient':
+            return self.send_json(store.patients[parts[2]])
+        if parts[1] == 'Observation':
+            pages = store.pages(parts[2])
+            page = parse_qs(url.query).get('page')
+            if page is None and not store.paged:
+                return self.send_json([bundle(resources) for resources in pages])
+            index = int(page[0]) if page else 0
+            next_url = None
+            if index + 1 < len(pages):
+                next_url = 'http://%s:%d/api/Observation/%s?page=%d' % (self.server.server_address[0],
+                                                                         self.server.server_address[1],
+                                                                         parts[2], index + 1)
+            return self.send_json(bundle(pages[index], next_url))
+        return self.send_json({}, 404)
+
+
+def create_stub_server(port=0, **options):
+    """
+    Creates the stub FHIR server without starting it. The options are passed to StubFHIRData.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubFHIRHandler)
+    server.daemon_threads = True
+    server.data = StubFHIRData(**options)
+    return server
+
+
+def start_stub_server(port=0, **options):
+    """
+    Starts the stub FHIR server on a background thread.
+    :return: the server, whose FHIR endpoint is http://127.0.0.1:<server.server_address[1]>/api/
+    """
+    server = create_stub_server(port, **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves synthetic patients and observations over a FHIR-like API.')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--patients', type=int, default=100)
+    parser.add_argument('--observations', type=int, default=1000, help='observations per patient')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--paged', action='store_true', help='answer with one bundle at a time linked by next')
+    args = parser.parse_args()
+
+    server = create_stub_server(args.port, patients=args.patients, observations=args.observations,
+                                page_size=args.page_size, paged=args.paged)
+    print('Stub FHIR server on http://127.0.0.1:%d/api/' % args.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+import datetime
+import random
+import os
+import sys
+
+# lets the benchmarks import the API modules when run from any directory
+API_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if API_DIR not in sys.path:
+    sys.path.insert(0, API_DIR)
+
+from fhir_parser.patient import Patient, Name, Address, MaritalStatus, Communications, Identifier
+from fhir_parser.observation import Observation, ObservationComponent
+
+# display name, LOINC code, unit and a plausible range of readings for each vital sign
+VITAL_SIGNS = [('Body Weight', '29463-7', 'kg', 40.0, 120.0),
+               ('Heart rate', '8867-4', '/min', 50.0, 110.0),
+               ('Respiratory rate', '9279-1', '/min', 10.0, 25.0),
+               ('Body Mass Index', '39156-5', 'kg/m2', 17.0, 40.0),
+               ('Diastolic Blood Pressure', '8462-4', 'mm[Hg]', 60.0, 100.0),
+               ('Systolic Blood Pressure', '8480-6', 'mm[Hg]', 100.0, 160.0)]
+
+# number of observations for a small, typical and very long patient history
+HISTORY_SIZES = {'small': 60, 'typical': 1000, 'long': 20000}
+
+
+def make_patient(index):
+    """
+    Creates a synthetic patient whose details are all derived from index.
+    """
+    uuid = 'synthetic-%08d' % index
+    name = Name('Family%d' % index, ['Given%d' % index], ['Mx.'])
+    address = Address(['%d Example Street' % index], 'London', 'Greater London', 'N%d 1AA' % (index % 20),
+                      'GB', [])
+    identifiers = [Identifier('http://hospital.example', 'DL', "Driver's License", 'S9%07d' % index),
+                   Identifier('http://hospital.example', 'SS', 'Social Security Number', '999-%06d' % index)]
+    return Patient(uuid, name, [], 'female' if index % 2 else 'male', datetime.date(1950 + index % 60, 1, 1),
+                   [address], MaritalStatus('M'), False, Communications([('en-GB', 'English')]), [], identifiers)
+
+
+def make_observations(patient_id, count, seed=0):
+    """
+    Creates count synthetic vital sign observations for a patient, one reading a day cycling through the vital signs.
+    Blood pressure readings are recorded as a single observation with two components as they are in FHIR.
+    """
+    generator = random.Random(seed)
+    start = datetime.datetime(2010, 1, 1, 9, tzinfo=datetime.timezone.utc)
+    observations = []
+    for index in range(count):
+        issued = start + datetime.timedelta(hours=6 * index)
+        kind = index % (len(VITAL_SIGNS) - 1)
+        if kind == len(VITAL_SIGNS) - 2:
+            signs = VITAL_SIGNS[-2:]
+        else:
+            signs = [VITAL_SIGNS[kind]]
+        components = [ObservationComponent('http://loinc.org', code, display, round(generator.uniform(low, high), 1),
+                                           unit)
+                      for display, code, unit, low, high in signs]
+        observations.append(Observation('obs-%s-%d' % (patient_id, index), 'vital-signs', 'final', patient_id,
+                                        'encounter-%d' % (index // 10), issued, issued, components))
+    return observations
+
+
+def make_health_data(points, seed=0):
+    """
+    Creates health data in the format passed to PatientHealthForm with the given number of readings per vital sign.
+    """
+    generator = random.Random(seed)
+    start = datetime.datetime(2010, 1, 1, 9, tzinfo=datetime.timezone.utc)
+    dates = [str(start + datetime.timedelta(days=day)) for day in range(points)]
+    return {display: {"Dates": dates, "Values": [round(generator.uniform(low, high), 1) for _ in range(points)],
+                      "Unit": unit}
+            for display, code, unit, low, high in VITAL_SIGNS}
+
+
+def patient_to_json(patient):
+    """
+    Creates the FHIR Patient resource for a patient, in the form the fhir_parser package reads.
+    """
+    address = patient.addresses[0]
+    return {"resourceType": "Patient",
+            "id": patient.uuid,
+            "name": [{"family": patient.name.family, "given": patient.name.given_list,
+                      "prefix": patient.name.prefix_list}],
+            "telecom": [{"system": "phone", "value": "555-0100", "use": "home"}],
+            "gender": patient.gender,
+            "birthDate": patient.birth_date.isoformat(),
+            "address": [{"line": address.lines, "city": address.city, "state": address.state,
+                         "postalCode": address.postal_code, "country": address.country,
+                         "extension": [{"extension": [{"url": "latitude", "valueDecimal": 51.5},
+                                                      {"url": "longitude", "valueDecimal": -0.1}]}]}],
+            "maritalStatus": {"coding": [{"code": patient.marital_status.marital_status}]},
+            "communication": [{"language": {"coding": [{"code": code, "display": display}]}}
+                              for code, display in patient.communications.communication],
+            "extension": [],
+            "identifier": [{"system": identifier.system,
+                            "type": {"coding": [{"code": identifier.code}], "text": identifier.display},
+                            "value": identifier.value} for identifier in patient.identifiers]}
+
+
+def observation_to_json(observation):
+    """
+    Creates the FHIR Observation resource for an observation. Observations with a single component carry it as the
+    code and value of the resource, others are recorded as a blood pressure panel with one entry per component.
+    """
+    def coding(component):
+        return {"coding": [{"system": component.system, "code": component.code, "display": component.display}]}
+
+    def quantity(component):
+        return {"value": component.value, "unit": component.unit, "system": "http://unitsofmeasure.org",
+                "code": component.unit}
+
+    resource = {"resourceType": "Observation",
+                "id": observation.uuid,
+                "status": observation.status,
+                "category": [{"coding": [{"code": observation.type}]}],
+                "subject": {"reference": "Patient/" + observation.patient_uuid},
+                "encounter": {"reference": "Encounter/" + observation.encounter_uuid},
+                "effectiveDateTime": observation.effective_datetime.isoformat(),
+                "issued": observation.issued_datetime.isoformat()}
+    if len(observation.components) == 1:
+        resource["code"] = coding(observation.components[0])
+        resource["valueQuantity"] = quantity(observation.components[0])
+    else:
+        resource["code"] = {"coding": [{"system": "http://loinc.org", "code": "55284-4",
+                                        "display": "Blood Pressure"}]}
+        resource["component"] = [{"code": coding(component), "valueQuantity": quantity(component)}
+                                 for component in observation.components]
+    return resource
+
+
+def bundle(resources, next_url=None):
+    """
+    Wraps a list of resources in a FHIR searchset Bundle, linking to the next page if there is one.
+    """
+    links = [{"relation": "next", "url": next_url}] if next_url else []
+    return {"resourceType": "Bundle", "type": "searchset", "total": len(resources), "link": links,
+            "entry": [{"resource": resource} for resource in resources]}
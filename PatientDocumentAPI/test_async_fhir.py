@@ -0,0 +1,140 @@
+from fhir_parser.fhir import FHIR
+from AsyncFHIR import AsyncFHIR
+import threading
+import unittest
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+from stub_fhir import StubFHIRHandler, start_stub_server
+
+
+def stub_endpoint(server):
+    return 'http://127.0.0.1:%d/api/' % server.server_address[1]
+
+
+def stop_stub_server(server):
+    server.shutdown()
+    server.server_close()
+
+
+def observation_uuids(observations):
+    return [observation.uuid for observation in observations]
+
+
+class CountingHandler(StubFHIRHandler):
+    """
+    Stub handler that records the most requests it was answering at the same time, holding each one briefly so
+    requests allowed to run together overlap. A request stops counting just before its answer is sent, as the
+    client may start its next request as soon as the answer arrives.
+    """
+
+    def do_GET(self):
+        with self.server.count_lock:
+            self.server.active += 1
+            self.server.most_active = max(self.server.most_active, self.server.active)
+        time.sleep(0.02)
+        super().do_GET()
+
+    def send_json(self, body, status=200):
+        with self.server.count_lock:
+            self.server.active -= 1
+        super().send_json(body, status)
+
+
+class AsyncFHIRTest(unittest.TestCase):
+    """
+    Checks the async client returns what the blocking fhir_parser client returns from the stub FHIR server.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.stub = start_stub_server(patients=5, observations=120, page_size=50)
+        cls.fhir = FHIR(stub_endpoint(cls.stub), verify_ssl=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        stop_stub_server(cls.stub)
+
+    def setUp(self):
+        self.client = AsyncFHIR(stub_endpoint(self.stub))
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_patient(self):
+        patient = self.client.get_patient('2')
+        expected = self.fhir.get_patient('2')
+        self.assertEqual(patient.uuid, expected.uuid)
+        self.assertEqual(patient.full_name(), expected.full_name())
+
+    def test_observations(self):
+        observations = self.client.get_patient_observations('3')
+        self.assertEqual(len(observations), 120)
+        self.assertEqual(observation_uuids(observations), observation_uuids(self.fhir.get_patient_observations('3')))
+
+    def test_patient_with_observations(self):
+        patient, observations = self.client.get_patient_with_observations('1')
+        self.assertEqual(patient.uuid, self.fhir.get_patient('1').uuid)
+        self.assertEqual(observation_uuids(observations), observation_uuids(self.fhir.get_patient_observations('1')))
+
+    def test_unknown_patient(self):
+        with self.assertRaises(ConnectionError):
+            self.client.get_patient('unknown')
+        with self.assertRaises(ConnectionError):
+            self.client.get_patient_observations('unknown')
+        with self.assertRaises(ConnectionError):
+            self.client.get_patient_with_observations('unknown')
+
+
+class AsyncFHIRPagingTest(unittest.TestCase):
+    """
+    Checks the async client follows next links through every page of observations while keeping to its limit on
+    concurrent requests.
+    """
+
+    def setUp(self):
+        self.stub = start_stub_server(patients=4, observations=230, page_size=50, paged=True)
+        self.stub.RequestHandlerClass = CountingHandler
+        self.stub.count_lock = threading.Lock()
+        self.stub.active = 0
+        self.stub.most_active = 0
+        # the blocking client only reads unpaged answers, so it is given the same observations in one list of bundles
+        self.unpaged = start_stub_server(patients=4, observations=230, page_size=50)
+        self.client = AsyncFHIR(stub_endpoint(self.stub), max_concurrent_requests=2)
+
+    def tearDown(self):
+        self.client.close()
+        stop_stub_server(self.stub)
+        stop_stub_server(self.unpaged)
+
+    def test_follows_next_links(self):
+        observations = self.client.get_patient_observations('0')
+        expected = FHIR(stub_endpoint(self.unpaged), verify_ssl=False).get_patient_observations('0')
+        self.assertEqual(len(observations), 230)
+        self.assertEqual(observation_uuids(observations), observation_uuids(expected))
+
+    def test_bounded_concurrency(self):
+        results = {}
+
+        def fetch(patient_id):
+            results[patient_id] = self.client.get_patient_with_observations(patient_id)
+
+        threads = [threading.Thread(target=fetch, args=(str(index),)) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        fhir = FHIR(stub_endpoint(self.unpaged), verify_ssl=False)
+        for patient_id, (patient, observations) in results.items():
+            self.assertEqual(patient.uuid, fhir.get_patient(patient_id).uuid)
+            self.assertEqual(observation_uuids(observations),
+                             observation_uuids(fhir.get_patient_observations(patient_id)))
+        self.assertEqual(len(results), 4)
+        self.assertEqual(self.stub.most_active, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
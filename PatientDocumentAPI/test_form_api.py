@@ -0,0 +1,132 @@
+import subprocess
+import tempfile
+import unittest
+import shutil
+import time
+import json
+import sys
+import os
+
+API_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(API_DIR, 'benchmarks'))
+from stub_fhir import start_stub_server
+from bench_suite import configure_api
+
+# a patient pack renders its charts in the pool before a batch starts, which used to leave the batch waiting forever
+PACK_THEN_BATCH = '''
+import sys, os, time, json
+sys.path.insert(0, os.path.join(os.getcwd(), 'benchmarks'))
+from stub_fhir import start_stub_server
+from bench_suite import configure_api
+stub = start_stub_server(patients=5, observations=200)
+configure_api('http://127.0.0.1:%d/api/' % stub.server_address[1], sys.argv[1], False, 2)
+os.environ['PATIENT_DOCUMENT_API_JOB_QUEUE_PATH'] = json.dumps(os.path.join(sys.argv[1], 'jobs.sqlite3'))
+os.environ['PATIENT_DOCUMENT_API_HEALTH_HISTORY_PATH'] = json.dumps(os.path.join(sys.argv[1], 'history.sqlite3'))
+import FormAPI
+client = FormAPI.app.test_client()
+assert client.get('/pack?id=2', json={}).status_code == 200
+job = client.post('/batch/healthReports', json={'ids': ['0', '1', '3', '4']}).get_json()
+deadline = time.time() + 60
+status = client.get('/batch/healthReports/' + job['job_id'], json={}).get_json()
+while status['state'] != 'finished' and time.time() < deadline:
+    time.sleep(0.2)
+    status = client.get('/batch/healthReports/' + job['job_id'], json={}).get_json()
+print(json.dumps(status['counts']))
+FormAPI.job_queue.stop()
+FormAPI.chart_pool.get_executor().shutdown()
+stub.shutdown()
+os._exit(0)
+'''
+
+FormAPI = None
+stub = None
+blob_root = None
+
+
+def setUpModule():
+    global FormAPI, stub, blob_root
+    stub = start_stub_server(patients=6, observations=150)
+    blob_root = tempfile.mkdtemp()
+    configure_api('http://127.0.0.1:%d/api/' % stub.server_address[1], blob_root, False, 1)
+    os.environ['PATIENT_DOCUMENT_API_JOB_QUEUE_PATH'] = json.dumps(os.path.join(blob_root, 'jobs.sqlite3'))
+    os.environ['PATIENT_DOCUMENT_API_HEALTH_HISTORY_PATH'] = json.dumps(os.path.join(blob_root, 'history.sqlite3'))
+    import FormAPI
+
+
+def tearDownModule():
+    FormAPI.job_queue.stop()
+    if FormAPI.chart_pool.executor is not None:
+        FormAPI.chart_pool.executor.shutdown()
+    stub.shutdown()
+    stub.server_close()
+    shutil.rmtree(blob_root)
+
+
+def wait_for_batch(client, job_id, timeout=60):
+    deadline = time.time() + timeout
+    status = client.get('/batch/healthReports/' + job_id, json={}).get_json()
+    while status['state'] != 'finished' and time.time() < deadline:
+        time.sleep(0.2)
+        status = client.get('/batch/healthReports/' + job_id, json={}).get_json()
+    return status
+
+
+class FingerprintTest(unittest.TestCase):
+    """
+    Checks a stored document is served again while its patient is unchanged, and regenerated when forced.
+    """
+
+    def setUp(self):
+        self.client = FormAPI.app.test_client()
+
+    def check_cache(self, path, patient_id):
+        first = self.client.get(path, query_string={'id': patient_id}, json={})
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.headers['X-Document-Cache'], 'regenerated')
+        second = self.client.get(path, query_string={'id': patient_id}, json={})
+        self.assertEqual(second.headers['X-Document-Cache'], 'hit')
+        self.assertEqual(second.data, first.data)
+        forced = self.client.get(path, query_string={'id': patient_id, 'force': 'true'}, json={})
+        self.assertEqual(forced.headers['X-Document-Cache'], 'regenerated')
+
+    def test_health_report(self):
+        self.check_cache('/report/patientReport', '1')
+
+    def test_feedback(self):
+        self.check_cache('/FormFiller/feedback', '2')
+
+
+class BatchTest(unittest.TestCase):
+    """
+    Checks a batch generates and stores a health report for every patient it can find, and leaves reports of
+    unchanged patients alone when run again.
+    """
+
+    def setUp(self):
+        self.client = FormAPI.app.test_client()
+
+    def test_batch(self):
+        response = self.client.post('/batch/healthReports', json={'ids': ['3', '4', 'unknown']})
+        self.assertEqual(response.status_code, 202)
+        status = wait_for_batch(self.client, response.get_json()['job_id'])
+        self.assertEqual(status['state'], 'finished')
+        self.assertEqual(status['counts'], {'done': 2, 'failed': 1})
+        stored = [name for name in os.listdir(os.path.join(blob_root, 'health')) if not name.startswith('.')]
+        self.assertGreaterEqual(len(stored), 2)
+
+        response = self.client.post('/batch/healthReports', json={'ids': ['3', '4']})
+        status = wait_for_batch(self.client, response.get_json()['job_id'])
+        self.assertEqual(status['counts'], {'unchanged': 2})
+
+    def test_pack_then_batch(self):
+        folder = tempfile.mkdtemp()
+        try:
+            result = subprocess.run([sys.executable, '-c', PACK_THEN_BATCH, folder], cwd=API_DIR, timeout=120,
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        finally:
+            shutil.rmtree(folder)
+        self.assertEqual(json.loads(result.stdout.decode().splitlines()[-1]), {'done': 4})
+
+
+if __name__ == '__main__':
+    unittest.main()
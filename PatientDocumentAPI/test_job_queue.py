@@ -0,0 +1,74 @@
+from JobQueue import JobQueue
+import tempfile
+import unittest
+import shutil
+import time
+import os
+
+
+def wait_for(queue, job_id, state, timeout=15):
+    deadline = time.time() + timeout
+    job = queue.get(job_id)
+    while job['state'] != state and time.time() < deadline:
+        time.sleep(0.05)
+        job = queue.get(job_id)
+    return job
+
+
+class JobQueueLeaseTest(unittest.TestCase):
+    """
+    Checks a job whose worker stopped renewing its lease is run again by another queue sharing the file, and that a
+    job whose lease is kept renewed is not.
+    """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'jobs.sqlite3')
+        self.queues = []
+        self.runs = []
+
+    def tearDown(self):
+        for queue in self.queues:
+            queue.stop()
+        shutil.rmtree(self.folder)
+
+    def queue(self, handler, workers):
+        queue = JobQueue(self.path, {'health': handler}, workers=workers, job_timeout=1, poll_interval=0.1)
+        self.queues.append(queue)
+        return queue
+
+    def test_abandoned_job_is_taken_over(self):
+        dead = self.queue(lambda patient_id, force: self.runs.append('dead'), 0)
+        job_id = dead.submit('health', '1')['job_id']
+        # claimed by a worker that then dies, so its lease is never renewed
+        claimed = dead._claim()
+        self.assertEqual(claimed[0], job_id)
+
+        live = self.queue(lambda patient_id, force: self.runs.append('live') or patient_id, 1)
+        job = wait_for(live, job_id, 'done')
+        self.assertEqual(job['state'], 'done')
+        self.assertEqual(job['result'], '1')
+        self.assertEqual(self.runs, ['live'])
+
+        # a late result from the worker that lost the job is discarded
+        dead._finish(job_id, claimed[5], 'failed', error='late')
+        job = live.get(job_id)
+        self.assertEqual(job['state'], 'done')
+        self.assertNotIn('error', job)
+
+    def test_renewed_job_is_not_taken_over(self):
+        def slow(patient_id, force):
+            self.runs.append(patient_id)
+            time.sleep(2.5)
+            return patient_id
+
+        first = self.queue(slow, 1)
+        second = self.queue(slow, 1)
+        job_id = first.submit('health', '2')['job_id']
+        job = wait_for(second, job_id, 'done')
+        self.assertEqual(job['state'], 'done')
+        self.assertEqual(self.runs, ['2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
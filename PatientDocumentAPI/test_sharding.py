@@ -0,0 +1,46 @@
+from Sharding import HashRing
+import unittest
+
+NODES = ['http://10.0.0.1:5010', 'http://10.0.0.2:5010', 'http://10.0.0.3:5010']
+
+
+class HashRingTest(unittest.TestCase):
+    """
+    Checks patient IDs are split between the nodes the same way everywhere and move as little as possible when a
+    node is added.
+    """
+
+    def setUp(self):
+        self.ring = HashRing(NODES)
+        self.patient_ids = [str(index) for index in range(3000)]
+
+    def test_same_owner_on_every_node(self):
+        other = HashRing(list(reversed(NODES)) + [NODES[0]])
+        for patient_id in self.patient_ids:
+            self.assertIn(self.ring.node_for(patient_id), NODES)
+            self.assertEqual(self.ring.node_for(patient_id), other.node_for(patient_id))
+
+    def test_partition_keeps_order(self):
+        parts = self.ring.partition(self.patient_ids)
+        self.assertEqual(sorted(sum(parts.values(), []), key=int), self.patient_ids)
+        for node, patient_ids in parts.items():
+            self.assertEqual(patient_ids, sorted(patient_ids, key=int))
+            self.assertTrue(all(self.ring.node_for(patient_id) == node for patient_id in patient_ids))
+
+    def test_every_node_gets_a_share(self):
+        parts = self.ring.partition(self.patient_ids)
+        self.assertEqual(set(parts), set(NODES))
+        for patient_ids in parts.values():
+            self.assertGreater(len(patient_ids), len(self.patient_ids) / 6)
+
+    def test_added_node_only_takes_patients(self):
+        added = 'http://10.0.0.4:5010'
+        grown = HashRing(NODES + [added])
+        moved = [patient_id for patient_id in self.patient_ids
+                 if grown.node_for(patient_id) != self.ring.node_for(patient_id)]
+        self.assertTrue(moved)
+        self.assertTrue(all(grown.node_for(patient_id) == added for patient_id in moved))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
+import threading
+import shutil
+import time
+import json
+import os
+
+
+class DocumentCache():
+    """
+    Local copies of documents downloaded from Azure, kept in a folder and keyed by container and blob name. A cached
+    document checked against Azure within fresh_seconds is used straight away. Older copies are checked with a
+    conditional download sending the ETag of the copy, so an unchanged document costs one small request instead of
+    being downloaded again. Once the folder holds more than max_bytes the least recently used documents are removed.
+    """
+
+    def __init__(self, folder, get_blob_service, max_bytes=200 * 1024 * 1024, fresh_seconds=60):
+        """
+        :param folder: folder the documents and the index describing them are kept in
+        :param get_blob_service: function returning the BlockBlobService documents are downloaded with
+        :param max_bytes: most bytes of documents kept in the folder
+        :param fresh_seconds: seconds a copy is used for after it was last checked against Azure
+        """
+        self.folder = folder
+        self.get_blob_service = get_blob_service
+        self.max_bytes = max_bytes
+        self.fresh_seconds = fresh_seconds
+        self.index_path = os.path.join(folder, 'index.json')
+        self.lock = threading.Lock()
+        self.blob_locks = {}
+        os.makedirs(folder, exist_ok=True)
+        try:
+            with open(self.index_path) as index_file:
+                self.entries = json.load(index_file)
+        except (OSError, ValueError):
+            self.entries = {}
+        # copies whose files have gone missing are forgotten
+        self.entries = {key: entry for key, entry in self.entries.items()
+                        if os.path.exists(os.path.join(folder, entry["file"]))}
+
+    def get(self, container_name, blob_name):
+        """
+        Returns the path of an up to date local copy of a document, downloading it only if it is not cached or has
+        changed on Azure. Raises AzureMissingResourceHttpError if the document does not exist.
+        """
+        key = container_name + '/' + blob_name
+        with self.blob_lock(key):
+            with self.lock:
+                entry = self.entries.get(key)
+            if entry is not None and time.time() - entry["checked"] < self.fresh_seconds:
+                return self.use(key)
+
+            file_name = entry["file"] if entry is not None else self.file_name(key)
+            path = os.path.join(self.folder, file_name)
+            download_path = path + '.download'
+            try:
+                blob = self.get_blob_service().get_blob_to_path(container_name, blob_name, download_path,
+                                                                if_none_match=entry["etag"] if entry else None)
+            except Exception as error:
+                if os.path.exists(download_path):
+                    os.remove(download_path)
+                if isinstance(error, AzureMissingResourceHttpError):
+                    self.discard(key)
+                if entry is None or not isinstance(error, AzureHttpError) or error.status_code != 304:
+                    raise
+                # the cached copy is still the latest version of the document
+                with self.lock:
+                    entry["checked"] = time.time()
+                return self.use(key)
+
+            os.replace(download_path, path)
+            with self.lock:
+                self.entries[key] = {"file": file_name, "etag": blob.properties.etag,
+                                     "size": os.path.getsize(path), "checked": time.time(), "used": time.time()}
+            self.evict(keep=key)
+            return self.use(key)
+
+    def copy_to(self, container_name, blob_name, destination):
+        """
+        Copies an up to date version of a document to destination, fetching it into the cache first if needed.
+        """
+        shutil.copyfile(self.get(container_name, blob_name), destination)
+
+    def expire(self, container_name, blob_name):
+        """
+        Makes the next use of a document check it against Azure, for instance after it has been generated again.
+        """
+        with self.lock:
+            entry = self.entries.get(container_name + '/' + blob_name)
+            if entry is not None:
+                entry["checked"] = 0
+
+    def use(self, key):
+        with self.lock:
+            entry = self.entries[key]
+            entry["used"] = time.time()
+            self.save_index()
+        return os.path.join(self.folder, entry["file"])
+
+    def discard(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            self.save_index()
+        if entry is not None:
+            self.remove_file(entry["file"])
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used documents until the cache is back under max_bytes, never removing keep.
+        """
+        removed = []
+        with self.lock:
+            total = sum(entry["size"] for entry in self.entries.values())
+            for key, entry in sorted(self.entries.items(), key=lambda item: item[1]["used"]):
+                if total <= self.max_bytes:
+                    break
+                if key != keep:
+                    removed.append(self.entries.pop(key)["file"])
+                    total -= entry["size"]
+            self.save_index()
+        for file_name in removed:
+            self.remove_file(file_name)
+
+    def blob_lock(self, key):
+        """
+        Returns the lock held while a document is fetched, so a click and a prefetch never download it twice.
+        """
+        with self.lock:
+            return self.blob_locks.setdefault(key, threading.Lock())
+
+    def file_name(self, key):
+        """
+        Returns a file name for a document that cannot clash with other documents or contain a path separator.
+        """
+        return key.replace('%', '%25').replace('/', '%2F').replace('\\', '%5C')
+
+    def remove_file(self, file_name):
+        try:
+            os.remove(os.path.join(self.folder, file_name))
+        except OSError:
+            pass
+
+    def save_index(self):
+        """
+        Writes the index to disk so the cache can be reused the next time the application starts. Must be called
+        with the lock held.
+        """
+        temporary_path = self.index_path + '.tmp'
+        with open(temporary_path, 'w') as index_file:
+            json.dump(self.entries, index_file)
+        os.replace(temporary_path, self.index_path)
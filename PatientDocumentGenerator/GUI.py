@@ -1,45 +1,127 @@
 from tkinter import *
+from concurrent.futures import ThreadPoolExecutor
+from DocumentCache import DocumentCache
 import threading
 import time
-import requests
 import json
-import os
 
 from azure.common import AzureMissingResourceHttpError
-from azure.storage.blob import BlockBlobService
 
 
-def get_feedback_document():
-    def get_feedback_form():
-        file_name = patient_id.get() + " feedback request.docx"
+# messages shown when the API could not make a document, by the status code queue_document returns
+FAILURE_MESSAGES = {503: "API could not be reached", 504: "Document is taking too long"}
+
+
+def get_blob_service():
+    """
+    Returns the shared blob client, importing the Azure SDK and creating the client the first time a document is
+    downloaded rather than before the window appears.
+    """
+    global blob_service
+    if blob_service is None:
+        from azure.storage.blob import BlockBlobService
         blob_service = BlockBlobService(account_name=storage_account_name, account_key=storage_account_key)
-        try:
-            blob_service.get_blob_to_path(feedback_container_name,
-                                          file_name,
-                                          file_name)
-        except AzureMissingResourceHttpError:
-            information.set("File does not exist on Azure")
-            time.sleep(1)
-            information.set("Enter Patient ID")
-            os.remove(file_name)
+    return blob_service
+
+
+def queue_document(path):
+    """
+    Asks the API to make a document in the background and waits for its job to finish, showing progress meanwhile.
+    Every request gives up after request_timeout seconds, and waiting stops once the job has taken job_wait_seconds.
+    :return: 200 if the document was made, 404 if the patient does not exist, 503 if the API could not be reached,
+    504 if the job did not finish in time and 500 otherwise
+    """
+    # requests is only needed once a document is generated, so it is not loaded before the window appears
+    import requests
+    try:
+        response = requests.get("http://localhost:5010" + path + "&background=true", timeout=request_timeout)
+        if response.status_code != 202:
+            return response.status_code
+        information.set("Document queued")
+        job = response.json()
+        status_url = "http://localhost:5010" + job["status_url"]
+        deadline = time.monotonic() + job_wait_seconds
+        while job["state"] in ("queued", "running"):
+            if time.monotonic() > deadline:
+                return 504
+            time.sleep(0.5)
+            response = requests.get(status_url, timeout=request_timeout)
+            if response.status_code != 200:
+                return 500
+            job = response.json()
+    except requests.RequestException:
+        return 503
+    except (ValueError, KeyError):
+        return 500
+    if job["state"] == "done":
+        return 200
+    return 404 if job.get("error") == "Patient Does Not Exist" else 500
+
+
+def prefetch_documents(requested_id):
+    """
+    Fetches the documents of the patient ID entered into the cache in the background, once typing has stopped, so
+    opening them afterwards needs no download.
+    """
+    if not requested_id or requested_id != patient_id.get().strip():
+        return
+    for container_name, suffix in ((feedback_container_name, " feedback request.docx"),
+                                   (health_data_container_name, " health data.docx"),
+                                   (patient_info_container_name, " details.docx")):
+        prefetches.submit(prefetch_document, container_name, requested_id + suffix)
+
+
+def prefetch_document(container_name, blob_name):
+    try:
+        document_cache.get(container_name, blob_name)
+    except Exception:
+        # the document may not have been generated yet, which is found out again if it is opened
+        pass
+
+
+def patient_id_changed(*_):
+    """
+    Schedules a prefetch of the documents for the patient ID entered, a moment after the last key press.
+    """
+    window.after(prefetch_delay, prefetch_documents, patient_id.get().strip())
+
+
+def download_document(container_name, file_name):
+    """
+    Saves a document into the working folder from the local cache, which downloads it first if it is missing or out
+    of date. Runs on a download thread.
+    """
+    try:
+        document_cache.copy_to(container_name, file_name, file_name)
+    except AzureMissingResourceHttpError:
+        information.set("File does not exist on Azure")
+    except Exception:
+        information.set("File could not be downloaded")
+    else:
+        return
+    time.sleep(1)
+    information.set("Enter Patient ID")
 
-    t = threading.Thread(target=get_feedback_form)
-    t.start()
+
+def get_feedback_document():
+    file_name = patient_id.get() + " feedback request.docx"
+    downloads.submit(download_document, feedback_container_name, file_name)
 
 
 def make_feedback_document():
     def make_feedback_form():
-        response = requests.get("http://localhost:5010/FormFiller/feedback?id=" + patient_id.get())
-        if response.status_code == 200:
+        status_code = queue_document("/FormFiller/feedback?id=" + patient_id.get())
+        if status_code == 200:
+            document_cache.expire(feedback_container_name, patient_id.get() + " feedback request.docx")
             information.set("Document created on Azure")
             time.sleep(1)
             information.set("Enter Patient ID")
-        elif response.status_code == 404:
+        elif status_code == 404:
             information.set("Patient does not exist")
             time.sleep(1)
             information.set("Enter Patient ID")
         else:
-            information.set("File could not be created")
+            information.set(FAILURE_MESSAGES.get(status_code, "File could not be created"))
             time.sleep(1)
             information.set("Enter Patient ID")
 
@@ -48,36 +130,24 @@ def make_feedback_document():
 
 
 def get_health_document():
-    def get_health_form():
-        file_name = patient_id.get() + " health data.docx"
-        blob_service = BlockBlobService(account_name=storage_account_name, account_key=storage_account_key)
-        try:
-            blob_service.get_blob_to_path(health_data_container_name,
-                                          file_name,
-                                          file_name)
-        except AzureMissingResourceHttpError:
-            information.set("File does not exist on Azure")
-            time.sleep(1)
-            information.set("Enter Patient ID")
-            os.remove(file_name)
-
-    t = threading.Thread(target=get_health_form)
-    t.start()
+    file_name = patient_id.get() + " health data.docx"
+    downloads.submit(download_document, health_data_container_name, file_name)
 
 
 def make_health_document():
     def make_health_form():
-        response = requests.get("http://localhost:5010/report/patientReport?id=" + patient_id.get())
-        if response.status_code == 200:
+        status_code = queue_document("/report/patientReport?id=" + patient_id.get())
+        if status_code == 200:
+            document_cache.expire(health_data_container_name, patient_id.get() + " health data.docx")
             information.set("Document created on Azure")
             time.sleep(1)
             information.set("Enter Patient ID")
-        elif response.status_code == 404:
+        elif status_code == 404:
             information.set("Patient does not exist")
             time.sleep(1)
             information.set("Enter Patient ID")
         else:
-            information.set("File could not be created")
+            information.set(FAILURE_MESSAGES.get(status_code, "File could not be created"))
             time.sleep(1)
             information.set("Enter Patient ID")
 
@@ -86,36 +156,24 @@ def make_health_document():
 
 
 def get_patient_details_document():
-    def get_patient_details_form():
-        file_name = patient_id.get() + " details.docx"
-        blob_service = BlockBlobService(account_name=storage_account_name, account_key=storage_account_key)
-        try:
-            blob_service.get_blob_to_path(patient_info_container_name,
-                                          file_name,
-                                          file_name)
-        except AzureMissingResourceHttpError:
-            information.set("File does not exist on Azure")
-            time.sleep(1)
-            information.set("Enter Patient ID")
-            os.remove(file_name)
-
-    t = threading.Thread(target=get_patient_details_form)
-    t.start()
+    file_name = patient_id.get() + " details.docx"
+    downloads.submit(download_document, patient_info_container_name, file_name)
 
 
 def make_patient_details_document():
     def make_patient_details_form():
-        response = requests.get("http://localhost:5010/info/infoDocument?id=" + patient_id.get())
-        if response.status_code == 200:
+        status_code = queue_document("/info/infoDocument?id=" + patient_id.get())
+        if status_code == 200:
+            document_cache.expire(patient_info_container_name, patient_id.get() + " details.docx")
             information.set("Document created on Azure")
             time.sleep(1)
             information.set("Enter Patient ID")
-        elif response.status_code == 404:
+        elif status_code == 404:
             information.set("Patient does not exist")
             time.sleep(1)
             information.set("Enter Patient ID")
         else:
-            information.set("File could not be created")
+            information.set(FAILURE_MESSAGES.get(status_code, "File could not be created"))
             time.sleep(1)
             information.set("Enter Patient ID")
 
@@ -130,12 +188,28 @@ with open('config.json') as config_file:
     feedback_container_name = data["feedback_container_name"]
     health_data_container_name = data["health_data_container_name"]
     patient_info_container_name = data['patient_info_container_name']
+    cache_folder = data.get('cache_folder', 'document_cache')
+    cache_max_bytes = data.get('cache_max_bytes', 200 * 1024 * 1024)
+    cache_fresh_seconds = data.get('cache_fresh_seconds', 60)
+    prefetch_delay = data.get('prefetch_delay_ms', 500)
+    request_timeout = data.get('request_timeout', 10)
+    job_wait_seconds = data.get('job_wait_seconds', 300)
+
+# a single client is shared by every button so its connection to Azure is reused between downloads
+blob_service = None
+
+# documents are downloaded into a local cache on these threads, never on the thread running the window. Prefetches
+# have their own threads so they never hold up a document that has been asked for.
+document_cache = DocumentCache(cache_folder, get_blob_service, cache_max_bytes, cache_fresh_seconds)
+downloads = ThreadPoolExecutor(3)
+prefetches = ThreadPoolExecutor(3)
 
 
 window = Tk()
 window.wm_title("Patient Document Generator")
 
 patient_id = StringVar()
+patient_id.trace_add('write', patient_id_changed)
 entry = Entry(window, textvariable=patient_id, width=45)
 entry.grid(row=1, column=0)
 
@@ -165,4 +239,7 @@ generate_patient_info_button = Button(window, text="Generate Patient Details For
                                      height=2)
 generate_patient_info_button.grid(row=4, column=1)
 
+# the Azure SDK is loaded in the background once the window is showing, so the first download does not wait for it
+window.after_idle(prefetches.submit, get_blob_service)
+
 window.mainloop()